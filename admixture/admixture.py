@@ -2,17 +2,30 @@
 import os
 import sys
 import logging
+import sqlite3
 import argparse
+import cProfile
 import datetime
-
-# Imports: third party
-import pandas as pd
+from typing import Any, Set, Dict, List, Tuple, Iterator, Optional
 
 # Imports: first party
-from plot import generate_admixture_plot
-from loader import vcf, ancestry, load_model, twenty_three
+import metrics
+from cache import DEFAULT_CACHE_SIZE, ResultCache, file_key, default_cache_dir
+from store import SampleStore
+from bundle import ModelBundle
+from loader import (
+    load_model,
+    model_path,
+    file_sample_id,
+    vcf_sample_ids,
+    model_fingerprint,
+)
 from logger import load_config
-from optimizer import estimate_ancestry
+from results import RESULT_FORMATS, ResultWriter, open_writer, check_format
+from parallel import iter_files_parallel
+from pipeline import INTERVAL_SUFFIXES, estimate_files
+from registry import ModelRegistry
+from optimizer import PRECISIONS
 
 
 def setup_log_file(args: argparse.Namespace):
@@ -37,13 +50,19 @@ def parse_args() -> argparse.Namespace:
         "--model",
         type=str,
         required=True,
-        help="The model to use for performing admixture.",
-        choices=[
-            "K7b",
-            "1000Genomes_chr21_population",
-            "1000Genomes_population",
-            "1000Genomes_superpopulation",
-        ],
+        help="The model to use for performing admixture: the name of a model of "
+        f"the registry ({', '.join(ModelRegistry().names())}), of a model in a "
+        "--model-dir folder or the path to a model file.",
+    )
+    parser.add_argument(
+        "--model-dir",
+        action="append",
+        dest="model_dirs",
+        metavar="MODEL_DIR",
+        help="Folder of user-defined models, text or compiled, described by an "
+        "optional models.json manifest. Searched before the folders of the "
+        "ADMIXTURE_MODELS environment variable and the bundled models. Can be "
+        "repeated.",
     )
     parser.add_argument(
         "-i",
@@ -65,54 +84,456 @@ def parse_args() -> argparse.Namespace:
         ],
         default="23andme",
     )
+    parser.add_argument(
+        "--solver",
+        type=str,
+        help="Solver used to estimate the admixture proportions. By default, a run "
+        "whose input files hold a single sample uses slsqp and a run with several "
+        "samples batched em, for every file and every job. slsqp and trust-constr "
+        "solve each sample separately.",
+        choices=[
+            "slsqp",
+            "trust-constr",
+            "em",
+        ],
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        help="Floating point type of the likelihood computations. float32 reads "
+        "half the memory per evaluation and gives proportions within about 0.001 "
+        "of float64. Default: float64",
+        choices=list(PRECISIONS),
+        default="float64",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        help="Read the model frequencies of the SNPs of the samples in blocks of "
+        "this many SNPs at every likelihood evaluation, instead of copying them to "
+        "memory, so that models larger than the memory can be used. Default: copy "
+        "them at once",
+    )
+    parser.add_argument(
+        "--preview",
+        type=float,
+        nargs="?",
+        const=0.005,
+        metavar="TOL",
+        help="Estimate progressively for a quick first result: on 5%% of the SNPs, "
+        "logging the proportions with bootstrap standard errors, then on 20%% and "
+        "on every SNP, stopping once the proportions change by less than TOL. "
+        "Always uses em. Default TOL: 0.005",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        metavar="N",
+        help="Add 95%% confidence intervals of the proportions to ancestries.csv, "
+        "as <population>_lower and <population>_upper columns, from N block "
+        "bootstrap replicates. Default: 0, no intervals",
+        default=0,
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Number of input files loaded and estimated together, whose results "
+        "are written before the next files are loaded. Default: 256",
+        default=256,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of processes used to load and estimate the input files in "
+        "parallel. Each input file is processed by a single process, so the samples "
+        "of a single vcf file are not estimated any faster. Default: 1",
+        default=1,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="Folder of the cache of ancestry estimates. Default: "
+        "$XDG_CACHE_HOME/admixture or ~/.cache/admixture",
+        default=default_cache_dir(),
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        help="Maximum size of the cache in MB, least recently used estimates are "
+        f"evicted first. Default: {DEFAULT_CACHE_SIZE // 2**20}",
+        default=DEFAULT_CACHE_SIZE // 2**20,
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Neither read nor write cached ancestry estimates.",
+    )
+    parser.add_argument(
+        "--sample-store",
+        type=str,
+        metavar="DIR",
+        help="Folder where the genotypes aligned to the model and the proportions "
+        "of every estimated sample are saved, see --merge.",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge the samples already in --sample-store with their stored "
+        "genotypes, e.g. to add a second genotyping file of a sample. Only the new "
+        "file is loaded and the solver starts from the stored proportions. SNPs in "
+        "both take the genotype of the new file.",
+    )
+    parser.add_argument(
+        "--sample-ids",
+        type=str,
+        nargs="+",
+        metavar="ID",
+        help="Id of the sample of each input file, in the same order. Default: the "
+        "file names.",
+    )
+    parser.add_argument(
+        "--no-plot",
+        action="store_true",
+        help="Only save the ancestry predictions, without the visualization.",
+    )
+    parser.add_argument(
+        "--plot-format",
+        type=str,
+        help="Format of the visualization. More than 100 samples are sorted by "
+        "dominant population and drawn as areas. Default: pdf",
+        choices=["pdf", "png", "svg"],
+        default="pdf",
+    )
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        help="Format of the ancestry estimates: ancestries.csv, or the "
+        "ancestries.parquet folder, which requires pyarrow. The estimates of each "
+        "input file are appended as soon as they are available. Default: csv",
+        choices=RESULT_FORMATS,
+        default="csv",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep the ancestry estimates of a previous run in the output folder and "
+        "skip the samples they include.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile the run with cProfile and save the statistics as profile.prof "
+        "in the output folder. Worker processes of --jobs are not profiled.",
+    )
     parser.add_argument(
         "-o",
         "--output",
         type=str,
         required=False,
-        help="Path where the output visualization and the log file will be saved.",
+        help="Path where the output visualization, the run metrics and the log file "
+        "will be saved.",
     )
 
     # Parse the command-line arguments
     args = parser.parse_args()
+    try:
+        model_path(args.model, args.model_dirs)
+        check_format(args.output_format)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.resume and not args.output:
+        parser.error("--resume requires an output folder.")
+    if args.merge and not args.sample_store:
+        parser.error("--merge requires --sample-store.")
+    if args.sample_ids is not None:
+        if args.input_format == "vcf":
+            parser.error("--sample-ids can not rename the samples of vcf files.")
+        if len(args.sample_ids) != len(args.input):
+            parser.error("--sample-ids needs one id per input file.")
+        if len(set(args.sample_ids)) != len(args.sample_ids):
+            parser.error("--sample-ids must be unique.")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1.")
+    if args.block_size is not None and args.block_size < 1:
+        parser.error("--block-size must be at least 1.")
     return args
 
 
+def open_cache(args: argparse.Namespace) -> Optional[ResultCache]:
+    if args.no_cache:
+        return None
+    try:
+        return ResultCache(args.cache_dir, args.cache_size * 2**20)
+    except (OSError, sqlite3.Error) as error:
+        logging.warning(f"Result cache disabled, could not open it: {error}")
+        return None
+
+
+def open_store(args: argparse.Namespace) -> Optional[SampleStore]:
+    if not args.sample_store:
+        return None
+    return SampleStore(args.sample_store, args.merge)
+
+
+def input_sample_ids(args: argparse.Namespace) -> Dict[str, str]:
+    """
+    Id of the sample of each single sample input file given by --sample-ids.
+    """
+    return dict(zip(args.input, args.sample_ids or []))
+
+
+def resolve_solver(args: argparse.Namespace) -> str:
+    """
+    Solver of a run: the requested one, em with --preview, and otherwise em when the
+    input files hold several samples in total and slsqp for a single one. It is
+    chosen once from all the input files, so that every batch of files and every
+    worker of --jobs, which estimate a few files each, use the same solver.
+    """
+    if args.preview is not None:
+        return "em"
+    if args.solver is not None:
+        return args.solver
+    sample_files = list(dict.fromkeys(args.input))
+    if args.input_format == "vcf":
+        n_samples = sum(len(vcf_sample_ids(file)) for file in sample_files)
+    else:
+        n_samples = len(sample_files)
+    return "em" if n_samples > 1 else "slsqp"
+
+
+def iter_results(
+    args: argparse.Namespace,
+    sample_files: List[str],
+    solver: str,
+    cache: Optional[ResultCache] = None,
+    skip: Optional[Set[str]] = None,
+    store: Optional[SampleStore] = None,
+) -> Iterator[Tuple[str, Tuple[Dict[str, Dict[str, float]], Dict[str, str]]]]:
+    """
+    Estimate the input files of a run, yielding the results of each file in input
+    order as soon as they are available: files found in the cache right away, the
+    others in batches of args.batch_size files, or as each worker finishes them and
+    those before them with --jobs.
+
+    :param args: <argparse.Namespace> Arguments of the run.
+    :param sample_files: <List[str]> Path to the input SNP files.
+    :param solver: <str> Solver of the run, see resolve_solver.
+    :param cache: <ResultCache> Cache of ancestry estimates. Default: None.
+    :param skip: <Set[str]> Ids of samples to leave out. Default: None.
+    :param store: <SampleStore> Store of the estimated samples. Default: None.
+
+    :return: <Iterator[Tuple[str, Tuple[Dict[str, Dict[str, float]], Dict[str, str]]]>
+             Each input file with the ancestry of each sample and the error message
+             of each failed sample.
+    """
+    # Files estimated before with the same model and settings are taken from the
+    # cache, looking the model up by the fingerprint in its bundle header. Files
+    # are always loaded with a sample store, so that their genotypes are stored
+    # or merged, and when their samples are renamed, since the file estimates
+    # carry the ids they were cached with.
+    sample_ids = input_sample_ids(args)
+    file_cache = cache if store is None and not sample_ids else None
+    file_keys: Dict[str, str] = {}
+    cached: Dict[str, Any] = {}
+    fingerprint = None
+    if file_cache is not None:
+        fingerprint = model_fingerprint(args.model, args.model_dirs)
+    if file_cache is not None and fingerprint is not None:
+        with metrics.stage("cache") as counts:
+            for sample_file in sample_files:
+                file_keys[sample_file] = file_key(
+                    sample_file,
+                    args.input_format,
+                    fingerprint,
+                    solver,
+                    args.precision,
+                    args.preview,
+                    args.bootstrap,
+                )
+            cached = file_cache.get_many(list(file_keys.values()))
+            counts["files_cached"] = len(cached)
+        logging.info(f"Found {len(cached)} of {len(sample_files)} files in the cache.")
+    pending = [file for file in sample_files if file_keys.get(file) not in cached]
+    results: Iterator[
+        Tuple[str, Tuple[Dict[str, Dict[str, float]], Dict[str, str]]]
+    ] = iter(())
+    fingerprint = fingerprint or ""
+    if pending:
+        logging.info(f"Loading admixture {args.model} model...")
+        with metrics.stage("load_model", model=args.model) as counts:
+            model = load_model(args.model, args.model_dirs)
+            counts["snps"] = len(model)
+        logging.info("Admixture model loaded!")
+        fingerprint = model.fingerprint
+        results = _estimate_pending(args, pending, model, solver, cache, skip, store)
+
+    # The files are yielded in input order, the cached ones between the others
+    for sample_file in sample_files:
+        key = file_keys.get(sample_file)
+        if key in cached:
+            yield sample_file, (cached[key], {})
+            continue
+        sample_file, (file_ancestries, file_failures) = next(results)
+        # Files missing skipped samples are not cached as complete results
+        if file_cache is not None and not file_failures and not skip:
+            key = key or file_key(
+                sample_file,
+                args.input_format,
+                fingerprint,
+                solver,
+                args.precision,
+                args.preview,
+                args.bootstrap,
+            )
+            file_cache.put_many({key: file_ancestries})
+        yield sample_file, (file_ancestries, file_failures)
+
+
+def _estimate_pending(
+    args: argparse.Namespace,
+    pending: List[str],
+    model: ModelBundle,
+    solver: str,
+    cache: Optional[ResultCache],
+    skip: Optional[Set[str]],
+    store: Optional[SampleStore],
+) -> Iterator[Tuple[str, Tuple[Dict[str, Dict[str, float]], Dict[str, str]]]]:
+    """
+    Estimate the input files that are not in the file cache, in input order, see
+    iter_results.
+    """
+    sample_ids = input_sample_ids(args)
+    if args.jobs > 1:
+        logging.info(f"Processing {len(pending)} files with {args.jobs} jobs...")
+        yield from iter_files_parallel(
+            pending,
+            args.input_format,
+            args.model,
+            model,
+            solver,
+            args.jobs,
+            cache,
+            args.precision,
+            args.preview,
+            args.bootstrap,
+            skip,
+            args.block_size,
+            args.model_dirs,
+            store,
+            sample_ids,
+        )
+        return
+    for start in range(0, len(pending), args.batch_size):
+        yield from estimate_files(
+            pending[start : start + args.batch_size],
+            args.input_format,
+            model,
+            solver,
+            cache,
+            args.precision,
+            args.preview,
+            args.bootstrap,
+            skip,
+            args.block_size,
+            store,
+            sample_ids,
+        ).items()
+
+
+def run(args: argparse.Namespace):
+    solver = resolve_solver(args)
+    cache = open_cache(args)
+    store = open_store(args)
+    writer: Optional[ResultWriter] = None
+    if args.output:
+        writer = open_writer(args.output, args.output_format, args.resume)
+
+    # Samples written by a previous run are skipped, single sample files without
+    # being loaded
+    sample_files = list(dict.fromkeys(args.input))
+    done = set(writer.sample_ids) if writer is not None else set()
+    if writer is not None and done:
+        logging.info(f"Found {len(done)} samples of a previous run in {writer.path}.")
+        if args.input_format != "vcf":
+            sample_ids = input_sample_ids(args)
+            sample_files = [
+                file
+                for file in sample_files
+                if sample_ids.get(file, file_sample_id(file)) not in done
+            ]
+
+    failures: Dict[str, str] = {}
+    try:
+        for sample_file, (file_ancestries, file_failures) in iter_results(
+            args,
+            sample_files,
+            solver,
+            cache,
+            done if args.input_format == "vcf" else None,
+            store,
+        ):
+            failures.update(file_failures)
+            if writer is None:
+                continue
+            with metrics.stage("write", file=sample_file) as counts:
+                new = {
+                    sample_id: admixture
+                    for sample_id, admixture in file_ancestries.items()
+                    if sample_id not in writer.sample_ids
+                }
+                writer.write(new)
+                counts["samples"] = len(new)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if failures:
+        logging.error(
+            f"Failed to process {len(failures)} samples: {', '.join(failures)}",
+        )
+
+    if writer is not None:
+        logging.info(
+            f"Saved ancestry predictions of {writer.n_written} samples to: "
+            f"{writer.path}",
+        )
+        if not args.no_plot:
+            with metrics.stage("plot"):
+                from plot import generate_admixture_plot  # isort: skip
+
+                plot_path = os.path.join(args.output, f"ancestry.{args.plot_format}")
+                logging.info(f"Saving visualization to: {plot_path}")
+                data = writer.read()
+                proportions = data.drop(
+                    columns=[
+                        column
+                        for column in data.columns
+                        if column.endswith(INTERVAL_SUFFIXES)
+                    ],
+                )
+                generate_admixture_plot(proportions, args.output, args.plot_format)
+
+
 def main():
     args = parse_args()
     setup_log_file(args)
-
-    logging.info(f"Loading {len(args.input)} samples...")
-    data_dict = {}
-    for sample_file in args.input:
-        if args.input_format == "ancestry":
-            sample_data = ancestry(sample_file)
-        elif args.input_format == "vcf":
-            sample_data = vcf(sample_file)
-        elif args.input_format == "23andme":
-            sample_data = twenty_three(sample_file)
-        else:
-            raise ValueError(f"Unkown input format: {args.input_format}")
-        data_dict.update(sample_data)
-    logging.info("Samples loaded!")
-
-    logging.info(f"Loading admixture {args.model} model...")
-    model = load_model(args.model)
-    logging.info("Admixture model loaded!")
-
-    ancestries = {}
-    for sample_id, sample in data_dict.items():
-        logging.info(f"Estimating sample {sample_id} ancestry...")
-        ancestries[sample_id] = estimate_ancestry(sample, model)
-
+    recorder = metrics.enable()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with metrics.stage("total"):
+            run(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profile_path = os.path.join(args.output or ".", "profile.prof")
+            profiler.dump_stats(profile_path)
+            logging.info(f"Saved profile to: {profile_path}")
     if args.output:
-        data = pd.DataFrame.from_dict(ancestries, orient="index").round(3)
-        data.index.name = "id"
-        ancestries_path = os.path.join(args.output, "ancestries.csv")
-        data.to_csv(ancestries_path)
-        logging.info("Saved ancestry predictions to: {ancestries_path}")
-        logging.info(f"Saving visualization to: {args.output}/ancestry.pdf")
-        generate_admixture_plot(data, args.output)
+        recorder.write(args.output)
+        logging.info(f"Saved run metrics to: {args.output}/{metrics.METRICS_JSON}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+"""Bootstrap confidence intervals and progressive estimates of the proportions"""
+
+# Imports: standard library
+from typing import Dict, Tuple, Union, Iterator, Optional, NamedTuple
+
+# Imports: third party
+import numpy as np
+
+# Imports: first party
+import metrics
+from bundle import ModelBundle
+from encoding import GenotypeMatrix
+from optimizer import FrequencyBlocks, model_frequencies, solve_admixture_batch
+
+# Number of blocks of consecutive SNPs resampled by bootstrap_intervals
+BOOTSTRAP_BLOCKS = 100
+# Weight of the uniform proportions in the starting point of the replicates
+BOOTSTRAP_SHRINKAGE = 0.05
+
+
+def bootstrap_admixture(
+    frequencies: Union[np.ndarray, FrequencyBlocks],
+    dosages: np.ndarray,
+    admixture: np.ndarray,
+    n_replicates: int = 100,
+    blocks: Optional[np.ndarray] = None,
+    seed: Optional[int] = None,
+    tol: float = 1e-8,
+    chunk_size: int = 32,
+) -> np.ndarray:
+    """
+    Bootstrap the admixture proportions of a sample. Each replicate draws blocks of
+    SNPs with replacement and weights every SNP by the number of times its block
+    was drawn, so the frequencies and dosages already aligned are reused as they
+    are. The replicates are solved together with batched EM, starting from the
+    proportions estimated on every SNP moved slightly towards uniform ones, since
+    EM only leaves a proportion of zero slowly and would otherwise stop next to it.
+
+    :param frequencies: <np.ndarray> (n_snps, n_pops) Reference populations
+                                     SNPs frequencies.
+    :param dosages: <np.ndarray> (n_snps,) Count of alternate alleles of the sample,
+                                 negative where it is missing.
+    :param admixture: <np.ndarray> (n_pops,) Proportions estimated on every SNP.
+    :param n_replicates: <int> Number of bootstrap replicates. Default: 100.
+    :param blocks: <np.ndarray> (n_snps,) Block of each SNP, numbered from 0.
+                                Default: every SNP is its own block.
+    :param seed: <int> Random seed. Default: None.
+    :param tol: <float> Convergence tolerance of the replicates. Default: 1e-8.
+    :param chunk_size: <int> Number of replicates solved at once. Default: 32.
+
+    :return: <np.ndarray> (n_replicates, n_pops) Proportions of each replicate.
+    """
+    rng = np.random.default_rng(seed)
+    if blocks is None:
+        blocks = np.arange(len(dosages))
+    if len(blocks) == 0:
+        return np.tile(admixture, (n_replicates, 1))
+    start_admixture = (1 - BOOTSTRAP_SHRINKAGE) * admixture
+    start_admixture += BOOTSTRAP_SHRINKAGE / len(admixture)
+    n_blocks = int(blocks.max()) + 1
+    replicates = np.zeros((n_replicates, len(admixture)))
+    for start in range(0, n_replicates, chunk_size):
+        size = min(chunk_size, n_replicates - start)
+        counts = rng.multinomial(n_blocks, np.full(n_blocks, 1 / n_blocks), size)
+        replicates[start : start + size], _ = solve_admixture_batch(
+            frequencies,
+            np.broadcast_to(dosages, (size, len(dosages))),
+            tol=tol,
+            chunk_size=size,
+            initial=np.tile(start_admixture, (size, 1)),
+            weights=counts[:, blocks].astype(frequencies.dtype),
+        )
+    return replicates
+
+
+class PreviewStage(NamedTuple):
+    """
+    Estimates of one stage of estimate_ancestry_progressive.
+
+    fraction: <float> Fraction of the SNPs used.
+    n_snps: <int> Number of SNPs used.
+    ancestries: <Dict[str, Dict[str, float]]> Proportions of each sample estimated
+                                              in this stage.
+    errors: <Dict[str, Dict[str, float]]> Bootstrap standard error of each
+                                          proportion, empty on every SNP.
+    changes: <Dict[str, float]> Largest change of the proportions of each sample
+                                since the previous stage.
+    """
+
+    fraction: float
+    n_snps: int
+    ancestries: Dict[str, Dict[str, float]]
+    errors: Dict[str, Dict[str, float]]
+    changes: Dict[str, float]
+
+
+def stratified_priorities(
+    n_snps: int,
+    n_strata: int = 100,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Random priority of each SNP, spread uniformly in [0, 1) within each of n_strata
+    contiguous blocks of SNPs. The SNPs whose priority is below f are then a
+    fraction f of every block, i.e. of every region of the genome in model order,
+    and the subsets of growing fractions are nested.
+
+    :param n_snps: <int> Number of SNPs.
+    :param n_strata: <int> Number of blocks. Default: 100.
+    :param seed: <int> Random seed. Default: None.
+
+    :return: <np.ndarray> (n_snps,) Priority of each SNP.
+    """
+    rng = np.random.default_rng(seed)
+    priorities = np.zeros(n_snps)
+    for stratum in np.array_split(np.arange(n_snps), max(min(n_strata, n_snps), 1)):
+        ranks = rng.permutation(len(stratum)) + rng.random(len(stratum))
+        priorities[stratum] = ranks / len(stratum)
+    return priorities
+
+
+def estimate_ancestry_progressive(
+    genotypes: GenotypeMatrix,
+    model: ModelBundle,
+    fractions: Tuple[float, ...] = (0.05, 0.2, 1.0),
+    tol: float = 0.005,
+    n_bootstrap: int = 20,
+    seed: Optional[int] = 0,
+    precision: str = "float64",
+    block_size: Optional[int] = None,
+) -> Iterator[PreviewStage]:
+    """
+    Estimate the ancestry of several samples on growing, stratified random subsets
+    of their SNPs. Each stage is solved with batched EM starting from the
+    proportions of the previous one, and its estimates are yielded as soon as they
+    are available, with bootstrap standard errors while not every SNP is used. A
+    sample stops being refined once its proportions change by less than tol.
+
+    :param genotypes: <GenotypeMatrix> Genotypes of the samples.
+    :param model: <ModelBundle> Reference populations SNPs frequencies.
+    :param fractions: <Tuple[float, ...]> Increasing fraction of the SNPs used by
+                                          each stage. Default: (0.05, 0.2, 1.0).
+    :param tol: <float> Largest change of a proportion between two stages at which
+                        a sample is considered converged. Default: 0.005.
+    :param n_bootstrap: <int> Bootstrap replicates used to compute the standard
+                              errors of a stage. Default: 20.
+    :param seed: <int> Random seed of the subsets and the bootstrap. Default: 0.
+    :param precision: <str> Floating point type of the likelihood computations.
+                            Default: float64.
+    :param block_size: <int> If given, the model frequencies are read in blocks of
+                             this many SNPs, see FrequencyBlocks. Default: None.
+
+    :return: <Iterator[PreviewStage]> Estimates of each stage.
+    """
+    pops = model.populations
+    frequencies = model_frequencies(model, genotypes.rows, precision, block_size)
+    priorities = stratified_priorities(len(genotypes.rows), seed=seed)
+    admixtures = np.full((len(genotypes.sample_ids), len(pops)), 1 / len(pops))
+    active = np.arange(len(genotypes.sample_ids))
+    for stage, fraction in enumerate(fractions):
+        if active.size == 0:
+            break
+        subset = priorities < fraction
+        dosages = genotypes.dosages[np.ix_(active, subset)]
+        # Previews only need to be as precise as their standard errors
+        estimates, _ = solve_admixture_batch(
+            frequencies[subset],
+            dosages,
+            tol=1e-10 if fraction >= 1 else 1e-8,
+            initial=admixtures[active] if stage else None,
+        )
+        changes = np.abs(estimates - admixtures[active]).max(axis=1)
+        admixtures[active] = estimates
+
+        errors = {}
+        if fraction < 1:
+            for i, sample in enumerate(active):
+                replicates = bootstrap_admixture(
+                    frequencies[subset],
+                    dosages[i],
+                    estimates[i],
+                    n_bootstrap,
+                    seed=None if seed is None else seed + stage,
+                    tol=1e-6,
+                )
+                errors[genotypes.sample_ids[sample]] = dict(
+                    zip(pops, replicates.std(axis=0, ddof=1)),
+                )
+        ids = [genotypes.sample_ids[i] for i in active]
+        yield PreviewStage(
+            fraction,
+            int(subset.sum()),
+            {id: dict(zip(pops, admixture)) for id, admixture in zip(ids, estimates)},
+            errors,
+            dict(zip(ids, changes.tolist())) if stage else {},
+        )
+        if stage:
+            active = active[changes >= tol]
+
+
+def bootstrap_intervals(
+    genotypes: GenotypeMatrix,
+    model: ModelBundle,
+    ancestries: Dict[str, Dict[str, float]],
+    n_replicates: int,
+    confidence: float = 0.95,
+    n_blocks: int = BOOTSTRAP_BLOCKS,
+    seed: Optional[int] = 0,
+    precision: str = "float64",
+    block_size: Optional[int] = None,
+) -> Dict[str, Dict[str, Tuple[float, float]]]:
+    """
+    Percentile confidence intervals of the proportions of several samples from a
+    block bootstrap. The SNPs of each sample are split into n_blocks blocks of
+    consecutive model rows, so that linked SNPs are resampled together. The models
+    only hold the rsid and the alleles of each SNP, not its position, so the blocks
+    follow the genome only as far as the model rows are in genome order, as they
+    are in the models built by models.py from the chromosome vcf files. The bounds
+    are the percentiles of the replicates, so a proportion at or next to zero, which
+    no replicate can go below, has a lower bound of zero.
+
+    :param genotypes: <GenotypeMatrix> Genotypes of the samples.
+    :param model: <ModelBundle> Reference populations SNPs frequencies.
+    :param ancestries: <Dict[str, Dict[str, float]]> Proportions estimated on every
+                                                     SNP, the replicates start
+                                                     from them.
+    :param n_replicates: <int> Number of bootstrap replicates.
+    :param confidence: <float> Confidence level of the intervals. Default: 0.95.
+    :param n_blocks: <int> Number of blocks of each sample. Default: 100.
+    :param seed: <int> Random seed. Default: 0.
+    :param precision: <str> Floating point type of the likelihood computations.
+                            Default: float64.
+    :param block_size: <int> If given, the model frequencies are read in blocks of
+                             this many SNPs, see FrequencyBlocks. Default: None.
+
+    :return: <Dict[str, Dict[str, Tuple[float, float]]]> Lower and upper bound of
+                                                         the proportion of each
+                                                         population of each sample.
+    """
+    pops = model.populations
+    frequencies = model_frequencies(model, genotypes.rows, precision, block_size)
+    quantiles = [(1 - confidence) / 2, (1 + confidence) / 2]
+    intervals = {}
+    for sample_id, dosages in zip(genotypes.sample_ids, genotypes.dosages):
+        if sample_id not in ancestries:
+            continue
+        observed = np.flatnonzero(dosages >= 0)
+        n_snps = len(observed)
+        replicates = bootstrap_admixture(
+            frequencies[observed],
+            dosages[observed],
+            np.array([ancestries[sample_id][pop] for pop in pops]),
+            n_replicates,
+            blocks=np.arange(n_snps) * min(n_blocks, n_snps) // max(n_snps, 1),
+            seed=seed,
+        )
+        lower, upper = np.quantile(replicates, quantiles, axis=0)
+        intervals[sample_id] = dict(zip(pops, zip(lower, upper)))
+    metrics.count("bootstrap_replicates", n_replicates * len(intervals))
+    return intervals
@@ -0,0 +1,428 @@
+"""Compiled binary format for admixture models"""
+
+# Imports: standard library
+import os
+import json
+import mmap
+import hashlib
+import logging
+import argparse
+import tempfile
+from typing import Dict, List, Tuple, Optional
+
+# Imports: third party
+import numpy as np
+import pandas as pd
+
+# Imports: first party
+from encoding import RsidIndex, encode_alleles
+
+# A bundle is a single file laid out as:
+#   MAGIC | uint32 version | uint64 header size | JSON header | padding | arrays
+# Every array starts at an offset multiple of ALIGNMENT (relative to the end of the
+# padded header) so that it can be viewed directly from a memory map.
+MAGIC = b"ADMXBNDL"
+VERSION = 3
+ALIGNMENT = 64
+BUNDLE_EXTENSION = ".bundle"
+
+
+class ModelBundle:
+    """
+    Admixture model stored as plain arrays: the rsid of each SNP, the uint8 codes of
+    its reference and alternate alleles and the alternate allele frequency of each
+    population. When read from a compiled bundle the arrays are read-only views of a
+    memory map, so every process on the host shares the same page-cached data.
+    """
+
+    def __init__(
+        self,
+        rsids: np.ndarray,
+        alleles: np.ndarray,
+        frequencies: np.ndarray,
+        populations: List[str],
+    ):
+        """
+        :param rsids: <np.ndarray> (n_snps,) Identifier of each SNP.
+        :param alleles: <np.ndarray> (n_snps, 2) uint8 codes of the ref and alt alleles.
+        :param frequencies: <np.ndarray> (n_snps, n_pops) Alternate allele frequencies.
+        :param populations: <List[str]> Name of each population.
+        """
+        self.rsids = rsids
+        self.alleles = alleles
+        self.frequencies = frequencies
+        self.populations = list(populations)
+        self._index: Optional[RsidIndex] = None
+        self._fingerprint: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self.rsids)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Size of the arrays of the model, including the rsid index once it is built.
+        Memory-mapped arrays are included, since their pages become resident as
+        they are read.
+        """
+        arrays = [self.rsids, self.alleles, self.frequencies]
+        if self._index is not None:
+            index = self._index
+            arrays += [index.codes, index.code_rows, index.other_ids, index.other_rows]
+        return sum(int(np.asarray(array).nbytes) for array in arrays)
+
+    @property
+    def ref(self) -> np.ndarray:
+        return self.alleles[:, 0]
+
+    @property
+    def alt(self) -> np.ndarray:
+        return self.alleles[:, 1]
+
+    @property
+    def index(self) -> RsidIndex:
+        """
+        Lookup table from rsid to model row. Compiled bundles store it, otherwise it
+        is built on first use.
+        """
+        if self._index is None:
+            rsids = self.rsids
+            if rsids.dtype.kind == "S":
+                rsids = rsids.astype(str)
+            self._index = RsidIndex.build(rsids)
+        return self._index
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Hash of the model content, stored in compiled bundles and computed on first
+        use otherwise.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = _fingerprint(_bundle_arrays(self), self.populations)
+        return self._fingerprint
+
+    def select(self, populations: List[str]) -> "ModelBundle":
+        """
+        Restrict the model to a subset of its populations.
+
+        :param populations: <List[str]> Populations to keep.
+
+        :return: <ModelBundle> Model with only the given populations.
+        """
+        columns = [self.populations.index(pop) for pop in populations]
+        bundle = ModelBundle(
+            self.rsids,
+            self.alleles,
+            np.ascontiguousarray(self.frequencies[:, columns]),
+            populations,
+        )
+        bundle._index = self._index
+        bundle._fingerprint = select_fingerprint(self.fingerprint, populations)
+        return bundle
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "ModelBundle":
+        """
+        Build a model from a DataFrame with the rsid, ref and alt columns followed by
+        one frequency column per population. SNPs with multi-character alleles can
+        not be encoded and are dropped, as are repeated rsids after their first
+        row, with a warning giving the number of SNPs dropped.
+
+        :param df: <pd.DataFrame> Model as loaded from its text file.
+
+        :return: <ModelBundle> The same model as arrays.
+        """
+        repeated = df.duplicated(subset="rsid").to_numpy()
+        if repeated.any():
+            logging.warning(
+                f"Dropping {repeated.sum()} SNPs whose rsid is already in the model.",
+            )
+        df = df[~repeated].reset_index(drop=True)
+        ref, irregular_ref = encode_alleles(df["ref"])
+        alt, irregular_alt = encode_alleles(df["alt"])
+        keep = ~(irregular_ref | irregular_alt)
+        if not keep.all():
+            logging.warning(
+                f"Dropping {(~keep).sum()} SNPs with multi-character alleles.",
+            )
+        return cls(
+            df["rsid"].to_numpy(dtype=str)[keep],
+            np.stack([ref, alt], axis=1)[keep],
+            df[df.columns[3:]].to_numpy()[keep],
+            list(df.columns[3:]),
+        )
+
+
+def bundle_path(text_path: str) -> str:
+    """
+    Default location of the compiled bundle of a model text file.
+    """
+    return os.path.splitext(text_path)[0] + BUNDLE_EXTENSION
+
+
+def _aligned(size: int) -> int:
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def _bundle_arrays(bundle: ModelBundle) -> Dict[str, np.ndarray]:
+    width = max((len(rsid) for rsid in bundle.rsids), default=1)
+    return {
+        "rsids": np.asarray(bundle.rsids, dtype=f"S{width}"),
+        "alleles": np.ascontiguousarray(bundle.alleles, dtype=np.uint8),
+        "frequencies": np.ascontiguousarray(bundle.frequencies, dtype=np.float32),
+    }
+
+
+def _fingerprint(arrays: Dict[str, np.ndarray], populations: List[str]) -> str:
+    digest = hashlib.sha256(json.dumps(populations).encode("utf-8"))
+    for array in arrays.values():
+        digest.update(array.dtype.str.encode("utf-8"))
+        digest.update(np.ascontiguousarray(array).data)
+    return digest.hexdigest()
+
+
+def select_fingerprint(fingerprint: str, populations: List[str]) -> str:
+    """
+    Fingerprint of a model restricted to a subset of its populations.
+    """
+    digest = hashlib.sha256(fingerprint.encode("utf-8"))
+    digest.update(json.dumps(list(populations)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def write_bundle(bundle: ModelBundle, path: str):
+    """
+    Write a model to a binary bundle. The file is first written to a temporary
+    location and then moved in place, so concurrent readers never see a partial file.
+
+    :param bundle: <ModelBundle> Model to write.
+    :param path: <str> Path of the bundle file.
+    """
+    arrays = _bundle_arrays(bundle)
+    fingerprint = _fingerprint(arrays, bundle.populations)
+    index = bundle.index
+    arrays = {
+        **arrays,
+        "index_codes": np.ascontiguousarray(index.codes, dtype=np.int64),
+        "index_code_rows": np.ascontiguousarray(index.code_rows, dtype=np.int64),
+        "index_other_ids": np.ascontiguousarray(index.other_ids),
+        "index_other_rows": np.ascontiguousarray(index.other_rows, dtype=np.int64),
+    }
+    layout: Dict[str, Dict] = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps(
+        {
+            "populations": bundle.populations,
+            "fingerprint": fingerprint,
+            "arrays": layout,
+        },
+    ).encode("utf-8")
+    prefix_size = len(MAGIC) + 4 + 8
+    data_start = _aligned(prefix_size + len(header))
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(MAGIC)
+            file.write(np.uint32(VERSION).tobytes())
+            file.write(np.uint64(len(header)).tobytes())
+            file.write(header)
+            for name, array in arrays.items():
+                file.seek(data_start + layout[name]["offset"])
+                file.write(array.tobytes())
+            file.truncate(data_start + offset)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_header(path: str) -> Tuple[Dict, int]:
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a model bundle.")
+        version = int(np.frombuffer(file.read(4), dtype=np.uint32)[0])
+        if version != VERSION:
+            raise ValueError(f"{path} is a version {version} model bundle.")
+        header_size = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+        header = json.loads(file.read(header_size).decode("utf-8"))
+    return header, _aligned(len(MAGIC) + 4 + 8 + header_size)
+
+
+def read_bundle(path: str) -> ModelBundle:
+    """
+    Memory-map a binary bundle. No data is parsed or copied: the arrays of the
+    returned model are read-only views of the file.
+
+    :param path: <str> Path of the bundle file.
+
+    :return: <ModelBundle> The model stored in the bundle.
+    """
+    header, data_start = _read_header(path)
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        start = data_start + spec["offset"]
+        size = int(np.prod(spec["shape"])) * dtype.itemsize
+        array = buffer[start : start + size].view(dtype).reshape(spec["shape"])
+        arrays[name] = array
+    bundle = ModelBundle(
+        arrays["rsids"],
+        arrays["alleles"],
+        arrays["frequencies"],
+        header["populations"],
+    )
+    bundle._index = RsidIndex(
+        arrays["index_codes"],
+        arrays["index_code_rows"],
+        arrays["index_other_ids"],
+        arrays["index_other_rows"],
+    )
+    bundle._fingerprint = header["fingerprint"]
+    return bundle
+
+
+def release_pages(array: np.ndarray, start: int, stop: int):
+    """
+    Unmap rows start to stop of a memory-mapped array from the process, e.g. once
+    they have been read, so that they stop counting towards its resident memory.
+    The pages stay in the page cache and are mapped again without reading the disk
+    if they are accessed later. Does nothing for arrays that are not memory-mapped.
+
+    :param array: <np.ndarray> C-contiguous array, e.g. the frequencies of a bundle.
+    :param start: <int> First row to release.
+    :param stop: <int> Row after the last one to release.
+    """
+    mapping = getattr(array, "_mmap", None)
+    if mapping is None or not hasattr(mmap, "MADV_DONTNEED") or stop <= start:
+        return
+    origin = np.frombuffer(mapping, dtype=np.uint8, count=1).ctypes.data
+    begin = array.ctypes.data - origin + start * array.strides[0]
+    end = array.ctypes.data - origin + stop * array.strides[0]
+    begin -= begin % mmap.PAGESIZE
+    mapping.madvise(mmap.MADV_DONTNEED, begin, end - begin)
+
+
+def read_model_text(text_path: str) -> pd.DataFrame:
+    """
+    Parse a whitespace-delimited model text file.
+    """
+    return pd.read_csv(
+        text_path,
+        sep=r"\s+",
+        dtype={"rsid": str, "ref": str, "alt": str},
+    )
+
+
+def compile_model(text_path: str, output_path: Optional[str] = None) -> str:
+    """
+    Convert a model text file into a binary bundle.
+
+    :param text_path: <str> Path to the whitespace-delimited model file.
+    :param output_path: <str> Where to write the bundle. Default: next to the text
+                              file, with the .bundle extension.
+
+    :return: <str> Path of the written bundle.
+    """
+    output_path = output_path or bundle_path(text_path)
+    logging.info(f"Compiling model {text_path} into {output_path}...")
+    write_bundle(ModelBundle.from_frame(read_model_text(text_path)), output_path)
+    return output_path
+
+
+def _is_stale(text_path: str, path: str) -> bool:
+    if not os.path.exists(text_path):
+        return not os.path.exists(path)
+    stale = not os.path.exists(path)
+    return stale or os.path.getmtime(text_path) > os.path.getmtime(path)
+
+
+def bundle_fingerprint(text_path: str) -> Optional[str]:
+    """
+    Fingerprint of a model read from the header of its compiled bundle, without
+    mapping its arrays.
+
+    :param text_path: <str> Path to the whitespace-delimited model file.
+
+    :return: <str> The fingerprint, None if the bundle is missing or out of date.
+    """
+    path = bundle_path(text_path)
+    if _is_stale(text_path, path):
+        return None
+    try:
+        return _read_header(path)[0]["fingerprint"]
+    except (OSError, ValueError):
+        return None
+
+
+def load_bundle(text_path: str) -> ModelBundle:
+    """
+    Load a model through its compiled bundle, (re)building the bundle when it does
+    not exist, the text file is newer or it was written by another version. If the
+    bundle can not be written, e.g. the models folder is read-only, the text file is
+    parsed instead.
+
+    :param text_path: <str> Path to the whitespace-delimited model file.
+
+    :return: <ModelBundle> The model.
+    """
+    path = bundle_path(text_path)
+    if not os.path.exists(text_path) and os.path.exists(path):
+        return read_bundle(path)
+    if not _is_stale(text_path, path):
+        try:
+            return read_bundle(path)
+        except ValueError as error:
+            logging.info(f"Recompiling model bundle: {error}")
+    try:
+        compile_model(text_path, path)
+    except OSError as error:
+        logging.warning(f"Could not compile model {text_path}: {error}")
+        return ModelBundle.from_frame(read_model_text(text_path))
+    return read_bundle(path)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Compile admixture model text files into binary bundles.",
+    )
+    parser.add_argument(
+        "models",
+        nargs="+",
+        type=str,
+        help="Path to the model text files.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        required=False,
+        help="Folder where to save the bundles. Default: next to each model file.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    for text_path in args.models:
+        output_path = None
+        if args.output is not None:
+            output_path = os.path.join(
+                args.output,
+                os.path.basename(bundle_path(text_path)),
+            )
+        print(compile_model(text_path, output_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""On-disk cache of ancestry estimates"""
+
+# Imports: standard library
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+from typing import Any, Dict, List, Iterator, Optional
+from contextlib import closing, contextmanager
+
+# Imports: first party
+from encoding import GenotypeMatrix
+
+# Bumped whenever the estimates of the same inputs may change, e.g. a solver fix,
+# so that older entries are not used anymore
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE = 256 * 2**20
+
+
+def default_cache_dir() -> str:
+    """
+    Default cache folder, following the XDG base directory specification.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "admixture")
+
+
+def _settings_digest(kind: str, fingerprint: str, solver: Optional[str], *extra):
+    settings = [kind, CACHE_VERSION, fingerprint, solver, *extra]
+    return hashlib.sha256(json.dumps(settings).encode("utf-8"))
+
+
+def file_key(
+    file_path: str,
+    input_format: str,
+    fingerprint: str,
+    solver: str,
+    precision: str = "float64",
+    preview: Optional[float] = None,
+    bootstrap: int = 0,
+) -> str:
+    """
+    Cache key of the estimates of every sample in an input file.
+
+    :param file_path: <str> Path to the input SNP file.
+    :param input_format: <str> File format of the input file.
+    :param fingerprint: <str> Fingerprint of the model.
+    :param solver: <str> Solver used, as chosen for the run when none is requested.
+    :param precision: <str> Floating point type of the computations.
+                            Default: float64.
+    :param preview: <float> Tolerance of the progressive estimation, None if the
+                            samples are estimated on every SNP. Default: None.
+    :param bootstrap: <int> Number of bootstrap replicates. Default: 0.
+
+    :return: <str> Hash of the file content and the estimation settings.
+    """
+    digest = _settings_digest(
+        "file",
+        fingerprint,
+        solver,
+        input_format,
+        precision,
+        preview,
+        bootstrap,
+    )
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sample_keys(
+    genotypes: GenotypeMatrix,
+    fingerprint: str,
+    solver: str,
+    precision: str = "float64",
+    preview: Optional[float] = None,
+    bootstrap: int = 0,
+) -> List[str]:
+    """
+    Cache key of the estimate of each sample of a genotype matrix. Only the SNPs
+    observed in a sample are hashed, so the key does not depend on the samples it
+    was loaded with.
+
+    :param genotypes: <GenotypeMatrix> Genotypes aligned to the model.
+    :param fingerprint: <str> Fingerprint of the model.
+    :param solver: <str> Solver used.
+    :param precision: <str> Floating point type of the computations.
+                            Default: float64.
+    :param preview: <float> Tolerance of the progressive estimation, None if the
+                            samples are estimated on every SNP. Default: None.
+    :param bootstrap: <int> Number of bootstrap replicates. Default: 0.
+
+    :return: <List[str]> Hash of the aligned genotypes and the estimation settings
+                         of each sample.
+    """
+    settings = _settings_digest(
+        "sample",
+        fingerprint,
+        solver,
+        precision,
+        preview,
+        bootstrap,
+    )
+    rows = genotypes.rows.astype("<i8")
+    keys = []
+    for dosages in genotypes.dosages:
+        observed = dosages >= 0
+        digest = settings.copy()
+        digest.update(rows[observed].tobytes())
+        digest.update(dosages[observed].tobytes())
+        keys.append(digest.hexdigest())
+    return keys
+
+
+class ResultCache:
+    """
+    Size-bounded cache of JSON values in a SQLite database. Entries are evicted in
+    least recently used order once the total size of the values exceeds max_bytes.
+    Failures to use the database are logged and treated as cache misses, so the
+    cache never stops a run. Connections are opened per operation, so the cache can
+    be shared with worker processes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_CACHE_SIZE):
+        """
+        :param directory: <str> Folder of the cache database, created if needed.
+        :param max_bytes: <int> Maximum total size of the cached values.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "results.sqlite")
+        self.max_bytes = max_bytes
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "size INTEGER NOT NULL, accessed REAL NOT NULL)",
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)",
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        with closing(sqlite3.connect(self.path, timeout=60)) as connection:
+            with connection:
+                yield connection
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """
+        Look up several keys, marking the ones found as recently used.
+
+        :param keys: <List[str]> Keys to look up.
+
+        :return: <Dict[str, Any]> Value of each key found.
+        """
+        values: Dict[str, Any] = {}
+        try:
+            with self._connect() as connection:
+                # SQLite limits the number of parameters of a statement
+                for start in range(0, len(keys), 500):
+                    batch = keys[start : start + 500]
+                    rows = connection.execute(
+                        "SELECT key, value FROM results WHERE key IN "
+                        f"({', '.join('?' * len(batch))})",
+                        batch,
+                    )
+                    values.update((key, json.loads(value)) for key, value in rows)
+                connection.executemany(
+                    "UPDATE results SET accessed = ? WHERE key = ?",
+                    [(time.time(), key) for key in values],
+                )
+        except sqlite3.Error as error:
+            logging.warning(f"Could not read the result cache {self.path}: {error}")
+            return {}
+        return values
+
+    def put_many(self, values: Dict[str, Any]):
+        """
+        Store several values, then evict the least recently used entries until the
+        cache fits in max_bytes.
+
+        :param values: <Dict[str, Any]> JSON-serializable value of each key.
+        """
+        if not values:
+            return
+        now = time.time()
+        entries = []
+        for key, value in values.items():
+            text = json.dumps(value)
+            entries.append((key, text, len(text), now))
+        try:
+            with self._connect() as connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                    entries,
+                )
+                self._evict(connection)
+        except sqlite3.Error as error:
+            logging.warning(f"Could not write the result cache {self.path}: {error}")
+
+    def _evict(self, connection: sqlite3.Connection):
+        total = connection.execute("SELECT SUM(size) FROM results").fetchone()[0]
+        excess = (total or 0) - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        rows = connection.execute("SELECT key, size FROM results ORDER BY accessed")
+        for key, size in rows:
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        rows.close()
+        connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+        logging.info(f"Evicted {len(evicted)} entries from the result cache.")
@@ -0,0 +1,228 @@
+# Imports: standard library
+from typing import List, Tuple, Iterable, Optional, Sequence, NamedTuple
+
+# Imports: third party
+import numpy as np
+import pandas as pd
+
+# Alleles and genotypes are encoded with the ASCII code of each base, so that
+# 'A' -> 65, 'C' -> 67, ... and 0 stands for "no allele". Every single character
+# allele is then represented exactly and comparisons between codes give the same
+# answer as comparisons between the original strings.
+MISSING = 0
+
+# rsids are encoded as the integer after the 'rs' prefix. Up to 18 digits fit in an
+# int64, longer ids (and any id that is not 'rs' followed by digits without leading
+# zeros) go to a side table.
+RSID_WIDTH = 20
+NOT_RSID = -1
+
+
+def encode_alleles(alleles: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encode single character alleles as uint8 codes.
+
+    :param alleles: <pd.Series> Allele strings, e.g. the ref or alt column of a model.
+
+    :return: <Tuple[np.ndarray, np.ndarray]> The uint8 code of each allele and a
+                                             boolean mask flagging the alleles that
+                                             are not a single character and thus
+                                             could not be encoded.
+    """
+    values = alleles.fillna("").astype(str)
+    irregular = (values.str.len() != 1).to_numpy()
+    codes = np.asarray(values, dtype="S1").view(np.uint8)
+    return codes, irregular
+
+
+def encode_genotypes(genotypes: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encode diploid (or haploid) genotype strings as pairs of uint8 codes.
+
+    :param genotypes: <pd.Series> Genotype strings, e.g. 'AG', '--' or 'A'.
+
+    :return: <Tuple[np.ndarray, np.ndarray]> A (n, 2) uint8 array with the code of
+                                             each allele (0 when absent) and a boolean
+                                             mask flagging the genotypes with more
+                                             than two characters.
+    """
+    if isinstance(genotypes.dtype, pd.CategoricalDtype):
+        # Encode each category once and look the codes up, missing values (-1)
+        # fall on the extra all-zero row
+        codes, irregular = encode_genotypes(pd.Series(genotypes.cat.categories))
+        codes = np.vstack([codes, np.zeros((1, 2), dtype=np.uint8)])
+        irregular = np.append(irregular, False)
+        return codes[genotypes.cat.codes], irregular[genotypes.cat.codes]
+    values = genotypes.fillna("").astype(str)
+    irregular = (values.str.len() > 2).to_numpy()
+    codes = np.asarray(values, dtype="S2").view(np.uint8).reshape(-1, 2)
+    return codes, irregular
+
+
+def encode_rsids(rsids: Iterable[str]) -> np.ndarray:
+    """
+    Encode rsids such as 'rs123' as int64 integers (123).
+
+    :param rsids: <Iterable[str]> SNP ids.
+
+    :return: <np.ndarray> int64 code of each id, NOT_RSID for the ids that are not
+                          of the form 'rs' followed by digits.
+    """
+    # One extra byte tells apart the ids longer than RSID_WIDTH, which are truncated
+    values = np.asarray(rsids, dtype=f"S{RSID_WIDTH + 1}")
+    chars = values.view(np.uint8).reshape(-1, RSID_WIDTH + 1)
+    width = int(np.max(np.flatnonzero(chars.any(axis=0)), initial=0)) + 1
+    # Work column by column on a transposed copy so that each column is contiguous
+    chars = np.ascontiguousarray(chars[:, :width].T)
+    if width < 3:
+        return np.full(len(values), NOT_RSID, dtype=np.int64)
+    valid = chars[0] == ord("r")
+    valid &= (chars[1] == ord("s")) & (chars[2] >= ord("1")) & (chars[2] <= ord("9"))
+    if width > RSID_WIDTH:
+        valid &= chars[RSID_WIDTH] == 0
+
+    # Parse the digits column by column, they must be followed only by padding
+    codes: np.ndarray = np.zeros(len(values), dtype=np.int64)
+    ended: np.ndarray = np.zeros(len(values), dtype=bool)
+    for column in chars[2:RSID_WIDTH]:
+        digit = column - ord("0")
+        is_digit = digit < 10
+        is_padding = column == 0
+        valid &= (is_digit & ~ended) | is_padding
+        ended |= is_padding
+        np.multiply(codes, 10, out=codes, where=is_digit)
+        np.add(codes, digit, out=codes, where=is_digit)
+    codes[~valid] = NOT_RSID
+    return codes
+
+
+class RsidIndex:
+    """
+    Lookup table from SNP id to model row. rsids are stored as sorted int64 codes
+    and looked up with a binary search, ids that are not rsids are kept apart in a
+    (small) sorted table of strings.
+    """
+
+    def __init__(
+        self,
+        codes: np.ndarray,
+        code_rows: np.ndarray,
+        other_ids: np.ndarray,
+        other_rows: np.ndarray,
+    ):
+        """
+        :param codes: <np.ndarray> Sorted int64 codes of the rsids.
+        :param code_rows: <np.ndarray> Model row of each code.
+        :param other_ids: <np.ndarray> Sorted fixed-width bytes of the other ids.
+        :param other_rows: <np.ndarray> Model row of each other id.
+        """
+        self.codes = codes
+        self.code_rows = code_rows
+        self.other_ids = other_ids
+        self.other_rows = other_rows
+        self._other_index: Optional[pd.Index] = None
+
+    def __len__(self) -> int:
+        return len(self.codes) + len(self.other_ids)
+
+    @classmethod
+    def build(cls, rsids: Iterable[str]) -> "RsidIndex":
+        """
+        Build the index of a sequence of unique ids, the row of each id being its
+        position in the sequence.
+        """
+        ids = np.asarray(rsids, dtype=str)
+        codes = encode_rsids(ids)
+        is_rsid = codes != NOT_RSID
+        rows = np.flatnonzero(is_rsid)
+        order = np.argsort(codes[rows], kind="stable")
+        other_rows = np.flatnonzero(~is_rsid)
+        other_ids = ids[other_rows]
+        other_order = np.argsort(other_ids, kind="stable")
+        width = max((len(rsid) for rsid in other_ids), default=1)
+        return cls(
+            codes[rows][order],
+            rows[order],
+            other_ids[other_order].astype(f"S{width}"),
+            other_rows[other_order],
+        )
+
+    def get_indexer(self, rsids: Iterable[str]) -> np.ndarray:
+        """
+        Find the model row of each id.
+
+        :param rsids: <Iterable[str]> SNP ids to look up.
+
+        :return: <np.ndarray> int64 model row of each id, -1 when it is not in the
+                              model.
+        """
+        ids = np.asarray(rsids, dtype=object)
+        codes = encode_rsids(ids)
+        rows: np.ndarray = np.full(len(codes), -1, dtype=np.int64)
+        if len(self.codes):
+            # Searching the codes in sorted order keeps the binary searches local
+            order = np.argsort(codes)
+            positions: np.ndarray = np.empty(len(codes), dtype=np.int64)
+            positions[order] = np.searchsorted(self.codes, codes[order])
+            positions = np.minimum(positions, len(self.codes) - 1)
+            found = (self.codes[positions] == codes) & (codes != NOT_RSID)
+            rows[found] = self.code_rows[positions[found]]
+        others = np.flatnonzero(codes == NOT_RSID)
+        if len(others) and len(self.other_ids):
+            if self._other_index is None:
+                self._other_index = pd.Index(self.other_ids.astype(str))
+            positions = self._other_index.get_indexer(ids[others])
+            found = positions >= 0
+            rows[others[found]] = self.other_rows[positions[found]]
+        return rows
+
+
+class GenotypeMatrix(NamedTuple):
+    """
+    Genotypes of several samples aligned to the rows of an admixture model.
+
+    sample_ids: <List[str]> Id of each sample.
+    rows: <np.ndarray> (n_snps,) Sorted, unique model row of each SNP.
+    dosages: <np.ndarray> (n_samples, n_snps) int8 count of the model alternate
+                          allele in each sample, -1 where the SNP is missing.
+    """
+
+    sample_ids: List[str]
+    rows: np.ndarray
+    dosages: np.ndarray
+
+    def take(self, samples: Sequence[int]) -> "GenotypeMatrix":
+        """
+        Select some of the samples, dropping the SNPs none of them has.
+        """
+        dosages = self.dosages[list(samples)]
+        observed = np.any(dosages >= 0, axis=0)
+        return GenotypeMatrix(
+            [self.sample_ids[i] for i in samples],
+            self.rows[observed],
+            dosages[:, observed],
+        )
+
+
+def concat_genotypes(matrices: Sequence[GenotypeMatrix]) -> GenotypeMatrix:
+    """
+    Stack the samples of several genotype matrices over the union of their SNPs.
+
+    :param matrices: <Sequence[GenotypeMatrix]> Matrices aligned to the same model.
+
+    :return: <GenotypeMatrix> Matrix with the samples of all of them.
+    """
+    if len(matrices) == 1:
+        return matrices[0]
+    rows = np.unique(
+        np.concatenate([matrix.rows for matrix in matrices] + [np.zeros(0, int)]),
+    )
+    n_samples = sum(len(matrix.sample_ids) for matrix in matrices)
+    dosages: np.ndarray = np.full((n_samples, len(rows)), -1, dtype=np.int8)
+    sample_ids: List[str] = []
+    for matrix in matrices:
+        columns = np.searchsorted(rows, matrix.rows)
+        start = len(sample_ids)
+        dosages[start : start + len(matrix.sample_ids), columns] = matrix.dosages
+        sample_ids.extend(matrix.sample_ids)
+    return GenotypeMatrix(sample_ids, rows, dosages)
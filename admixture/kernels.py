@@ -0,0 +1,144 @@
+"""Compiled likelihood kernels, used when Numba is installed"""
+
+# Imports: standard library
+import os
+import threading
+import importlib.util
+from typing import Tuple, Callable, Optional
+
+# Imports: third party
+import numpy as np
+
+NUMBA_AVAILABLE = importlib.util.find_spec("numba") is not None
+# Environment variable that disables the compiled kernels when set to 0
+KERNELS_VARIABLE = "ADMIXTURE_NUMBA"
+# Minimum number of SNPs of each thread of the compiled score
+MIN_CHUNK_SNPS = 4096
+# Below this many SNPs, a single thread computes the score faster with NumPy, whose
+# logs are vectorized, than with the compiled loop, whose logs are not
+MIN_SERIAL_SNPS = 2**18
+
+_KERNELS: Optional[Tuple[Callable, Callable]] = None
+_COMPILE_LOCK = threading.Lock()
+# The default threading layer of Numba aborts when parallel kernels are launched
+# from several threads at once, e.g. by the server, so launches are serialized
+_LAUNCH_LOCK = threading.Lock()
+
+
+def kernels_enabled() -> bool:
+    """
+    Whether the compiled kernels are used: Numba is installed and they were not
+    disabled with ADMIXTURE_NUMBA=0.
+    """
+    return NUMBA_AVAILABLE and os.environ.get(KERNELS_VARIABLE, "1") != "0"
+
+
+def _threads() -> int:
+    # Default number of threads of Numba, known without importing it
+    return int(os.environ.get("NUMBA_NUM_THREADS", 0)) or os.cpu_count() or 1
+
+
+def _compile() -> Tuple[Callable, Callable]:
+    # Numba takes about as long to import as scipy.optimize, so it is only imported
+    # once a kernel is used. The kernels are compiled on first use for the types
+    # they are called with, then read from the on-disk cache of Numba.
+    import numba  # isort: skip
+
+    @numba.njit(cache=True, nogil=True)
+    def score_snps(frequencies, mutations, admixture, floor, start, stop, sums):
+        n_pops = frequencies.shape[1]
+        total = admixture.sum()
+        score = 0.0
+        weights = 0.0
+        for i in range(start, stop):
+            alt = 0.0
+            for k in range(n_pops):
+                alt += frequencies[i, k] * admixture[k]
+            ref = max(total - alt, floor)
+            alt = max(alt, floor)
+            mutated = mutations[i]
+            not_mutated = 2 - mutated
+            # alt^m ref^(2 - m) is the product of two of the probabilities, so a
+            # single log and a single division are needed per SNP
+            first = alt if mutated >= 1 else ref
+            second = alt if mutated >= 2 else ref
+            score -= np.log(first * second)
+            inverse = 1 / (alt * ref)
+            weight = not_mutated * alt * inverse
+            weights += weight
+            slope = weight - mutated * ref * inverse
+            for k in range(n_pops):
+                sums[k] += slope * frequencies[i, k]
+        sums[n_pops] += score
+        sums[n_pops + 1] += weights
+
+    @numba.njit(parallel=True, cache=True, nogil=True)
+    def score_parallel(frequencies, mutations, admixture, floor, n_chunks):
+        n_snps, n_pops = frequencies.shape
+        # Each chunk of SNPs sums into its own row, then the rows are added in a
+        # fixed order, so the result does not depend on the scheduling
+        partial = np.zeros((n_chunks, n_pops + 2))
+        for chunk in numba.prange(n_chunks):
+            score_snps(
+                frequencies,
+                mutations,
+                admixture,
+                floor,
+                chunk * n_snps // n_chunks,
+                (chunk + 1) * n_snps // n_chunks,
+                partial[chunk],
+            )
+        return partial.sum(axis=0)
+
+    return score_snps, score_parallel
+
+
+def _launch_score(
+    frequencies: np.ndarray,
+    mutations: np.ndarray,
+    admixture: np.ndarray,
+    floor: float,
+) -> Tuple[float, np.ndarray]:
+    global _KERNELS  # pylint: disable=global-statement
+    with _COMPILE_LOCK:
+        if _KERNELS is None:
+            _KERNELS = _compile()
+    score_snps, score_parallel = _KERNELS
+
+    n_snps, n_pops = frequencies.shape
+    admixture = np.ascontiguousarray(admixture, dtype=np.float64)
+    n_chunks = min(_threads(), n_snps // MIN_CHUNK_SNPS)
+    if n_chunks > 1:
+        with _LAUNCH_LOCK:
+            sums = score_parallel(frequencies, mutations, admixture, floor, n_chunks)
+    else:
+        # Without threads to spread the SNPs over, the serial loop saves the
+        # overhead of the parallel launch
+        sums = np.zeros(n_pops + 2)
+        score_snps(frequencies, mutations, admixture, floor, 0, n_snps, sums)
+    # The weights of the reference alleles are subtracted from every population
+    return sums[n_pops], sums[:n_pops] - sums[n_pops + 1]
+
+
+def score_kernel(n_snps: int) -> Optional[Callable[..., Tuple[float, np.ndarray]]]:
+    """
+    Return the compiled score of score_admixture, which fuses the product with the
+    frequencies, the logs and the gradient in a single parallel loop over the SNPs
+    without temporary arrays, if it is faster than NumPy for that many SNPs: when
+    they can be split over several threads, or when they are so many that the
+    temporary arrays of NumPy no longer fit in the CPU cache. The kernel takes the
+    (n_snps, n_pops) frequencies, the integer count of mutated alleles of each SNP,
+    from 0 to 2, the admixture proportion and the smallest probability of an allele,
+    below which the probabilities are floored, and returns the negative
+    log-likelihood and its gradient, computed in float64 whatever the type of the
+    frequencies.
+
+    :param n_snps: <int> Number of SNPs the kernel will be called with.
+
+    :return: <Callable> The kernel, or None when the kernels are not enabled or are
+                        slower, in which case the NumPy implementation is used.
+    """
+    if not kernels_enabled():
+        return None
+    parallel = _threads() > 1 and n_snps >= 2 * MIN_CHUNK_SNPS
+    return _launch_score if parallel or n_snps >= MIN_SERIAL_SNPS else None
@@ -1,90 +1,343 @@
 # Imports: standard library
 import os
-from typing import Dict, List, Optional
+import gzip
+from typing import IO, Dict, List, Tuple, Union, Iterable, Iterator, Optional
 
 # Imports: third party
+import numpy as np
 import pandas as pd
 
+# Imports: first party
+import metrics
+from bundle import ModelBundle
+from encoding import RsidIndex, GenotypeMatrix, encode_alleles
+from registry import ModelRegistry
 
-def load_model(model: str) -> pd.DataFrame:
+
+def model_path(model: str, model_dirs: Optional[List[str]] = None) -> str:
+    """
+    Path to the file of a model.
+
+    :param model: <str> Name of a model of the registry, e.g. K7b, or the path to a
+                        model text file.
+    :param model_dirs: <List[str]> Folders of user-defined models, searched before
+                                   the default ones. Default: None.
+
+    :return: <str> Path to the whitespace-delimited model file, or to its compiled
+                   bundle when there is no text file.
+    """
+    return ModelRegistry(model_dirs).spec(model).path
+
+
+def load_model(model: str, model_dirs: Optional[List[str]] = None) -> ModelBundle:
     """
     Loads the model file with the frequencies and the mutations
-    at each SNP.
-
-    :param model: <str> Name of the model. Choices: 1000Genomes_superpopulation,
-                         1000Genomes_pop.txt, K1000Genomes_chr21_population, 7b.
-
-    :returns: <pd.DataFrame> Pandas Dataframe with the frequencies,
-                             the mutations and the rsid for each SNP.
-    """
-    if model == "1000Genomes_superpopulation":
-        model_name = "1000Genomes_superpop.txt"
-    elif model == "1000Genomes_population":
-        model_name = "1000Genomes_pop.txt"
-    elif model == "1000Genomes_chr21_population":
-        model_name = "1000Genomes_chr21_pop.txt"
-    elif model == "K7b":
-        model_name = "K7b.txt"
-    else:
-        raise ValueError(
-            f"Unknown model {model}. Expected 1000Genomes_superpopulation,"
-            "1000Genomes_population or K7b",
+    at each SNP. The model text file is compiled into a binary bundle the first
+    time it is used (or whenever it changes) and the bundle is memory-mapped
+    afterwards, so no parsing happens and processes share the frequencies.
+
+    :param model: <str> Name of a model of the registry, e.g. K7b, or the path to a
+                        model file.
+    :param model_dirs: <List[str]> Folders of user-defined models, searched before
+                                   the default ones. Default: None.
+
+    :returns: <ModelBundle> Model with the frequencies, the mutations and the rsid
+                            for each SNP.
+    """
+    return ModelRegistry(model_dirs).load(model)
+
+
+def model_fingerprint(
+    model: str,
+    model_dirs: Optional[List[str]] = None,
+) -> Optional[str]:
+    """
+    Fingerprint of a model read from its compiled bundle without loading it.
+
+    :param model: <str> Name or path of the model.
+    :param model_dirs: <List[str]> Folders of user-defined models, searched before
+                                   the default ones. Default: None.
+
+    :return: <str> The fingerprint, the same as the one of the loaded model, or None
+                   if the model has not been compiled yet.
+    """
+    return ModelRegistry(model_dirs).spec(model).fingerprint()
+
+
+def _read_genotype_file(
+    file_path: str,
+    genotype_columns: List[int],
+    rsids: Optional[Iterable[str]] = None,
+    chunk_size: int = 100000,
+) -> pd.DataFrame:
+    """
+    Read the rsid and genotype columns of a tab-separated genotyping file in chunks
+    of lines, keeping only the SNPs in rsids so that memory is bounded by the
+    overlap with the model rather than by the file size. When the alleles are in
+    separate columns they are joined into a single genotype string. A file without
+    any genotype line raises a ValueError naming it.
+    """
+    index: Optional[Union[pd.Index, RsidIndex]] = None
+    if isinstance(rsids, (pd.Index, RsidIndex)):
+        index = rsids
+    elif rsids is not None:
+        index = RsidIndex.build(pd.unique(np.asarray(rsids, dtype=object)))
+    chunks = []
+    try:
+        reader = pd.read_csv(
+            file_path,
+            sep="\t",
+            comment="#",
+            header=None,
+            usecols=[0] + genotype_columns,
+            dtype=str,
+            na_filter=False,
+            on_bad_lines="warn",
+            chunksize=chunk_size,
         )
-    model_path = os.path.dirname(os.path.realpath(__file__)) + "/models"
-    model_df = pd.read_csv(
-        os.path.join(model_path, model_name),
-        delim_whitespace=True,
-    )
-    if model == "1000Genomes_chr21_population":
-        model_df = model_df[["rsid", "ref", "alt", "ASW", "CEU", "GWD", "PEL", "PUR"]]
-    return model_df
+    except pd.errors.EmptyDataError:
+        reader = []
+    for chunk in reader:
+        metrics.count("snps_read", len(chunk))
+        if index is not None:
+            chunk = chunk[index.get_indexer(chunk[0]) >= 0]
+        metrics.count("snps_kept", len(chunk))
+        genotype = chunk[genotype_columns[0]]
+        for column in genotype_columns[1:]:
+            genotype = genotype + chunk[column]
+        chunks.append(pd.DataFrame({"rsid": chunk[0], "genotype": genotype}))
+    if not chunks:
+        raise ValueError(f"No genotypes found in {file_path}.")
+    df = pd.concat(chunks, ignore_index=True)
+    df["genotype"] = df["genotype"].astype("category")
+    return df
+
+
+def file_sample_id(file_path: str) -> str:
+    """
+    Id of the sample of a single sample genotyping file: its file name.
+    """
+    return os.path.split(file_path)[-1]
 
 
-def twenty_three(file_path: str) -> Dict[str, pd.DataFrame]:
+def twenty_three(
+    file_path: str,
+    rsids: Optional[Iterable[str]] = None,
+) -> Dict[str, pd.DataFrame]:
     """
     Loads and parses a 23andMe genotype file.
 
     :param file_path: <str> Full path to the 23andMe file.
+    :param rsids: <Iterable[str]> If provided, e.g. the index of the model to use,
+                                  just these SNPs will be kept. Default: None.
 
     :return: <Dict[str, pd.DataFrame]> Pandas dataframe with the rsid and the genotype
                             for each SNP. Key is the file name.
     """
-    df = pd.read_csv(file_path, sep="\t", comment="#", header=None, low_memory=False)
-    df = df[[0, 3]]
-    df.columns = ["rsid", "genotype"]
-    return {os.path.split(file_path)[-1]: df}
+    df = _read_genotype_file(file_path, [3], rsids)
+    return {file_sample_id(file_path): df}
 
 
-def ancestry(file_path: str) -> Dict[str, pd.DataFrame]:
+def ancestry(
+    file_path: str,
+    rsids: Optional[Iterable[str]] = None,
+) -> Dict[str, pd.DataFrame]:
     """
-    Loads and parses an AncestryDNA genotype file.
+    Loads and parses an AncestryDNA genotype file, whose columns are the rsid, the
+    chromosome, the position and the two alleles.
 
     :param file_path: <str> Full path to the AncestryDNA file.
+    :param rsids: <Iterable[str]> If provided, e.g. the index of the model to use,
+                                  just these SNPs will be kept. Default: None.
 
     :return: <Dict[str, pd.DataFrame]> Pandas dataframe with the rsid and the genotype
                             for each SNP. Key is the file name.
     """
-    df = pd.read_csv(file_path, sep="\t", comment="#", header=None, low_memory=False)
-    df = df[[0, 4]]
-    df.columns = ["rsid", "genotype"]
-    return {os.path.split(file_path)[-1]: df}
+    df = _read_genotype_file(file_path, [3, 4], rsids)
+    return {file_sample_id(file_path): df}
 
 
-def _convert_genotypes(ref, alt, genotypes):
-    genotype_map = {"0": ref, "1": alt, ".": "N"}
-    # Convert genotype strings using the map
-    mapped_genotypes = genotypes.apply(
-        lambda genotype: "".join(
-            genotype_map.get(allele, "N")
-            for allele in genotype.replace("|", "/").split("/")
-        ),
+# Allele index of a decoded GT field: 0 for the reference, 1 for the alternate,
+# MISSING_ALLELE for "." (or any other allele) and ABSENT_ALLELE for the second
+# allele of a haploid call.
+MISSING_ALLELE = -1
+ABSENT_ALLELE = -2
+
+
+def _open_text(file_path: str) -> IO[str]:
+    """
+    Open a text file, transparently decompressing it if it is gzip or bgzip
+    compressed.
+    """
+    with open(file_path, "rb") as file:
+        magic = file.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(file_path, "rt", encoding="utf-8")
+    return open(file_path, "r", encoding="utf-8")
+
+
+def _read_vcf_header(file: IO[str]) -> List[str]:
+    """
+    Skip the meta-information lines of a vcf file and return the columns of its
+    header line, leaving the file positioned at the first record.
+    """
+    for line in file:
+        if line.startswith("#CHROM"):
+            return line[1:].rstrip("\r\n").split("\t")
+        if not line.startswith("##"):
+            break
+    raise ValueError("Missing #CHROM header line in vcf file.")
+
+
+def vcf_sample_ids(file_path: str) -> List[str]:
+    """
+    Ids of the samples of a vcf file, read from its header line.
+    """
+    with _open_text(file_path) as file:
+        return _read_vcf_header(file)[9:]
+
+
+def _allele_index(codes: np.ndarray) -> np.ndarray:
+    index = np.full(codes.shape, MISSING_ALLELE, dtype=np.int8)
+    index[codes == ord("0")] = 0
+    index[codes == ord("1")] = 1
+    return index
+
+
+def _decode_gt(fields: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Decode the GT subfield of biallelic vcf genotype fields, e.g. '0|1:35,2' or '1',
+    as the allele index of the first and second alleles.
+
+    :param fields: <np.ndarray> Genotype fields as strings, any shape.
+
+    :return: <Tuple[np.ndarray, np.ndarray]> int8 allele index of each allele.
+    """
+    # GT is always the first subfield and has 3 characters for diploid calls of
+    # biallelic SNPs, so the first 3 bytes of each field are enough
+    codes = np.asarray(fields, dtype="S3").view(np.uint8).reshape(fields.shape + (3,))
+    first = _allele_index(codes[..., 0])
+    diploid = (codes[..., 1] == ord("/")) | (codes[..., 1] == ord("|"))
+    second = np.where(diploid, _allele_index(codes[..., 2]), ABSENT_ALLELE)
+    return first, second.astype(np.int8)
+
+
+def iter_vcf(
+    file_path: str,
+    ids: Optional[Iterable[str]] = None,
+    model: Optional[ModelBundle] = None,
+    chunk_size: int = 10000,
+) -> Iterator[Tuple[List[str], pd.DataFrame, np.ndarray, np.ndarray]]:
+    """
+    Stream the biallelic SNPs of a vcf file in chunks of records. Records with
+    multi-character or multiple alternate alleles are skipped.
+
+    :param file_path: <str> Full path to the vcf file, optionally gzip compressed.
+    :param ids: <Iterable[str]> If provided, just the ids provided will be parsed.
+    :param model: <ModelBundle> If provided, just the SNPs of the model are kept and
+                                their model row is added as the 'row' column.
+    :param chunk_size: <int> Number of records parsed at once.
+
+    :return: <Iterator> For each chunk, the sample ids, a DataFrame with the rsid,
+                        ref and alt of each SNP and the (n_snps, n_samples) allele
+                        indexes of the first and second alleles.
+    """
+    with _open_text(file_path) as file:
+        columns = _read_vcf_header(file)
+        sample_columns = columns[9:]
+        if ids is not None:
+            ids = set(ids)
+            sample_columns = [id for id in sample_columns if id in ids]
+        reader = pd.read_csv(
+            file,
+            sep="\t",
+            header=None,
+            names=columns,
+            usecols=["ID", "REF", "ALT"] + sample_columns,
+            dtype=str,
+            na_filter=False,
+            chunksize=chunk_size,
+        )
+        for chunk in reader:
+            metrics.count("snps_read", len(chunk))
+            snv = (chunk["REF"].str.len() == 1) & (chunk["ALT"].str.len() == 1)
+            keep = snv.to_numpy().copy()
+            variants = pd.DataFrame(
+                {
+                    "rsid": chunk["ID"].to_numpy(),
+                    "ref": chunk["REF"].to_numpy(),
+                    "alt": chunk["ALT"].to_numpy(),
+                },
+            )
+            if model is not None:
+                rows = model.index.get_indexer(variants["rsid"])
+                variants["row"] = rows
+                keep &= rows >= 0
+            variants = variants[keep].reset_index(drop=True)
+            metrics.count("snps_kept", len(variants))
+            first, second = _decode_gt(chunk[sample_columns].to_numpy()[keep])
+            yield sample_columns, variants, first, second
+
+
+def vcf_genotypes(
+    file_path: str,
+    model: ModelBundle,
+    ids: Optional[Iterable[str]] = None,
+    chunk_size: int = 10000,
+) -> GenotypeMatrix:
+    """
+    Stream a vcf file, possibly gzip or bgzip compressed, and align its genotypes to
+    a model. Records are parsed in chunks and only the SNPs of the model are kept,
+    so memory is bounded by the model size instead of the file size.
+
+    :param file_path: <str> Full path to the vcf file.
+    :param model: <ModelBundle> Admixture model.
+    :param ids: <Iterable[str]> If provided, just the ids provided will be parsed.
+                                Default: None.
+    :param chunk_size: <int> Number of records parsed at once. Default: 10000.
+
+    :return: <GenotypeMatrix> Count of the model alternate allele of each sample at
+                              each SNP of the model found in the file.
+    """
+    sample_ids: List[str] = []
+    rows, dosages = [], []
+    for sample_ids, variants, first, second in iter_vcf(
+        file_path,
+        ids,
+        model,
+        chunk_size,
+    ):
+        chunk_rows = variants["row"].to_numpy()
+        ref, _ = encode_alleles(variants["ref"])
+        alt, _ = encode_alleles(variants["alt"])
+        model_ref = model.ref[chunk_rows][:, None]
+        model_alt = model.alt[chunk_rows][:, None]
+
+        # Translate the allele indexes to bases and count them the same way the
+        # genotype strings of the other formats are counted
+        mutations = np.zeros(first.shape, dtype=np.int8)
+        valid = np.zeros(first.shape, dtype=bool)
+        for allele in (first, second):
+            bases = np.where(allele == 0, ref[:, None], 0)
+            bases = np.where(allele == 1, alt[:, None], bases)
+            mutations += bases == model_alt
+            valid |= (bases == model_alt) | (bases == model_ref)
+        rows.append(chunk_rows)
+        dosages.append(np.where(valid, mutations, -1).astype(np.int8))
+
+    all_rows = np.concatenate(rows + [np.zeros(0, int)])
+    all_rows, index = np.unique(all_rows, return_index=True)
+    all_dosages = np.concatenate(dosages + [np.zeros((0, len(sample_ids)), np.int8)])
+    return GenotypeMatrix(
+        sample_ids,
+        all_rows,
+        np.ascontiguousarray(all_dosages[index].T),
     )
-    return mapped_genotypes
 
 
 def vcf(file_path: str, ids: Optional[List[str]] = None) -> Dict[str, pd.DataFrame]:
     """
-    Loads and parses a vcf file.
+    Loads and parses a vcf file, possibly gzip or bgzip compressed.
 
     :param file_path: <str> Full path to the vcf file.
     :param ids: <List[str]> If provided, just the ids provided will be parsed.
@@ -94,37 +347,25 @@ def vcf(file_path: str, ids: Optional[List[str]] = None) -> Dict[str, pd.DataFra
                                        a Pandas dataframe with the rsid and the genotype
                                        for each SNP of the sample id.
     """
-    vcf_data = pd.read_csv(file_path, sep="\t", skiprows=5, header=None, comment="#")
-    with open(file_path, "r", encoding="utf-8") as file:
-        for line in file:
-            if line.startswith("#CHROM"):
-                line = line[1:]
-                if line.endswith("\n"):
-                    line = line[:-2]
-                columns = line.split("\t")
-    sample_columns = columns[9:]
-    if ids is not None:
-        sample_columns = [id for id in sample_columns if id in ids]
-    sample_data: Dict[str, pd.DataFrame] = {sample: [] for sample in sample_columns}
-
-    # Correct header processing
-    vcf_data.columns = columns
-
-    for _, row in vcf_data.iterrows():
-        rsid = row["ID"]
-        ref, alt = row["REF"], row["ALT"]
-        genotypes = row[sample_columns]
-        # Use _convert_genotypes function
-        converted_genotypes = _convert_genotypes(ref, alt, genotypes)
-
-        # Accumulate data in a list of dicts for DataFrame conversion
-        for sample in sample_columns:
-            sample_data[sample].append(
-                {"rsid": rsid, "genotype": converted_genotypes[sample]},
-            )
+    sample_columns: List[str] = []
+    rsids, genotypes = [], []
+    for sample_columns, variants, first, second in iter_vcf(file_path, ids):
+        ref, _ = encode_alleles(variants["ref"])
+        alt, _ = encode_alleles(variants["alt"])
+        alleles = []
+        for allele in (first, second):
+            bases = np.where(allele == 0, ref[:, None], ord("N"))
+            bases = np.where(allele == 1, alt[:, None], bases)
+            alleles.append(np.where(allele == ABSENT_ALLELE, 0, bases))
+        codes = np.ascontiguousarray(np.stack(alleles, axis=-1).astype(np.uint8))
+        rsids.append(variants["rsid"].to_numpy())
+        genotypes.append(codes.view("S2")[..., 0].astype(str))
 
-    # Convert each list of dicts to a DataFrame
-    for sample in sample_columns:
-        sample_data[sample] = pd.DataFrame(sample_data[sample])
-
-    return sample_data
+    all_rsids = np.concatenate(rsids + [np.zeros(0, str)])
+    all_genotypes = np.concatenate(
+        genotypes + [np.zeros((0, len(sample_columns)), str)]
+    )
+    return {
+        sample: pd.DataFrame({"rsid": all_rsids, "genotype": all_genotypes[:, i]})
+        for i, sample in enumerate(sample_columns)
+    }
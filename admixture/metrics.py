@@ -0,0 +1,153 @@
+"""Per-stage and per-sample run metrics"""
+
+# Imports: standard library
+import os
+import csv
+import sys
+import json
+import time
+from typing import Any, Dict, List, Iterator
+from contextlib import contextmanager
+
+try:
+    import resource  # isort: skip
+except ImportError:  # Windows
+    resource = None  # type: ignore
+
+METRICS_JSON = "metrics.json"
+METRICS_CSV = "metrics.csv"
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process and of its finished child processes, in
+    MB, or NaN where it can not be measured.
+    """
+    if resource is None:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class Recorder:
+    """
+    Collects the wall time, peak RSS and counts of each stage of a run, such as the
+    SNPs read from a file, and values of each sample, such as the solver iterations.
+    A disabled recorder keeps nothing, so that long-running processes do not grow.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.stages: List[Dict[str, Any]] = []
+        self.samples: Dict[str, Dict[str, Any]] = {}
+        self._active: List[Dict[str, Any]] = []
+
+    @contextmanager
+    def stage(self, name: str, **labels) -> Iterator[Dict[str, Any]]:
+        """
+        Time a stage. Counts added while it runs, with count or through the yielded
+        dictionary, are recorded with it.
+
+        :param name: <str> Name of the stage, e.g. 'solve'.
+        :param labels: Values identifying the stage, e.g. the file it processes.
+        """
+        counts: Dict[str, Any] = {}
+        record = {"stage": name, **labels, "counts": counts}
+        self._active.append(record)
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            record["wall_time_s"] = time.perf_counter() - start
+            record["peak_rss_mb"] = peak_rss_mb()
+            self._active.remove(record)
+            if self.enabled:
+                self.stages.append(record)
+
+    def count(self, name: str, value: float):
+        """
+        Add to a count of the innermost running stage.
+        """
+        if self._active:
+            counts = self._active[-1]["counts"]
+            counts[name] = counts.get(name, 0) + value
+
+    def sample(self, sample_id: str, **values):
+        """
+        Record values of a sample, e.g. its number of SNPs in the model.
+        """
+        if self.enabled:
+            self.samples.setdefault(sample_id, {}).update(values)
+
+    def merge(self, records: Dict[str, Any]):
+        """
+        Add the records of another recorder, e.g. of a worker process.
+        """
+        if self.enabled:
+            self.stages.extend(records["stages"])
+            for sample_id, values in records["samples"].items():
+                self.sample(sample_id, **values)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"stages": self.stages, "samples": self.samples}
+
+    def write(self, output_dir: str):
+        """
+        Write the records as metrics.json and as metrics.csv, with one row per
+        stage and per sample.
+
+        :param output_dir: <str> Folder where to save the files.
+        """
+        with open(
+            os.path.join(output_dir, METRICS_JSON), "w", encoding="utf-8"
+        ) as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+        rows = []
+        for record in self.stages:
+            row = {"kind": "stage", **record, **record["counts"]}
+            del row["counts"]
+            rows.append(row)
+        for sample_id, values in self.samples.items():
+            rows.append({"kind": "sample", "sample": sample_id, **values})
+        columns = list(dict.fromkeys(column for row in rows for column in row))
+        with open(
+            os.path.join(output_dir, METRICS_CSV),
+            "w",
+            encoding="utf-8",
+            newline="",
+        ) as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+# Recorder used by the functions below. It is disabled unless a run enables it.
+_RECORDER = Recorder(enabled=False)
+
+
+def enable() -> Recorder:
+    """
+    Start recording the metrics of this process in a new recorder.
+    """
+    global _RECORDER  # pylint: disable=global-statement
+    _RECORDER = Recorder()
+    return _RECORDER
+
+
+def current() -> Recorder:
+    return _RECORDER
+
+
+def stage(name: str, **labels):
+    return _RECORDER.stage(name, **labels)
+
+
+def count(name: str, value: float):
+    _RECORDER.count(name, value)
+
+
+def record_sample(sample_id: str, **values):
+    _RECORDER.sample(sample_id, **values)
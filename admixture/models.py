@@ -1,123 +1,254 @@
+"""Build admixture models from the 1000 Genomes pruned VCF files"""
+
 # Imports: standard library
 import os
-import typing
-from typing import List, Optional
-from collections import Counter
+import argparse
+from typing import Dict, List, Tuple, Optional
+from concurrent.futures import ProcessPoolExecutor
 
 # Imports: third party
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-# pylint: disable=too-many-branches
+# Imports: first party
+from bundle import ModelBundle, bundle_path, write_bundle
+from loader import iter_vcf, vcf_sample_ids
+
+# Output model name and igsr_samples.tsv column used to group the samples
+DEFAULT_GROUPINGS = {
+    "1000Genomes_superpop": "Superpopulation code",
+    "1000Genomes_pop": "Population code",
+}
+SAMPLES_FILE = "igsr_samples.tsv"
+VCF_FILE = "1000G_chr{chrom}_pruned.vcf"
+
+
+def _sample_labels(
+    samples_path: str,
+    sample_ids: List[str],
+    groupings: Dict[str, str],
+) -> Tuple[pd.DataFrame, Dict[str, List[str]]]:
+    """
+    Assign each sample of the VCF files to a group of every grouping. The groups of a
+    grouping are the values of its column for the samples in the VCF files, in order
+    of first appearance in the samples file.
+
+    :param samples_path: <str> Path to the igsr_samples.tsv file.
+    :param sample_ids: <List[str]> Samples in the VCF files.
+    :param groupings: <Dict[str, str]> Column of the samples file of each model.
+
+    :return: <Tuple[pd.DataFrame, Dict[str, List[str]]]> Index of the group of each
+                                                         sample (rows) in each model
+                                                         (columns), -1 if it has
+                                                         none, and the group names
+                                                         of each model.
+    """
+    samples = pd.read_csv(samples_path, sep="\t", dtype=str)
+    samples = samples.drop_duplicates("Sample name").set_index("Sample name")
+    samples = samples.reindex(samples.index[samples.index.isin(sample_ids)])
+    labels = pd.DataFrame(index=pd.Index(sample_ids))
+    groups = {}
+    for name, column in groupings.items():
+        values = samples[column].dropna()
+        groups[name] = list(values.unique())
+        codes = pd.Series(pd.Categorical(values, categories=groups[name]).codes)
+        labels[name] = codes.set_axis(values.index).reindex(labels.index)
+    return labels.fillna(-1).astype(np.int64), groups
+
+
+def _chromosome_frequencies(
+    vcf_path: str,
+    labels: pd.DataFrame,
+    n_groups: Dict[str, int],
+    chunk_size: int = 10000,
+) -> Tuple[pd.DataFrame, Dict[str, np.ndarray]]:
+    """
+    Compute the alternate allele frequency of each group at each biallelic SNP of a
+    VCF file. Genotypes are decoded in blocks of records into a dosage matrix and
+    the allele counts of all the groups are obtained at once by multiplying it by
+    the sample x group indicator matrix. Only diploid calls are counted.
+
+    :param vcf_path: <str> Path to the VCF file.
+    :param labels: <pd.DataFrame> Group index of each sample in each model.
+    :param n_groups: <Dict[str, int]> Number of groups of each model.
+    :param chunk_size: <int> Number of records decoded at once.
+
+    :return: <Tuple[pd.DataFrame, Dict[str, np.ndarray]]> rsid, ref and alt of each
+                                                          SNP and the frequencies of
+                                                          each model.
+    """
+    variants, counts, totals = [], [], []
+    indicators = None
+    for sample_ids, chunk, first, second in iter_vcf(vcf_path, chunk_size=chunk_size):
+        if indicators is None:
+            codes = labels.reindex(sample_ids).fillna(-1).to_numpy(dtype=np.int64)
+            indicators = np.concatenate(
+                [
+                    codes[:, [i]] == np.arange(n_groups[name])
+                    for i, name in enumerate(labels.columns)
+                ],
+                axis=1,
+            ).astype(np.float32)
+        called = (first >= 0) & (second >= 0)
+        dosages = np.where(called, (first == 1).astype(np.int8) + (second == 1), 0)
+        variants.append(chunk)
+        counts.append(dosages.astype(np.float32) @ indicators)
+        totals.append(2 * called.astype(np.float32) @ indicators)
+
+    variants_df = pd.concat(variants, ignore_index=True)
+    n_columns = sum(n_groups.values())
+    count = np.concatenate(counts + [np.zeros((0, n_columns), np.float32)])
+    total = np.concatenate(totals + [np.zeros((0, n_columns), np.float32)])
+    frequencies = np.divide(
+        count,
+        total,
+        out=np.zeros(count.shape),
+        where=total > 0,
+    )
+    bounds = np.cumsum([0] + [n_groups[name] for name in labels.columns])
+    return variants_df, {
+        name: frequencies[:, bounds[i] : bounds[i + 1]]
+        for i, name in enumerate(labels.columns)
+    }
 
 
 def generate_1000genomes_model(
     input_folder: str,
     output_folder: str,
     chromosomes: Optional[List[int]] = None,
+    groupings: Optional[Dict[str, str]] = None,
+    jobs: Optional[int] = None,
+    write_text: bool = True,
 ):
     """
     Given the 1000 Geneomes pruned VCF files, generate an admixture model.
     The input folder should contain the 'igsr_samples.tsv' with the population and
     superpopulation of each sample and one vcf file per chromosome with the following
-    naming convention '1000G_chr{chrom}_pruned.vcf'. An admixture model for the 1000G
-    populations ('1000Genomes_pop.txt') and another one for the superpopulations
-    ('1000Genomes_superpop.txt') will be generated in the ouput_folder.
+    naming convention '1000G_chr{chrom}_pruned.vcf', optionally gzip compressed. By
+    default, an admixture model for the 1000G populations ('1000Genomes_pop') and
+    another one for the superpopulations ('1000Genomes_superpop') will be generated
+    in the ouput_folder, both as a compiled bundle and as a text file.
     The files contain all the rsids, the reference and the alternate alleles, as well
     as the alternate allele frequency for each population for each SNP is provided.
+    Chromosomes are processed in parallel, one per process.
 
     :param input_folder: <str> Path to folder with pruned .vcf files.
     :param output_folder: <str> Path to folder to store resulting models.
     :param chromosomes: <List[str]> List of chromosomes to use to create the model.
                                     If None, all chromosomes will be used. Default: None
+    :param groupings: <Dict[str, str]> Name of each model to generate and the column
+                                       of igsr_samples.tsv used to group the samples.
+                                       Default: DEFAULT_GROUPINGS.
+    :param jobs: <int> Number of processes. Default: one per chromosome, up to the
+                       number of CPUs.
+    :param write_text: <bool> Also write the models as text files. Default: True.
     """
     if chromosomes is None:
         chromosomes = list(range(1, 23))
+    groupings = groupings or DEFAULT_GROUPINGS
+    jobs = jobs or min(len(chromosomes), os.cpu_count() or 1)
 
-    file_name = os.path.join(input_folder, "1000G_chr{chrom}_pruned.vcf")
-    sample_pop_df = pd.read_csv(
-        os.path.join(input_folder, "igsr_samples.tsv"),
-        sep="\t",
+    vcf_paths = []
+    for chrom in chromosomes:
+        vcf_path = os.path.join(input_folder, VCF_FILE.replace("{chrom}", str(chrom)))
+        if not os.path.exists(vcf_path) and os.path.exists(vcf_path + ".gz"):
+            vcf_path += ".gz"
+        vcf_paths.append(vcf_path)
+    sample_ids = vcf_sample_ids(vcf_paths[0])
+    labels, groups = _sample_labels(
+        os.path.join(input_folder, SAMPLES_FILE),
+        sample_ids,
+        groupings,
     )
+    n_groups = {name: len(names) for name, names in groups.items()}
 
-    keys = sample_pop_df["Sample name"]
-    values = sample_pop_df["Population code"]
-    sample_pop = dict(zip(keys, values))
-    pops = values.dropna().unique()[:-1]
+    print(f"Extracting stats for snps in chromosomes {chromosomes}...")
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(
+            tqdm(
+                executor.map(
+                    _chromosome_frequencies,
+                    vcf_paths,
+                    [labels] * len(vcf_paths),
+                    [n_groups] * len(vcf_paths),
+                ),
+                total=len(vcf_paths),
+            ),
+        )
 
-    values = sample_pop_df["Superpopulation code"]
-    sample_superpop = dict(zip(keys, values))
-    superpops = values.dropna().unique()[:-1]
+    alleles = pd.concat([variants for variants, _ in results], ignore_index=True)
+    for name in groupings:
+        frequencies = pd.DataFrame(
+            np.concatenate([frequencies[name] for _, frequencies in results]),
+            columns=groups[name],
+        )
+        df = pd.concat([alleles, frequencies], axis=1)
+        text_path = os.path.join(output_folder, f"{name}.txt")
+        if write_text:
+            df.to_csv(text_path, sep=" ", index=False)
+        # Written after the text file so that it is not considered stale
+        write_bundle(ModelBundle.from_frame(df), bundle_path(text_path))
 
-    alleles = []
-    pop_freq = []
-    superpop_freq = []
 
-    for chrom in chromosomes:
-        print(f"Extracting stats for snps in chromosome {chrom}...")
-        with open(
-            file_name.replace("{chrom}", str(chrom)),
-            "r",
-            encoding="utf-8",
-        ) as file:
-            parse = False
-            for line in tqdm(file):
-                if line.startswith("#CHROM"):
-                    if line.endswith("\n"):
-                        line = line[:-2]
-                    columns = line.split("\t")
-                    parse = True
-                elif parse:
-                    pop_counter: typing.Counter[int] = Counter()
-                    superpop_counter: typing.Counter[int] = Counter()
-                    n_pop_counter: typing.Counter[int] = Counter()
-                    n_superpop_counter: typing.Counter[int] = Counter()
-                    if line.endswith("\n"):
-                        line = line[:-2]
-                    row = line.split("\t")
-                    ref = row[3]
-                    alt = row[4]
-                    if len(ref) > 1 or len(alt) > 1:
-                        continue
-                    alleles.append(row[2:5])
-
-                    for i, subject in enumerate(columns[9:]):
-                        genotype = row[i + 9]
-                        if len(genotype) == 3:
-                            genotype = sum(int(el) for el in genotype.split("|"))
-                            pop_counter[sample_pop[subject]] += genotype
-                            superpop_counter[sample_superpop[subject]] += genotype
-                            n_pop_counter[sample_pop[subject]] += 2
-                            n_superpop_counter[sample_superpop[subject]] += 2
-
-                    row = []
-                    for pop in pops:
-                        if n_pop_counter[pop] == 0:
-                            row.append(0)
-                        else:
-                            row.append(pop_counter[pop] / n_pop_counter[pop])
-                    pop_freq.append(row)
-
-                    row = []
-                    for pop in superpops:
-                        if n_superpop_counter[pop] == 0:
-                            row.append(0)
-                        else:
-                            row.append(superpop_counter[pop] / n_superpop_counter[pop])
-                    superpop_freq.append(row)
-
-    alleles = pd.DataFrame(alleles, columns=["rsid", "ref", "alt"])
-    frequencies = pd.DataFrame(superpop_freq, columns=superpops)
-    df = pd.concat([alleles, frequencies], axis=1)
-    df.to_csv(
-        os.path.join(output_folder, "1000Genomes_superpop.txt"),
-        sep=" ",
-        index=False,
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Generate admixture models from the 1000 Genomes VCF files.",
+    )
+    parser.add_argument(
+        "input_folder",
+        type=str,
+        help="Folder with igsr_samples.tsv and the pruned VCF files.",
+    )
+    parser.add_argument(
+        "output_folder",
+        type=str,
+        help="Folder where to save the models.",
+    )
+    parser.add_argument(
+        "-c",
+        "--chromosomes",
+        nargs="+",
+        type=int,
+        help="Chromosomes to use. Default: 1 to 22.",
     )
-    frequencies = pd.DataFrame(pop_freq, columns=pops)
-    df = pd.concat([alleles, frequencies], axis=1)
-    df.to_csv(
-        os.path.join(output_folder, "1000Genomes_pop.txt"),
-        sep=" ",
-        index=False,
+    parser.add_argument(
+        "-g",
+        "--group",
+        nargs="+",
+        type=str,
+        help="Models to generate as NAME=COLUMN, where COLUMN is the column of "
+        "igsr_samples.tsv used to group the samples. Default: "
+        + " ".join(f"'{name}={column}'" for name, column in DEFAULT_GROUPINGS.items()),
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of processes. Default: one per chromosome, up to the CPUs.",
+    )
+    parser.add_argument(
+        "--no-text",
+        action="store_true",
+        help="Only write the compiled bundles.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    groupings = None
+    if args.group:
+        groupings = dict(group.split("=", 1) for group in args.group)
+    generate_1000genomes_model(
+        args.input_folder,
+        args.output_folder,
+        args.chromosomes,
+        groupings,
+        args.jobs,
+        not args.no_text,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,103 +1,768 @@
 # Imports: standard library
 import logging
-from typing import Dict, Tuple, Callable
+from typing import Dict, Tuple, Union, Callable, Iterator, Optional
 
 # Imports: third party
 import numpy as np
 import pandas as pd
-from scipy.optimize import Bounds, LinearConstraint, minimize
+
+# Imports: first party
+import metrics
+from bundle import ModelBundle, release_pages
+from kernels import score_kernel
+from encoding import GenotypeMatrix, concat_genotypes, encode_genotypes
+
+# Floating point types in which the likelihood can be computed. float32 halves the
+# memory read per evaluation, at the cost of the accuracy described in the README.
+PRECISIONS = {"float64": np.float64, "float32": np.float32}
+# Smallest probability of an allele used in a log, by every likelihood, its
+# gradient and the compiled kernel. It is a normal number in every precision.
+MIN_PROBABILITY = 1e-30
+# Default number of SNPs whose frequencies are held in memory at once when they
+# are read from the model block by block
+BLOCK_SIZE = 2**14
+
+
+def align_sample(
+    sample: pd.DataFrame,
+    model: ModelBundle,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the model rows of the SNPs genotyped in a sample whose genotype contains the
+    reference or the alternate allele, and count the alternate alleles at each one.
+
+    Alleles and genotypes are encoded as uint8 codes so that the validity of each
+    SNP and the number of alternate alleles are computed with array operations.
+
+    :param sample: <pd.DataFrame> Sample genotyping.
+    :param model: <ModelBundle> Reference populations SNPs frequencies.
+
+    :return: <Tuple[np.ndarray, np.ndarray]> Model row of each valid SNP and count
+                                             of alternate alleles (mutations).
+    """
+    rows = model.index.get_indexer(sample["rsid"])
+    in_model = rows >= 0
+    rows = rows[in_model]
+    genotype_strings = sample["genotype"][in_model]
+    genotypes, irregular = encode_genotypes(genotype_strings)
+    ref = model.ref[rows]
+    alt = model.alt[rows]
+
+    is_alt = genotypes == alt[:, None]
+    is_ref = genotypes == ref[:, None]
+    valid = np.logical_or(is_alt.any(axis=1), is_ref.any(axis=1))
+    mutations = is_alt.sum(axis=1, dtype=np.int64)
+
+    # Genotypes with more than two characters can not be encoded, fall back to
+    # string matching for those few SNPs
+    for i in np.flatnonzero(irregular):
+        genotype = genotype_strings.iloc[i]
+        alt_allele, ref_allele = chr(alt[i]), chr(ref[i])
+        valid[i] = alt_allele in genotype or ref_allele in genotype
+        mutations[i] = genotype.count(alt_allele)
+
+    return rows[valid], np.ascontiguousarray(mutations[valid])
 
 
 def cross_reference(
     sample: pd.DataFrame,
-    model: pd.DataFrame,
-) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    model: Union[ModelBundle, pd.DataFrame],
+    precision: str = "float64",
+) -> Tuple[np.ndarray, np.ndarray]:
     """
     Combine the information of a model SNPs frequencies with an individual genotype
     in order to use it later on to compute the log-likelihood.
 
     :param sample: <pd.DataFrame> Sample genotyping.
-    :param model: <pd.DataFrame> Reference populations SNPs frequencies.
+    :param model: <ModelBundle> Reference populations SNPs frequencies.
+    :param precision: <str> Floating point type of the frequencies, float64 or
+                            float32. Default: float64.
 
-    :return: <Tuple[pd.DataFrame, pd.DataFrame]>
+    :return: <Tuple[np.ndarray, np.ndarray]> Contiguous (n_snps, n_pops) float array
+                                             with the frequencies of the valid SNPs
+                                             and the count of alternate alleles
+                                             (mutations) of the sample at each one.
     """
-    df = sample.merge(model, left_on="rsid", right_on="rsid")
-    df = df[
-        np.logical_or(
-            df.apply(lambda x: x.alt in x.genotype, axis=1),
-            df.apply(lambda x: x.ref in x.genotype, axis=1),
+    if isinstance(model, pd.DataFrame):
+        model = ModelBundle.from_frame(model)
+    rows, mutations = align_sample(sample, model)
+    return model.frequencies[rows].astype(PRECISIONS[precision]), mutations
+
+
+def align_samples(
+    samples: Dict[str, pd.DataFrame],
+    model: ModelBundle,
+) -> GenotypeMatrix:
+    """
+    Align several samples to a model at once. The result covers every model SNP
+    that is valid in at least one sample.
+
+    :param samples: <Dict[str, pd.DataFrame]> Genotyping of each sample.
+    :param model: <ModelBundle> Reference populations SNPs frequencies.
+
+    :return: <GenotypeMatrix> Count of alternate alleles of each sample at each SNP.
+    """
+    matrices = []
+    for sample_id, sample in samples.items():
+        rows, mutations = align_sample(sample, model)
+        rows, index = np.unique(rows, return_index=True)
+        dosages = mutations[index].astype(np.int8)[None, :]
+        matrices.append(GenotypeMatrix([sample_id], rows, dosages))
+    if not matrices:
+        return GenotypeMatrix([], np.zeros(0, int), np.zeros((0, 0), np.int8))
+    return concat_genotypes(matrices)
+
+
+class FrequencyBlocks:
+    """
+    Frequencies of the SNPs aligned to some samples, read from the model rows block
+    by block each time the likelihood is evaluated instead of copied to memory at
+    once. Only one block of block_size SNPs is held in memory at a time, and the
+    pages of a memory-mapped model are released as soon as they have been read, so
+    the memory used does not grow with the number of SNPs. The likelihood functions
+    of this module accept it in place of an (n_snps, n_pops) frequencies array.
+    """
+
+    def __init__(
+        self,
+        frequencies: np.ndarray,
+        rows: np.ndarray,
+        block_size: int = BLOCK_SIZE,
+        precision: str = "float64",
+    ):
+        """
+        :param frequencies: <np.ndarray> (n_model_snps, n_pops) Frequencies of every
+                                         model SNP, typically memory-mapped.
+        :param rows: <np.ndarray> Model row of each SNP, read fastest when sorted.
+        :param block_size: <int> Number of SNPs read at once. Default: 16384.
+        :param precision: <str> Floating point type of the blocks, float64 or
+                                float32. Default: float64.
+        """
+        if block_size < 1:
+            raise ValueError(f"The block size must be positive, got {block_size}.")
+        self.frequencies = frequencies
+        self.rows = np.asarray(rows)
+        self.block_size = block_size
+        self.precision = precision
+        self.dtype = np.dtype(PRECISIONS[precision])
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.rows), self.frequencies.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, snps) -> "FrequencyBlocks":
+        """
+        Select a subset of the SNPs, with the same indices as an array.
+        """
+        return FrequencyBlocks(
+            self.frequencies,
+            self.rows[snps],
+            self.block_size,
+            self.precision,
         )
+
+    def __iter__(self) -> Iterator[Tuple[slice, np.ndarray]]:
+        """
+        Yield the position of the SNPs of each block and their frequencies.
+        """
+        for start in range(0, len(self.rows), self.block_size):
+            rows = self.rows[start : start + self.block_size]
+            block = np.asarray(self.frequencies[rows], dtype=self.dtype)
+            release_pages(self.frequencies, rows.min(), rows.max() + 1)
+            yield slice(start, start + len(rows)), block
+
+
+def model_frequencies(
+    model: ModelBundle,
+    rows: np.ndarray,
+    precision: str = "float64",
+    block_size: Optional[int] = None,
+) -> Union[np.ndarray, FrequencyBlocks]:
+    """
+    Frequencies of some model rows in the floating point type of the likelihood.
+
+    :param model: <ModelBundle> Reference populations SNPs frequencies.
+    :param rows: <np.ndarray> Model row of each SNP.
+    :param precision: <str> Floating point type, float64 or float32.
+                            Default: float64.
+    :param block_size: <int> If given, the frequencies are read from the model in
+                             blocks of this many SNPs at every evaluation, see
+                             FrequencyBlocks. Default: copied to memory at once.
+
+    :return: <Union[np.ndarray, FrequencyBlocks]> Frequencies of the rows.
+    """
+    if block_size is None:
+        return model.frequencies[rows].astype(PRECISIONS[precision])
+    return FrequencyBlocks(model.frequencies, rows, block_size, precision)
+
+
+def _snp_blocks(
+    frequencies: Union[np.ndarray, FrequencyBlocks],
+    *arrays: np.ndarray,
+) -> Iterator[Tuple[np.ndarray, ...]]:
+    """
+    Split a likelihood into sums over blocks of SNPs: yield the frequencies of each
+    block followed by the given arrays sliced along their last (SNPs) axis. An
+    in-memory frequencies array is a single block.
+    """
+    if not isinstance(frequencies, FrequencyBlocks):
+        yield (frequencies, *arrays)
+        return
+    for snps, block in frequencies:
+        yield (block, *(array[..., snps] for array in arrays))
+
+
+def _informative_snps(frequencies: Union[np.ndarray, FrequencyBlocks]) -> np.ndarray:
+    """
+    Mask of the SNPs whose alternate allele frequency is not 0 in every population,
+    nor 1 in every population. The likelihood of such a SNP is the same for every
+    admixture proportion, 0 when the sample has the allele that is absent from
+    every population, so the solvers leave them out: they carry no information,
+    and an impossible genotype would otherwise dominate the derivatives of the
+    likelihood through the floor of its probability.
+    """
+    informative = [
+        (block.max(axis=1) > 0) & (block.min(axis=1) < 1)
+        for (block,) in _snp_blocks(frequencies)
     ]
-    df = df.reset_index(drop=True)
-    columns = model.columns[3:]
-    df["mutation"] = df.apply(lambda x: x.genotype.count(x.alt), axis=1)
-    df["not_mutation"] = 2 - df["mutation"]
-    return df[columns], df[["mutation", "not_mutation"]]
+    return np.concatenate(informative + [np.zeros(0, dtype=bool)])
+
+
+def _probabilities(
+    frequencies: np.ndarray,
+    admixture: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Probability of the alternate and of the reference allele at each SNP, in float64.
+    """
+    alt = np.matmul(frequencies, admixture.astype(frequencies.dtype, copy=False))
+    alt = alt.astype(np.float64, copy=False)
+    ref = admixture.sum() - alt
+    # Solvers may step slightly outside the bounds, keep the probabilities away
+    # from zero so the logs and the derivatives stay finite
+    return np.maximum(alt, MIN_PROBABILITY), np.maximum(ref, MIN_PROBABILITY)
 
 
 def score_admixture(
-    df: pd.DataFrame,
-    mutations: pd.DataFrame,
-) -> Callable[[np.ndarray], float]:
+    frequencies: Union[np.ndarray, FrequencyBlocks],
+    mutations: np.ndarray,
+    gradient: bool = False,
+) -> Callable[[np.ndarray], Union[float, Tuple[float, np.ndarray]]]:
     """
-    Given a df with the sample genotype frequency for the given populaton
-    and the mutations, return a function to compute the log-likelihood given
-    an admixture proportion.
+    Given the sample genotype frequency for the given populaton and the mutations,
+    return a function to compute the log-likelihood given an admixture proportion.
 
-    :param df: <pd.DataFrame> Reference populations SNPs frequencies.
-    :param mutations: <pd.DataFrame> DataFrame with the count of mutated
-                                     and non mutated alleles in each SNP.
+    The products with the frequencies matrix are computed in its floating point
+    type, and the sums over SNPs in float64. The reference allele probabilities are
+    sum(admixture) - alt, so the complement of the frequencies is never built. With
+    FrequencyBlocks, the sums are accumulated over the blocks as they are read. When
+    Numba is installed, the score and its gradient of large blocks are computed by
+    the compiled kernel of kernels.score_kernel instead, entirely in float64.
+
+    :param frequencies: <np.ndarray> Reference populations SNPs frequencies, or
+                                     FrequencyBlocks to read them block by block.
+    :param mutations: <np.ndarray> Count of mutated alleles in each SNP. The
+                                   remaining alleles up to 2 are not mutated.
+    :param gradient: <bool> If True, the function also returns the exact gradient
+                            of the score. Default: False.
 
     :return: <function> Return afunction that given an admixture proportion
                         returns the log-likelihood.
     """
+    not_mutations: np.ndarray = 2 - mutations
+    counts = np.issubdtype(np.asarray(mutations).dtype, np.integer)
 
-    def score_admixture_(admixture: np.ndarray) -> float:
+    def score_admixture_(
+        admixture: np.ndarray,
+    ) -> Union[float, Tuple[float, np.ndarray]]:
         """
         Compute the log-likelihood given an admixture proportion.
 
         :param admixture: <np.ndarray> Admixture proportion.
 
-        :returns: <float> log-likelihood.
+        :returns: <float> log-likelihood, and its gradient if requested.
         """
-        score = -np.dot(
-            mutations["mutation"],
-            np.log(np.matmul(df, admixture) + 1e-100),
-        )
-        score -= np.dot(
-            mutations["not_mutation"],
-            np.log(np.matmul(1 - df, admixture) + 1e-100),
-        )
-        return score
+        score = 0.0
+        jacobian = np.zeros(frequencies.shape[1])
+        for block, block_mutations, block_not_mutations in _snp_blocks(
+            frequencies,
+            mutations,
+            not_mutations,
+        ):
+            kernel = score_kernel(len(block)) if counts else None
+            if kernel is not None:
+                block_score, block_jacobian = kernel(
+                    block,
+                    block_mutations,
+                    admixture,
+                    MIN_PROBABILITY,
+                )
+                score += block_score
+                jacobian += block_jacobian
+                continue
+            alt, ref = _probabilities(block, admixture)
+            score -= np.dot(block_mutations, np.log(alt))
+            score -= np.dot(block_not_mutations, np.log(ref))
+            if gradient:
+                weights = block_not_mutations / ref
+                jacobian += np.matmul(
+                    (weights - block_mutations / alt).astype(block.dtype),
+                    block,
+                )
+                jacobian -= weights.sum()
+        if not gradient:
+            return score
+        return score, jacobian
 
     return score_admixture_
 
 
-def estimate_ancestry(sample: pd.DataFrame, model: pd.DataFrame) -> Dict[str, float]:
+def hessian_admixture(
+    frequencies: Union[np.ndarray, FrequencyBlocks],
+    mutations: np.ndarray,
+) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Return a function computing the exact Hessian of the score of score_admixture.
+
+    :param frequencies: <np.ndarray> Reference populations SNPs frequencies, or
+                                     FrequencyBlocks to read them block by block.
+    :param mutations: <np.ndarray> Count of mutated alleles in each SNP.
+
+    :return: <function> Function that given an admixture proportion returns the
+                        (n_pops, n_pops) Hessian matrix.
+    """
+    not_mutations: np.ndarray = 2 - mutations
+
+    def hessian_admixture_(admixture: np.ndarray) -> np.ndarray:
+        n_pops = frequencies.shape[1]
+        hessian = np.zeros((n_pops, n_pops))
+        for block, block_mutations, block_not_mutations in _snp_blocks(
+            frequencies,
+            mutations,
+            not_mutations,
+        ):
+            alt, ref = _probabilities(block, admixture)
+            weights = block_not_mutations / ref**2
+            # (1 - F)' W (1 - F) expanded so that only F is multiplied
+            curvature = (block_mutations / alt**2 + weights).astype(block.dtype)
+            hessian += np.matmul(block.T * curvature, block)
+            cross = np.matmul(weights.astype(block.dtype), block)
+            hessian += weights.sum() - cross[:, None] - cross[None, :]
+        return hessian
+
+    return hessian_admixture_
+
+
+def solve_admixture(
+    frequencies: Union[np.ndarray, FrequencyBlocks],
+    mutations: np.ndarray,
+    solver: str = "slsqp",
+    initial: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, Dict[str, float]]:
+    """
+    Find the admixture proportion that maximizes the likelihood of a sample. The
+    likelihood is computed in the floating point type of the frequencies.
+
+    :param frequencies: <np.ndarray> Reference populations SNPs frequencies, or
+                                     FrequencyBlocks to read them block by block.
+    :param mutations: <np.ndarray> Count of mutated alleles in each SNP.
+    :param solver: <str> Solver to use. Choices: slsqp, trust-constr (both with the
+                         exact gradient, and Hessian for trust-constr) or em, the
+                         multiplicative EM update of ADMIXTURE. Default: slsqp.
+    :param initial: <np.ndarray> Proportions to start from, e.g. a previous
+                                 estimate of the sample. Default: uniform.
+
+    :return: <Tuple[np.ndarray, Dict[str, float]]> Admixture proportion and solver
+                                                   statistics: number of iterations,
+                                                   of function evaluations and final
+                                                   log-likelihood.
+    """
+    n_pops = frequencies.shape[1]
+    informative = _informative_snps(frequencies)
+    if not informative.all():
+        frequencies = frequencies[informative]
+        mutations = mutations[informative]
+    if solver == "em":
+        admixtures, info = solve_admixture_batch(
+            frequencies,
+            mutations[None, :],
+            initial=None if initial is None else np.asarray(initial)[None, :],
+        )
+        return admixtures[0], {
+            "iterations": int(info["iterations"][0]),
+            "evaluations": int(info["evaluations"][0]),
+            "log_likelihood": float(info["log_likelihood"][0]),
+        }
+    if solver not in ("slsqp", "trust-constr"):
+        raise ValueError(f"Unknown solver {solver}. Expected slsqp, trust-constr or em")
+
+    # scipy.optimize takes longer to import than most runs spend solving with EM,
+    # so it is only imported by the solvers that use it
+    from scipy.optimize import Bounds, LinearConstraint, minimize  # isort: skip
+
+    linear_constraint = LinearConstraint(np.ones(n_pops), [1], [1])
+    bounds = Bounds(0, 1)
+    result = minimize(
+        score_admixture(frequencies, mutations, gradient=True),
+        np.ones(n_pops) / n_pops if initial is None else initial,
+        method=solver,
+        jac=True,
+        hess=hessian_admixture(frequencies, mutations)
+        if solver == "trust-constr"
+        else None,
+        constraints=[linear_constraint],
+        bounds=bounds,
+    )
+    return result.x, {
+        "iterations": int(result.nit),
+        "evaluations": int(result.nfev),
+        "log_likelihood": -float(result.fun),
+    }
+
+
+def estimate_ancestry(
+    sample: pd.DataFrame,
+    model: Union[ModelBundle, pd.DataFrame],
+    solver: str = "slsqp",
+    precision: str = "float64",
+    block_size: Optional[int] = None,
+) -> Dict[str, float]:
     """
     Estimate the ancestry of sample given its genotype and a reference population SNP
     frequencies.
 
     :param sample: <pd.DataFrame> Sample genotyping.
-    :param model: <pd.DataFrame> Reference populations SNPs frequencies.
+    :param model: <ModelBundle> Reference populations SNPs frequencies.
+    :param solver: <str> Solver to use. Choices: slsqp, trust-constr or em.
+                         Default: slsqp.
+    :param precision: <str> Floating point type of the likelihood computations,
+                            float64 or float32. Default: float64.
+    :param block_size: <int> If given, the model frequencies are read in blocks of
+                             this many SNPs at every evaluation instead of copied
+                             to memory, see FrequencyBlocks. Default: None.
 
     :return: <Dict[str, float]> Dictionary whose keys are population names and
                                 values the corresponding admixture fraction.
     """
-    df, mutations = cross_reference(sample, model)
-    pops = list(df.columns)
+    if isinstance(model, pd.DataFrame):
+        model = ModelBundle.from_frame(model)
+    rows, mutations = align_sample(sample, model)
+    if block_size is not None:
+        # Read the model sequentially
+        order = np.argsort(rows, kind="stable")
+        rows, mutations = rows[order], mutations[order]
+    frequencies = model_frequencies(model, rows, precision, block_size)
+    pops = model.populations
 
-    linear_constraint = LinearConstraint(np.ones(len(pops)), [1], [1])
-    bounds = Bounds(0, 1)
-    admixture = minimize(
-        score_admixture(df, mutations),
-        np.ones(len(pops)) / len(pops),
-        constraints=[linear_constraint],
-        bounds=bounds,
-    ).x
+    admixture, info = solve_admixture(frequencies, mutations, solver)
+    logging.info(
+        f"Solver {solver} finished after {info['iterations']} iterations "
+        f"({info['evaluations']} evaluations) with log-likelihood "
+        f"{info['log_likelihood']:.3f}",
+    )
 
     output_str = "Admixture proportions:"
     for pop, admix in zip(pops, admixture):
         output_str += f"\n\t{pop}: {admix*100:.3f}%"
     logging.info(output_str)
     return dict(zip(pops, admixture))
+
+
+def _batch_probabilities(
+    admixture: np.ndarray,
+    frequencies: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Batched version of _probabilities, which stays in the floating point type of
+    the frequencies since its results are as large as the genotypes of a chunk.
+    """
+    alt = np.matmul(admixture.astype(frequencies.dtype, copy=False), frequencies.T)
+    ref = admixture.sum(axis=1, keepdims=True).astype(frequencies.dtype) - alt
+    return (
+        np.maximum(alt, MIN_PROBABILITY, out=alt),
+        np.maximum(ref, MIN_PROBABILITY, out=ref),
+    )
+
+
+def _log_likelihood(
+    admixture: np.ndarray,
+    frequencies: Union[np.ndarray, FrequencyBlocks],
+    mutations: np.ndarray,
+    not_mutations: np.ndarray,
+) -> np.ndarray:
+    # Accumulate in float64 whatever the precision, so that the convergence test
+    # sees changes smaller than the rounding of the whole sum
+    log_likelihood = np.zeros(admixture.shape[0])
+    for block, block_mutations, block_not_mutations in _snp_blocks(
+        frequencies,
+        mutations,
+        not_mutations,
+    ):
+        alt, ref = _batch_probabilities(admixture, block)
+        log_likelihood += np.sum(
+            block_mutations * np.log(alt),
+            axis=1,
+            dtype=np.float64,
+        )
+        log_likelihood += np.sum(
+            block_not_mutations * np.log(ref),
+            axis=1,
+            dtype=np.float64,
+        )
+    return log_likelihood
+
+
+def _em_step(
+    admixture: np.ndarray,
+    frequencies: Union[np.ndarray, FrequencyBlocks],
+    mutations: np.ndarray,
+    not_mutations: np.ndarray,
+    totals: np.ndarray,
+) -> np.ndarray:
+    """
+    Multiplicative EM update of the admixture proportions of several samples with
+    fixed allele frequencies, as in ADMIXTURE's projection mode.
+    """
+    responsibilities = np.zeros(admixture.shape)
+    for block, block_mutations, block_not_mutations in _snp_blocks(
+        frequencies,
+        mutations,
+        not_mutations,
+    ):
+        alt, ref = _batch_probabilities(admixture, block)
+        # m / alt F + (2 - m) / ref (1 - F), expanded so that only F is multiplied
+        weights = block_not_mutations / ref
+        responsibilities += np.matmul(block_mutations / alt - weights, block)
+        responsibilities += weights.sum(axis=1, dtype=np.float64)[:, None]
+    return admixture * responsibilities / totals[:, None]
+
+
+def _squarem(
+    admixture: np.ndarray,
+    frequencies: Union[np.ndarray, FrequencyBlocks],
+    mutations: np.ndarray,
+    not_mutations: np.ndarray,
+    max_iter: int,
+    tol: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    admixture = admixture.copy()
+    totals = np.maximum(mutations.sum(axis=1) + not_mutations.sum(axis=1), 1)
+    log_likelihood = _log_likelihood(admixture, frequencies, mutations, not_mutations)
+    iterations = np.zeros(admixture.shape[0], dtype=np.int64)
+    active = np.arange(admixture.shape[0])
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        counts = (mutations[active], not_mutations[active])
+        active_totals = totals[active]
+        current = admixture[active]
+        first = _em_step(current, frequencies, *counts, active_totals)
+        second = _em_step(first, frequencies, *counts, active_totals)
+
+        # Extrapolate along the EM path, then take one more EM step from the
+        # (projected) extrapolated point. Fall back to the plain EM iterate for the
+        # samples where it does not improve the log-likelihood.
+        difference = first - current
+        curvature = second - first - difference
+        difference_norm = np.linalg.norm(difference, axis=1)
+        curvature_norm = np.linalg.norm(curvature, axis=1)
+        alpha = -np.divide(
+            difference_norm,
+            curvature_norm,
+            out=np.ones_like(difference_norm),
+            where=curvature_norm > 0,
+        )
+        alpha = np.minimum(alpha, -1)[:, None]
+        proposal = current - 2 * alpha * difference + alpha**2 * curvature
+        # Shorten the step towards the EM iterate (alpha = -1) until it stays
+        # inside the simplex, so no population is pushed onto the boundary
+        for _ in range(20):
+            infeasible = np.any(proposal < 0, axis=1)
+            if not infeasible.any():
+                break
+            alpha[infeasible] = (alpha[infeasible] - 1) / 2
+            proposal = current - 2 * alpha * difference + alpha**2 * curvature
+        proposal = np.maximum(proposal, 0)
+        sums = proposal.sum(axis=1, keepdims=True)
+        np.divide(proposal, sums, out=proposal, where=sums > 0)
+        proposal = _em_step(proposal, frequencies, *counts, active_totals)
+        proposal_likelihood = _log_likelihood(proposal, frequencies, *counts)
+        second_likelihood = _log_likelihood(second, frequencies, *counts)
+        # Written so that a proposal whose likelihood is not a number is not kept
+        worse = ~(proposal_likelihood >= second_likelihood)
+        proposal[worse] = second[worse]
+        proposal_likelihood[worse] = second_likelihood[worse]
+
+        change = np.abs(proposal_likelihood - log_likelihood[active])
+        converged = change <= tol * np.abs(proposal_likelihood)
+        admixture[active] = proposal
+        log_likelihood[active] = proposal_likelihood
+        iterations[active] += 1
+        active = active[~converged]
+    return admixture, iterations, log_likelihood
+
+
+def solve_admixture_batch(
+    frequencies: Union[np.ndarray, FrequencyBlocks],
+    dosages: np.ndarray,
+    max_iter: int = 1000,
+    tol: float = 1e-10,
+    chunk_size: int = 256,
+    initial: Optional[np.ndarray] = None,
+    weights: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Estimate the admixture proportions of several samples together with batched
+    EM updates, accelerated with SQUAREM extrapolation. Each update is a pair of
+    matrix-matrix products over every sample of a chunk, computed in the floating
+    point type of the frequencies.
+
+    :param frequencies: <np.ndarray> (n_snps, n_pops) Reference populations
+                                     SNPs frequencies, or FrequencyBlocks to read
+                                     them block by block.
+    :param dosages: <np.ndarray> (n_samples, n_snps) Count of alternate alleles of
+                                 each sample, negative where it is missing.
+    :param max_iter: <int> Maximum number of iterations. Default: 1000.
+    :param tol: <float> Relative change in log-likelihood at which a sample is
+                        considered converged. Default: 1e-10.
+    :param chunk_size: <int> Number of samples solved at once, which bounds the
+                             memory used. Default: 256.
+    :param initial: <np.ndarray> (n_samples, n_pops) Proportions to start from, e.g.
+                                 the solution on fewer SNPs. Default: uniform.
+    :param weights: <np.ndarray> (n_samples, n_snps) Weight of each SNP in the
+                                 likelihood of each sample, e.g. the number of
+                                 times it is drawn by a bootstrap. Default: 1.
+
+    :return: <Tuple[np.ndarray, Dict[str, np.ndarray]]> (n_samples, n_pops)
+                                                        Admixture proportions and
+                                                        the number of iterations,
+                                                        of likelihood evaluations
+                                                        and final log-likelihood
+                                                        of each sample.
+    """
+    n_pops = frequencies.shape[1]
+    if initial is None:
+        admixture = np.full((dosages.shape[0], n_pops), 1 / n_pops)
+    else:
+        # Multiplicative updates can not move a proportion away from zero
+        admixture = np.maximum(np.asarray(initial, dtype=np.float64), 1e-6)
+        admixture /= admixture.sum(axis=1, keepdims=True)
+    informative = _informative_snps(frequencies)
+    if not informative.all():
+        frequencies = frequencies[informative]
+        dosages = dosages[:, informative]
+        if weights is not None:
+            weights = weights[:, informative]
+    iterations = np.zeros(dosages.shape[0], dtype=np.int64)
+    log_likelihood = np.zeros(dosages.shape[0])
+    for start in range(0, dosages.shape[0], chunk_size):
+        chunk = dosages[start : start + chunk_size]
+        observed = chunk >= 0
+        mutations = np.where(observed, chunk, 0).astype(frequencies.dtype)
+        not_mutations = np.where(observed, 2 - chunk, 0).astype(frequencies.dtype)
+        batch = slice(start, start + chunk_size)
+        if weights is not None:
+            mutations *= weights[batch]
+            not_mutations *= weights[batch]
+        admixture[batch], iterations[batch], log_likelihood[batch] = _squarem(
+            admixture[batch],
+            frequencies,
+            mutations,
+            not_mutations,
+            max_iter,
+            tol,
+        )
+    # Every iteration takes three EM steps and two likelihood evaluations
+    return admixture, {
+        "iterations": iterations,
+        "evaluations": 5 * iterations,
+        "log_likelihood": log_likelihood,
+    }
+
+
+def estimate_ancestry_batch(
+    samples: Union[Dict[str, pd.DataFrame], GenotypeMatrix],
+    model: Union[ModelBundle, pd.DataFrame],
+    solver: str = "em",
+    precision: str = "float64",
+    block_size: Optional[int] = None,
+    initial: Optional[np.ndarray] = None,
+) -> Dict[str, Dict[str, float]]:
+    """
+    Estimate the ancestry of several samples in a single solver pass. The samples
+    are aligned to the model together and, with the em solver, all the admixture
+    vectors are solved with batched EM updates. Other solvers go through the aligned
+    samples one by one.
+
+    :param samples: <Dict[str, pd.DataFrame]> Genotyping of each sample, or their
+                                              genotypes already aligned to the model.
+    :param model: <ModelBundle> Reference populations SNPs frequencies.
+    :param solver: <str> Solver to use. Choices: em, slsqp or trust-constr.
+                         Default: em.
+    :param precision: <str> Floating point type of the likelihood computations,
+                            float64 or float32. Default: float64.
+    :param block_size: <int> If given, the model frequencies are read in blocks of
+                             this many SNPs at every evaluation instead of copied
+                             to memory, see FrequencyBlocks. Default: None.
+    :param initial: <np.ndarray> (n_samples, n_pops) Proportions to start each
+                                 sample from, e.g. a previous estimate of it.
+                                 Default: uniform.
+
+    :return: <Dict[str, Dict[str, float]]> Dictionary whose keys are the sample ids
+                                           and values dictionaries with the admixture
+                                           fraction of each population.
+    """
+    if isinstance(model, pd.DataFrame):
+        model = ModelBundle.from_frame(model)
+    if not isinstance(samples, GenotypeMatrix):
+        samples = align_samples(samples, model)
+    frequencies = model_frequencies(model, samples.rows, precision, block_size)
+
+    if solver == "em":
+        admixtures, info = solve_admixture_batch(
+            frequencies,
+            samples.dosages,
+            initial=initial,
+        )
+    else:
+        admixtures = np.zeros((len(samples.sample_ids), len(model.populations)))
+        info = {
+            "iterations": np.zeros(len(samples.sample_ids), dtype=np.int64),
+            "evaluations": np.zeros(len(samples.sample_ids), dtype=np.int64),
+            "log_likelihood": np.zeros(len(samples.sample_ids)),
+        }
+        for i, dosages in enumerate(samples.dosages):
+            observed = dosages >= 0
+            admixtures[i], sample_info = solve_admixture(
+                frequencies[observed],
+                dosages[observed].astype(np.int64),
+                solver,
+                None if initial is None else initial[i],
+            )
+            for name, value in sample_info.items():
+                info[name][i] = value
+
+    pops = model.populations
+    ancestries = {}
+    for i, (sample_id, admixture) in enumerate(zip(samples.sample_ids, admixtures)):
+        output_str = (
+            f"Admixture proportions of sample {sample_id} after "
+            f"{info['iterations'][i]} iterations with log-likelihood "
+            f"{info['log_likelihood'][i]:.3f}:"
+        )
+        for pop, admix in zip(pops, admixture):
+            output_str += f"\n\t{pop}: {admix*100:.3f}%"
+        logging.info(output_str)
+        metrics.record_sample(
+            sample_id,
+            iterations=int(info["iterations"][i]),
+            evaluations=int(info["evaluations"][i]),
+            log_likelihood=float(info["log_likelihood"][i]),
+        )
+        ancestries[sample_id] = dict(zip(pops, admixture))
+    metrics.count("solver_iterations", int(info["iterations"].sum()))
+    metrics.count("solver_evaluations", int(info["evaluations"].sum()))
+    return ancestries
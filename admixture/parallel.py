@@ -0,0 +1,156 @@
+"""Estimation of the input files across a pool of worker processes"""
+
+# Imports: standard library
+import logging
+import multiprocessing
+from typing import Any, Set, Dict, List, Tuple, Iterator, Optional
+from concurrent.futures import ProcessPoolExecutor
+
+# Imports: first party
+import metrics
+from cache import ResultCache
+from store import SampleStore
+from bundle import ModelBundle
+from loader import load_model
+from pipeline import load_samples, estimate_samples
+
+# Model used by the worker processes. It is set before the pool is created, so
+# forked workers inherit it, or loaded once per worker by _init_worker otherwise.
+_WORKER_MODEL: Optional[ModelBundle] = None
+
+
+def _init_worker(model_name: str, model_dirs: Optional[List[str]]):
+    global _WORKER_MODEL  # pylint: disable=global-statement
+    if _WORKER_MODEL is None:
+        _WORKER_MODEL = load_model(model_name, model_dirs)
+
+
+def _process_file(
+    sample_file: str,
+    input_format: str,
+    solver: Optional[str],
+    cache: Optional[ResultCache],
+    precision: str,
+    preview: Optional[float],
+    bootstrap: int,
+    skip: Optional[Set[str]],
+    block_size: Optional[int],
+    store: Optional[SampleStore],
+    sample_id: Optional[str],
+) -> Tuple[Dict[str, Dict[str, float]], Dict[str, str], Dict[str, Any]]:
+    assert _WORKER_MODEL is not None
+    recorder = metrics.enable()
+    try:
+        genotypes = load_samples(
+            sample_file,
+            input_format,
+            _WORKER_MODEL,
+            skip,
+            sample_id,
+        )
+    except Exception as error:  # pylint: disable=broad-except
+        logging.error(f"Failed to load {sample_file}: {error}")
+        return {}, {sample_file: repr(error)}, recorder.to_dict()
+    ancestries, failures = estimate_samples(
+        genotypes,
+        _WORKER_MODEL,
+        solver,
+        cache,
+        precision,
+        preview,
+        bootstrap,
+        block_size,
+        store,
+    )
+    return ancestries, failures, recorder.to_dict()
+
+
+def iter_files_parallel(
+    sample_files: List[str],
+    input_format: str,
+    model_name: str,
+    model: ModelBundle,
+    solver: Optional[str],
+    jobs: int,
+    cache: Optional[ResultCache] = None,
+    precision: str = "float64",
+    preview: Optional[float] = None,
+    bootstrap: int = 0,
+    skip: Optional[Set[str]] = None,
+    block_size: Optional[int] = None,
+    model_dirs: Optional[List[str]] = None,
+    store: Optional[SampleStore] = None,
+    sample_ids: Optional[Dict[str, str]] = None,
+) -> Iterator[Tuple[str, Tuple[Dict[str, Dict[str, float]], Dict[str, str]]]]:
+    """
+    Load and estimate the input files across a pool of processes, yielding the
+    results of each file in input order, as soon as its worker and those of the
+    files before it are finished, so that the output does not depend on which
+    worker finishes first. The model is inherited
+    by forked workers, or memory-mapped from its compiled bundle by each worker when
+    fork is not available, instead of being pickled for every task.
+
+    :param sample_files: <List[str]> Path to the input SNP files.
+    :param input_format: <str> File format of the input files.
+    :param model_name: <str> Name of the model.
+    :param model: <ModelBundle> The loaded model.
+    :param solver: <str> Solver to use. Default: see estimate_samples.
+    :param jobs: <int> Number of processes.
+    :param cache: <ResultCache> Cache of ancestry estimates. Default: None.
+    :param precision: <str> Floating point type of the likelihood computations.
+                            Default: float64.
+    :param preview: <float> Tolerance of the progressive estimation, see
+                            estimate_samples. Default: None.
+    :param bootstrap: <int> Number of bootstrap replicates, see estimate_samples.
+                            Default: 0.
+    :param skip: <Set[str]> Ids of samples to leave out. Default: None.
+    :param block_size: <int> Number of SNPs of the model read at once, see
+                             estimate_samples. Default: None.
+    :param model_dirs: <List[str]> Folders of user-defined models where workers
+                                   that are not forked look the model up.
+                                   Default: None.
+    :param store: <SampleStore> Store of the estimated samples, see
+                                estimate_samples. Default: None.
+    :param sample_ids: <Dict[str, str]> Id of the sample of single sample input
+                                        files. Default: their file names.
+
+    :return: <Iterator[Tuple[str, Tuple[Dict[str, Dict[str, float]], Dict[str, str]]]]>
+             Each input file, in input order, with the ancestry of each
+             sample and the error message of each failed sample.
+    """
+    global _WORKER_MODEL  # pylint: disable=global-statement
+    sample_ids = sample_ids or {}
+    context = None
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        _WORKER_MODEL = model
+
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(model_name, model_dirs),
+    ) as executor:
+        futures = [
+            executor.submit(
+                _process_file,
+                sample_file,
+                input_format,
+                solver,
+                cache,
+                precision,
+                preview,
+                bootstrap,
+                skip,
+                block_size,
+                store,
+                sample_ids.get(sample_file),
+            )
+            for sample_file in sample_files
+        ]
+        # Files finished before those submitted ahead of them wait in their futures
+        for sample_file, future in zip(sample_files, futures):
+            ancestries, failures, records = future.result()
+            # The metrics of each file are recorded by its worker
+            metrics.current().merge(records)
+            yield sample_file, (ancestries, failures)
@@ -0,0 +1,433 @@
+"""Loading and estimation of the samples of the input files"""
+
+# Imports: standard library
+import time
+import logging
+from typing import Set, Dict, List, Tuple, Optional
+
+# Imports: third party
+import numpy as np
+
+# Imports: first party
+import metrics
+from cache import ResultCache, sample_keys
+from store import SampleStore
+from bundle import ModelBundle
+from loader import ancestry, twenty_three, vcf_genotypes
+from encoding import GenotypeMatrix, concat_genotypes
+from bootstrap import bootstrap_intervals, estimate_ancestry_progressive
+from optimizer import align_samples, estimate_ancestry_batch
+
+# Suffixes of the columns with the bounds of the confidence interval of each
+# population proportion
+INTERVAL_SUFFIXES = ("_lower", "_upper")
+
+
+def load_samples(
+    sample_file: str,
+    input_format: str,
+    model: ModelBundle,
+    skip: Optional[Set[str]] = None,
+    sample_id: Optional[str] = None,
+) -> GenotypeMatrix:
+    """
+    Load an input file and align its samples to the model.
+
+    :param sample_file: <str> Path to the input SNP file.
+    :param input_format: <str> File format of the input file.
+    :param model: <ModelBundle> Admixture model.
+    :param skip: <Set[str]> Ids of samples to leave out, e.g. those estimated by a
+                            previous run. Default: None.
+    :param sample_id: <str> Id of the sample of a single sample file.
+                            Default: the file name.
+
+    :return: <GenotypeMatrix> Genotypes of the samples in the file.
+    """
+    if input_format == "vcf":
+        with metrics.stage("parse", file=sample_file) as counts:
+            genotypes = vcf_genotypes(sample_file, model)
+    else:
+        with metrics.stage("parse", file=sample_file) as counts:
+            if input_format == "ancestry":
+                sample_data = ancestry(sample_file, model.index)
+            elif input_format == "23andme":
+                sample_data = twenty_three(sample_file, model.index)
+            else:
+                raise ValueError(f"Unknown input format: {input_format}")
+        with metrics.stage("align", file=sample_file):
+            genotypes = align_samples(sample_data, model)
+    if sample_id is not None:
+        genotypes = genotypes._replace(sample_ids=[sample_id])
+    if skip:
+        genotypes = genotypes.take(
+            [i for i, id in enumerate(genotypes.sample_ids) if id not in skip],
+        )
+
+    overlap = (genotypes.dosages >= 0).sum(axis=1)
+    for loaded_id, n_snps in zip(genotypes.sample_ids, overlap):
+        metrics.record_sample(
+            loaded_id,
+            file=sample_file,
+            snps_read=counts.get("snps_read", 0),
+            snps_in_model=int(n_snps),
+        )
+    return genotypes
+
+
+def _estimate_samples(
+    genotypes: GenotypeMatrix,
+    model: ModelBundle,
+    solver: str,
+    precision: str,
+    preview: Optional[float] = None,
+    bootstrap: int = 0,
+    block_size: Optional[int] = None,
+    initial: Optional[Dict[str, Dict[str, float]]] = None,
+) -> Tuple[Dict[str, Dict[str, float]], Dict[str, str]]:
+    def estimate(genotypes: GenotypeMatrix) -> Dict[str, Dict[str, float]]:
+        # Samples without initial proportions start from uniform ones
+        start = None
+        if initial:
+            uniform = dict.fromkeys(model.populations, 1 / len(model.populations))
+            start = np.array(
+                [
+                    [initial.get(id, uniform)[pop] for pop in model.populations]
+                    for id in genotypes.sample_ids
+                ],
+            )
+        if preview is not None:
+            ancestries = _preview_samples(
+                genotypes,
+                model,
+                preview,
+                precision,
+                block_size,
+            )
+        else:
+            ancestries = estimate_ancestry_batch(
+                genotypes,
+                model,
+                solver,
+                precision,
+                block_size,
+                start,
+            )
+        if bootstrap:
+            _add_intervals(
+                genotypes,
+                model,
+                ancestries,
+                bootstrap,
+                precision,
+                block_size,
+            )
+        return ancestries
+
+    n_samples = len(genotypes.sample_ids)
+    with metrics.stage("solve", solver=solver) as counts:
+        counts["samples"] = n_samples
+        logging.info(f"Estimating the ancestry of {n_samples} samples with {solver}...")
+        try:
+            return estimate(genotypes), {}
+        except Exception as error:  # pylint: disable=broad-except
+            if n_samples == 1:
+                logging.error(f"Failed to estimate sample ancestry: {error}")
+                return {}, {genotypes.sample_ids[0]: repr(error)}
+            logging.warning(f"Batch estimation failed ({error}), retrying per sample")
+
+        ancestries, failures = {}, {}
+        for i, sample_id in enumerate(genotypes.sample_ids):
+            try:
+                ancestries.update(estimate(genotypes.take([i])))
+            except Exception as error:  # pylint: disable=broad-except
+                logging.error(
+                    f"Failed to estimate sample {sample_id} ancestry: {error}",
+                )
+                failures[sample_id] = repr(error)
+        return ancestries, failures
+
+
+def _add_intervals(
+    genotypes: GenotypeMatrix,
+    model: ModelBundle,
+    ancestries: Dict[str, Dict[str, float]],
+    n_replicates: int,
+    precision: str,
+    block_size: Optional[int] = None,
+):
+    """
+    Add the bounds of the 95% bootstrap confidence interval of each proportion to
+    the ancestries, as the <population>_lower and <population>_upper values.
+    """
+    logging.info(f"Computing confidence intervals from {n_replicates} replicates...")
+    with metrics.stage("bootstrap", replicates=n_replicates):
+        intervals = bootstrap_intervals(
+            genotypes,
+            model,
+            ancestries,
+            n_replicates,
+            precision=precision,
+            block_size=block_size,
+        )
+    for sample_id, sample_intervals in intervals.items():
+        for pop, bounds in sample_intervals.items():
+            for suffix, bound in zip(INTERVAL_SUFFIXES, bounds):
+                ancestries[sample_id][pop + suffix] = bound
+
+
+def _preview_samples(
+    genotypes: GenotypeMatrix,
+    model: ModelBundle,
+    tol: float,
+    precision: str,
+    block_size: Optional[int] = None,
+) -> Dict[str, Dict[str, float]]:
+    """
+    Estimate the samples progressively, logging the estimates of every stage.
+    """
+    start = time.perf_counter()
+    ancestries = {}
+    for stage in estimate_ancestry_progressive(
+        genotypes,
+        model,
+        tol=tol,
+        precision=precision,
+        block_size=block_size,
+    ):
+        output_str = (
+            f"Estimates on {stage.fraction:.0%} of the SNPs ({stage.n_snps}) after "
+            f"{time.perf_counter() - start:.2f}s:"
+        )
+        for sample_id, admixture in stage.ancestries.items():
+            output_str += f"\n\t{sample_id}:"
+            errors = stage.errors.get(sample_id)
+            for pop, admix in admixture.items():
+                output_str += f" {pop} {admix*100:.1f}%"
+                if errors:
+                    output_str += f" ± {errors[pop]*100:.1f}"
+            if sample_id in stage.changes:
+                output_str += f" (changed by {stage.changes[sample_id]*100:.2f}%)"
+        logging.info(output_str)
+        metrics.count("preview_stages", 1)
+        ancestries.update(stage.ancestries)
+    return ancestries
+
+
+def estimate_samples(
+    genotypes: GenotypeMatrix,
+    model: ModelBundle,
+    solver: Optional[str] = None,
+    cache: Optional[ResultCache] = None,
+    precision: str = "float64",
+    preview: Optional[float] = None,
+    bootstrap: int = 0,
+    block_size: Optional[int] = None,
+    store: Optional[SampleStore] = None,
+) -> Tuple[Dict[str, Dict[str, float]], Dict[str, str]]:
+    """
+    Estimate the ancestry of the given samples. Several samples are solved together
+    with batched EM unless another solver is requested. A sample that can not be
+    estimated is reported as a failure without stopping the others. Samples whose
+    aligned genotypes were already estimated with the same model and solver are
+    taken from the cache. With a sample store, the estimated samples are saved to
+    it and, if it merges, the samples already stored are first merged with their
+    stored genotypes and solved starting from their stored proportions.
+
+    :param genotypes: <GenotypeMatrix> Genotypes of the samples.
+    :param model: <ModelBundle> Admixture model.
+    :param solver: <str> Solver to use. Default: em for several samples and slsqp
+                         for a single one.
+    :param cache: <ResultCache> Cache of ancestry estimates. Default: None.
+    :param precision: <str> Floating point type of the likelihood computations.
+                            Default: float64.
+    :param preview: <float> If given, estimate progressively on growing subsets of
+                            the SNPs until the proportions change by less than
+                            this tolerance. Default: None.
+    :param bootstrap: <int> Number of block bootstrap replicates used to add the
+                            confidence intervals of the proportions. Default: 0.
+    :param block_size: <int> If given, the model frequencies are read in blocks of
+                             this many SNPs at every likelihood evaluation instead
+                             of copied to memory. Default: None.
+    :param store: <SampleStore> Store of the estimated samples. Default: None.
+
+    :return: <Tuple[Dict[str, Dict[str, float]], Dict[str, str]]> Ancestry of each
+                                                                  sample and error
+                                                                  message of each
+                                                                  failed sample.
+    """
+    if not genotypes.sample_ids:
+        return {}, {}
+    if preview is not None:
+        solver = "em"
+    solver = solver or ("em" if len(genotypes.sample_ids) > 1 else "slsqp")
+    initial: Dict[str, Dict[str, float]] = {}
+    if store is not None and store.merge:
+        with metrics.stage("merge") as counts:
+            genotypes, initial = store.merge_samples(genotypes, model)
+            counts["samples"] = len(initial)
+        overlap = (genotypes.dosages >= 0).sum(axis=1)
+        for sample_id, n_snps in zip(genotypes.sample_ids, overlap):
+            if sample_id in initial:
+                metrics.record_sample(sample_id, snps_merged=int(n_snps))
+        if initial:
+            logging.info(f"Merged {len(initial)} samples with their stored genotypes.")
+    ancestries, failures = _estimate_cached(
+        genotypes,
+        model,
+        solver,
+        cache,
+        precision,
+        preview,
+        bootstrap,
+        block_size,
+        initial,
+    )
+    if store is not None:
+        with metrics.stage("store") as counts:
+            store.put_many(genotypes, model, ancestries)
+            counts["samples"] = len(ancestries)
+    return ancestries, failures
+
+
+def _estimate_cached(
+    genotypes: GenotypeMatrix,
+    model: ModelBundle,
+    solver: str,
+    cache: Optional[ResultCache],
+    precision: str,
+    preview: Optional[float],
+    bootstrap: int,
+    block_size: Optional[int],
+    initial: Dict[str, Dict[str, float]],
+) -> Tuple[Dict[str, Dict[str, float]], Dict[str, str]]:
+    """
+    Estimate the samples that are not in the cache, see estimate_samples.
+    """
+    if cache is None:
+        return _estimate_samples(
+            genotypes,
+            model,
+            solver,
+            precision,
+            preview,
+            bootstrap,
+            block_size,
+            initial,
+        )
+
+    keys = sample_keys(
+        genotypes,
+        model.fingerprint,
+        solver,
+        precision,
+        preview,
+        bootstrap,
+    )
+    cached = cache.get_many(keys)
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    if len(missing) < len(keys):
+        logging.info(f"Found {len(keys) - len(missing)} samples in the cache.")
+    ancestries: Dict[str, Dict[str, float]] = {}
+    failures: Dict[str, str] = {}
+    if missing:
+        ancestries, failures = _estimate_samples(
+            genotypes.take(missing),
+            model,
+            solver,
+            precision,
+            preview,
+            bootstrap,
+            block_size,
+            initial,
+        )
+        cache.put_many(
+            {
+                keys[i]: ancestries[genotypes.sample_ids[i]]
+                for i in missing
+                if genotypes.sample_ids[i] in ancestries
+            },
+        )
+    for sample_id, key in zip(genotypes.sample_ids, keys):
+        if key in cached:
+            ancestries[sample_id] = cached[key]
+            metrics.record_sample(sample_id, cached=True)
+    ancestries = {
+        sample_id: ancestries[sample_id]
+        for sample_id in genotypes.sample_ids
+        if sample_id in ancestries
+    }
+    return ancestries, failures
+
+
+def estimate_files(
+    sample_files: List[str],
+    input_format: str,
+    model: ModelBundle,
+    solver: Optional[str],
+    cache: Optional[ResultCache] = None,
+    precision: str = "float64",
+    preview: Optional[float] = None,
+    bootstrap: int = 0,
+    skip: Optional[Set[str]] = None,
+    block_size: Optional[int] = None,
+    store: Optional[SampleStore] = None,
+    sample_ids: Optional[Dict[str, str]] = None,
+) -> Dict[str, Tuple[Dict[str, Dict[str, float]], Dict[str, str]]]:
+    """
+    Load the input files and estimate the ancestry of all their samples together.
+
+    :param sample_files: <List[str]> Path to the input SNP files.
+    :param input_format: <str> File format of the input files.
+    :param model: <ModelBundle> Admixture model.
+    :param solver: <str> Solver to use. Default: see estimate_samples.
+    :param cache: <ResultCache> Cache of ancestry estimates. Default: None.
+    :param precision: <str> Floating point type of the likelihood computations.
+                            Default: float64.
+    :param preview: <float> Tolerance of the progressive estimation, see
+                            estimate_samples. Default: None.
+    :param bootstrap: <int> Number of bootstrap replicates, see estimate_samples.
+                            Default: 0.
+    :param skip: <Set[str]> Ids of samples to leave out. Default: None.
+    :param block_size: <int> Number of SNPs of the model read at once, see
+                             estimate_samples. Default: None.
+    :param store: <SampleStore> Store of the estimated samples, see
+                                estimate_samples. Default: None.
+    :param sample_ids: <Dict[str, str]> Id of the sample of single sample input
+                                        files. Default: their file names.
+
+    :return: <Dict[str, Tuple[Dict[str, Dict[str, float]], Dict[str, str]]]>
+             Ancestry of each sample and error message of each failed sample, for
+             each input file.
+    """
+    sample_ids = sample_ids or {}
+    logging.info(f"Loading {len(sample_files)} samples...")
+    file_genotypes = [
+        load_samples(
+            sample_file,
+            input_format,
+            model,
+            skip,
+            sample_ids.get(sample_file),
+        )
+        for sample_file in sample_files
+    ]
+    logging.info("Samples loaded!")
+    ancestries, failures = estimate_samples(
+        concat_genotypes(file_genotypes),
+        model,
+        solver,
+        cache,
+        precision,
+        preview,
+        bootstrap,
+        block_size,
+        store,
+    )
+    results = {}
+    for sample_file, genotypes in zip(sample_files, file_genotypes):
+        ids = genotypes.sample_ids
+        results[sample_file] = (
+            {id: ancestries[id] for id in ids if id in ancestries},
+            {id: failures[id] for id in ids if id in failures},
+        )
+    return results
@@ -3,36 +3,190 @@ import os
 from typing import Optional
 
 # Imports: third party
+import numpy as np
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 
+PLOT_FORMATS = ["pdf", "png", "svg"]
+# Above this many samples the plot switches to the cohort layout, where samples are
+# not labeled individually
+MAX_LABELED_SAMPLES = 100
+# Cohorts of more samples are drawn as an image of IMAGE_SIZE pixels, averaging the
+# samples that fall in the same column, so the rendering time and the file size do
+# not grow with the number of samples
+MAX_VECTOR_SAMPLES = 2000
+IMAGE_SIZE = (400, 2000)
+LEGEND_ROWS = 10
 
-def generate_admixture_plot(data: pd.DataFrame, output_path: Optional[str] = None):
+
+def sort_samples(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Order the samples by their dominant population, in the order of the columns,
+    and by decreasing proportion of that population within each group.
+
+    :param data: <pd.DataFrame> Proportions of each population (columns) in each
+                                sample (rows).
+
+    :return: <pd.DataFrame> The same rows, reordered.
+    """
+    values = data.to_numpy()
+    dominant = values.argmax(axis=1)
+    order = np.lexsort((-values[np.arange(len(values)), dominant], dominant))
+    return data.iloc[order]
+
+
+def _colors(n_pops: int) -> np.ndarray:
+    from matplotlib import colormaps  # isort: skip
+
+    if n_pops <= 10:
+        return colormaps["tab10"](np.arange(n_pops))
+    if n_pops <= 20:
+        return colormaps["tab20"](np.arange(n_pops))
+    return colormaps["turbo"](np.linspace(0, 1, n_pops))
+
+
+def _style() -> str:
+    # The seaborn styles bundled with matplotlib were renamed in version 3.6
+    import matplotlib.style  # isort: skip
+
+    for style in ["seaborn-v0_8-whitegrid", "seaborn-whitegrid"]:
+        if style in matplotlib.style.available:
+            return style
+    return "default"
+
+
+def _plot_samples(ax, data: pd.DataFrame, colors: np.ndarray):
+    bottom = np.zeros(len(data))
+    positions = np.arange(len(data))
+    for pop, color in zip(data.columns, colors):
+        ax.bar(positions, data[pop], bottom=bottom, width=1, color=color)
+        bottom += data[pop].to_numpy()
+    ax.set_xticks(positions)
+    ax.set_xticklabels(data.index, rotation=90)
+
+
+def _fill_cohort(ax, data: pd.DataFrame, colors: np.ndarray):
+    # One filled polygon per population, stepping at every sample boundary
+    edges = np.arange(len(data) + 1)
+    cumulative = np.zeros((len(data) + 1, len(data.columns) + 1))
+    cumulative[:-1, 1:] = np.cumsum(data.to_numpy(), axis=1)
+    cumulative[-1] = cumulative[-2]
+    for k, color in enumerate(colors):
+        ax.fill_between(
+            edges,
+            cumulative[:, k],
+            cumulative[:, k + 1],
+            step="post",
+            color=color,
+            linewidth=0,
+        )
+
+
+def _image_cohort(ax, data: pd.DataFrame, colors: np.ndarray):
+    height, width = IMAGE_SIZE
+    starts = np.linspace(0, len(data), width, endpoint=False).astype(int)
+    sizes: np.ndarray = np.diff(np.append(starts, len(data)))[:, None]
+    columns = np.add.reduceat(data.to_numpy(), starts, axis=0) / sizes
+    # Population at the height of each pixel of each column
+    heights = (np.arange(height) + 0.5) / height
+    boundaries = np.cumsum(columns, axis=1)
+    pops = (heights[:, None, None] >= boundaries[None, :, :]).sum(axis=2)
+    image = colors[np.minimum(pops, len(colors) - 1)]
+    ax.imshow(
+        image,
+        origin="lower",
+        extent=(0, len(data), 0, 1),
+        aspect="auto",
+        interpolation="nearest",
+    )
+
+
+def _plot_cohort(ax, data: pd.DataFrame, colors: np.ndarray):
+    data = sort_samples(data)
+    if len(data) > MAX_VECTOR_SAMPLES:
+        _image_cohort(ax, data, colors)
+    else:
+        _fill_cohort(ax, data, colors)
+
+    # Label each group of samples with its dominant population
+    dominant = data.to_numpy().argmax(axis=1)
+    starts = np.flatnonzero(np.diff(dominant, prepend=-1))
+    ends: np.ndarray = np.append(starts[1:], len(data))
+    ax.set_xticks((starts + ends) / 2)
+    ax.set_xticklabels(data.columns[dominant[starts]], rotation=90)
+    ax.vlines(starts[1:], 0, 1, color="white", linewidth=0.5)
+    ax.set_xlim(0, len(data))
+    ax.grid(False, axis="x")
+    ax.set_xlabel(f"{len(data)} samples, grouped by dominant population")
+
+
+def generate_admixture_plot(
+    data: pd.DataFrame,
+    output_path: Optional[str] = None,
+    output_format: str = "pdf",
+    cohort: Optional[bool] = None,
+):
     """
     Generate an admixture plot from the given data.
     The function generates a stacked bar chart where each bar represents a sample
     and the segments of the bar represent the contributions from different populations.
+    Cohorts are sorted by dominant population and drawn as one filled area per
+    population or, past MAX_VECTOR_SAMPLES samples, as a fixed size image, so that
+    100,000 samples are drawn in about a second.
+
+    The figure is drawn without pyplot, on a non-interactive canvas, so it never
+    opens a window or blocks and can be used from threads and headless nodes.
 
     :param data: <pd.DataFrame> Pandas DataFrame where each row represents the
                                 proportional contribution of each population to the
                                 samples in the index.
     :param output_path: <str> Folder where to save the resulting figure.
+    :param output_format: <str> Format of the figure. Choices: pdf, png or svg.
+                                Default: pdf.
+    :param cohort: <bool> Whether to use the cohort layout. Default: when there are
+                          more than MAX_LABELED_SAMPLES samples.
+
+    :return: <matplotlib.figure.Figure> The figure.
     """
-    # Set seaborn style for better aesthetics
-    sns.set(style="whitegrid")
+    # Plotting libraries are slow to import, so they are only loaded when plotting
+    import matplotlib.style  # isort: skip
+    from matplotlib.figure import Figure  # isort: skip
+    from matplotlib.patches import Patch  # isort: skip
 
-    _fig, ax = plt.subplots(figsize=(10, 3))
+    if output_format not in PLOT_FORMATS:
+        raise ValueError(f"Unknown plot format {output_format}.")
+    if cohort is None:
+        cohort = len(data) > MAX_LABELED_SAMPLES
 
-    data.plot.bar(stacked=True, ax=ax, width=1)
+    with matplotlib.style.context(_style()):
+        fig = Figure(figsize=(12, 3) if cohort else (10, 3))
+        ax = fig.subplots()
+        colors = _colors(len(data.columns))
+        if cohort:
+            _plot_cohort(ax, data, colors)
+        else:
+            _plot_samples(ax, data, colors)
 
-    ax.spines["right"].set_visible(False)
-    ax.spines["top"].set_visible(False)
-    ax.yaxis.set_ticks_position("left")
-    ax.xaxis.set_ticks_position("bottom")
-    ax.set_xticklabels(data.index)
+        ax.set_ylim(0, 1)
+        ax.spines["right"].set_visible(False)
+        ax.spines["top"].set_visible(False)
+        ax.yaxis.set_ticks_position("left")
+        ax.xaxis.set_ticks_position("bottom")
+        ax.legend(
+            handles=[
+                Patch(color=color, label=pop)
+                for pop, color in zip(data.columns, colors)
+            ],
+            loc="upper left",
+            bbox_to_anchor=(1, 1),
+            fontsize="small",
+            # Columns of at most LEGEND_ROWS entries fit the height of the figure
+            ncol=-(-len(data.columns) // LEGEND_ROWS),
+        )
 
-    plt.tight_layout()
-    if output_path is not None:
-        plt.savefig(os.path.join(output_path, "ancestry.pdf"))
-    plt.show()
+        fig.tight_layout()
+        if output_path is not None:
+            fig.savefig(
+                os.path.join(output_path, f"ancestry.{output_format}"),
+                dpi=200,
+            )
+    return fig
@@ -0,0 +1,284 @@
+"""Discovery of the admixture models and in-process cache of the loaded ones"""
+
+# Imports: standard library
+import os
+import json
+import logging
+import threading
+from typing import Dict, List, Iterable, Optional, NamedTuple
+from collections import OrderedDict
+
+# Imports: first party
+from bundle import (
+    BUNDLE_EXTENSION,
+    ModelBundle,
+    bundle_path,
+    load_bundle,
+    bundle_fingerprint,
+    select_fingerprint,
+)
+
+# Manifest describing the models of a folder
+MANIFEST = "models.json"
+# Folder of the models shipped with the package
+MODELS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "models")
+# Environment variable with more model folders, separated like PATH
+MODELS_PATH_VARIABLE = "ADMIXTURE_MODELS"
+MODEL_EXTENSIONS = [".txt", BUNDLE_EXTENSION]
+DEFAULT_MODEL_CACHE_SIZE = 2 * 2**30
+
+
+class ModelSpec(NamedTuple):
+    """
+    Where a model is stored and how to load it.
+
+    name: <str> Name of the model.
+    path: <str> Path to its text file, whose compiled bundle is used when it is up
+                to date, or to the bundle itself when there is no text file.
+    populations: <Optional[List[str]]> Populations to keep, in this order, from a
+                                       model with more columns. Default: all.
+    build: <Optional[str]> Genome build of the model SNPs, e.g. GRCh37.
+    checksum: <Optional[str]> Fingerprint of the whole model, checked when it is
+                              loaded.
+    description: <Optional[str]> Description of the model.
+    """
+
+    name: str
+    path: str
+    populations: Optional[List[str]] = None
+    build: Optional[str] = None
+    checksum: Optional[str] = None
+    description: Optional[str] = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path) or os.path.exists(bundle_path(self.path))
+
+    def load(self) -> ModelBundle:
+        """
+        Load the model, compiling its text file into a bundle when needed, and keep
+        the populations of the spec.
+
+        :return: <ModelBundle> The model.
+        """
+        if not self.exists():
+            raise FileNotFoundError(f"The file of model {self.name} is missing.")
+        bundle = load_bundle(self.path)
+        if self.checksum is not None and bundle.fingerprint != self.checksum:
+            raise ValueError(
+                f"Model {self.name} does not match the checksum of its manifest: "
+                f"{bundle.fingerprint} instead of {self.checksum}.",
+            )
+        if self.populations is not None:
+            bundle = bundle.select(self.populations)
+        return bundle
+
+    def fingerprint(self) -> Optional[str]:
+        """
+        Fingerprint of the model read from its compiled bundle without loading it.
+
+        :return: <str> The fingerprint, the same as the one of the loaded model, or
+                       None if the model has not been compiled yet.
+        """
+        fingerprint = bundle_fingerprint(self.path)
+        if fingerprint is not None and self.populations is not None:
+            fingerprint = select_fingerprint(fingerprint, self.populations)
+        return fingerprint
+
+
+def default_model_dirs() -> List[str]:
+    """
+    Folders searched for models: those of the ADMIXTURE_MODELS environment variable
+    followed by the models shipped with the package.
+    """
+    folders = os.environ.get(MODELS_PATH_VARIABLE, "").split(os.pathsep)
+    return [folder for folder in folders if folder] + [MODELS_DIR]
+
+
+def read_manifest(folder: str) -> List[ModelSpec]:
+    """
+    Read the manifest of a model folder, a JSON object with an entry for each model
+    name giving the model file, relative to the folder, and optionally the
+    populations kept, the genome build, the checksum and a description:
+
+        {"K7b": {"file": "K7b.txt", "build": "GRCh37"}}
+
+    :param folder: <str> Model folder.
+
+    :return: <List[ModelSpec]> The models of the manifest, none if it is missing.
+    """
+    path = os.path.join(folder, MANIFEST)
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as file:
+        manifest = json.load(file)
+    specs = []
+    for name, entry in manifest.items():
+        if "file" not in entry:
+            raise ValueError(f"Model {name} of {path} has no file.")
+        specs.append(
+            ModelSpec(
+                name,
+                os.path.join(folder, entry["file"]),
+                entry.get("populations"),
+                entry.get("build"),
+                entry.get("checksum"),
+                entry.get("description"),
+            ),
+        )
+    return specs
+
+
+def discover_models(folder: str) -> List[ModelSpec]:
+    """
+    Find the models of a folder: those of its manifest, then every other text or
+    compiled model file, named after the file.
+
+    :param folder: <str> Model folder.
+
+    :return: <List[ModelSpec]> The models found.
+    """
+    specs = read_manifest(folder)
+    listed = {os.path.splitext(os.path.realpath(spec.path))[0] for spec in specs}
+    files = sorted(os.listdir(folder)) if os.path.isdir(folder) else []
+    for file_name in files:
+        stem, extension = os.path.splitext(file_name)
+        path = os.path.join(folder, file_name)
+        if extension not in MODEL_EXTENSIONS or not os.path.isfile(path):
+            continue
+        if os.path.splitext(os.path.realpath(path))[0] in listed:
+            continue
+        # A bundle is only listed on its own when there is no text file
+        if extension == BUNDLE_EXTENSION and stem + ".txt" in files:
+            continue
+        specs.append(ModelSpec(stem, path))
+    return specs
+
+
+class ModelRegistry:
+    """
+    Models available by name, discovered from a list of folders. When several
+    folders have a model with the same name, the first one is used, so user folders
+    come before the models shipped with the package.
+    """
+
+    def __init__(self, folders: Optional[Iterable[str]] = None):
+        """
+        :param folders: <Iterable[str]> Model folders searched before the default
+                                        ones. Default: only the default ones, see
+                                        default_model_dirs.
+        """
+        self.folders = list(folders or []) + default_model_dirs()
+        self.specs: Dict[str, ModelSpec] = {}
+        for folder in self.folders:
+            for spec in discover_models(folder):
+                self.specs.setdefault(spec.name, spec)
+
+    def __contains__(self, model: str) -> bool:
+        return model in self.specs
+
+    def names(self) -> List[str]:
+        return list(self.specs)
+
+    def add(self, spec: ModelSpec):
+        """
+        Make a model available under its name, replacing any model with the same
+        name.
+        """
+        self.specs[spec.name] = spec
+
+    def spec(self, model: str) -> ModelSpec:
+        """
+        Find a model by name, or by the path to its text or compiled file.
+
+        :param model: <str> Name or path of the model.
+
+        :return: <ModelSpec> The model.
+        """
+        if model in self.specs:
+            return self.specs[model]
+        if os.path.isfile(model):
+            return ModelSpec(model, model)
+        raise ValueError(
+            f"Unknown model {model}. Expected {', '.join(self.names())} or the path "
+            "to a model file",
+        )
+
+    def load(self, model: str) -> ModelBundle:
+        """
+        Load a model by name or path, see ModelSpec.load.
+        """
+        return self.spec(model).load()
+
+
+class ModelCache:
+    """
+    Models loaded in this process, so that a long-running process loads each model
+    once. Once the size of the loaded models is above max_bytes, the least recently
+    used ones are dropped, except the one just requested. Safe to use from several
+    threads.
+    """
+
+    def __init__(
+        self,
+        registry: Optional[ModelRegistry] = None,
+        max_bytes: int = DEFAULT_MODEL_CACHE_SIZE,
+    ):
+        """
+        :param registry: <ModelRegistry> Models that can be loaded.
+                                         Default: ModelRegistry().
+        :param max_bytes: <int> Size of the loaded models above which the least
+                                recently used are dropped. Default: 2 GB.
+        """
+        self.registry = registry or ModelRegistry()
+        self.max_bytes = max_bytes
+        self._models: "OrderedDict[str, ModelBundle]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, model: str) -> bool:
+        with self._lock:
+            return model in self._models
+
+    def names(self) -> List[str]:
+        """
+        Names of the loaded models, least recently used first.
+        """
+        with self._lock:
+            return list(self._models)
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(bundle.nbytes for bundle in self._models.values())
+
+    def get(self, model: str) -> ModelBundle:
+        """
+        Return a model, loading it if it is not in the cache.
+
+        :param model: <str> Name or path of the model, see ModelRegistry.spec.
+
+        :return: <ModelBundle> The model.
+        """
+        with self._lock:
+            if model in self._models:
+                self._models.move_to_end(model)
+                return self._models[model]
+        # Loaded without the lock, so that other threads keep using the models
+        # already loaded. A model loaded twice concurrently is only kept once.
+        bundle = self.registry.load(model)
+        with self._lock:
+            bundle = self._models.setdefault(model, bundle)
+            self._models.move_to_end(model)
+            self._evict()
+        return bundle
+
+    def _evict(self):
+        size = sum(bundle.nbytes for bundle in self._models.values())
+        while size > self.max_bytes and len(self._models) > 1:
+            name, bundle = self._models.popitem(last=False)
+            size -= bundle.nbytes
+            logging.info(f"Dropped model {name} from the model cache.")
+        if size > self.max_bytes:
+            logging.warning(
+                f"Model {next(iter(self._models))} takes {size / 2**20:.0f} MB, "
+                f"more than the model cache size ({self.max_bytes / 2**20:.0f} MB).",
+            )
@@ -0,0 +1,239 @@
+"""Streaming writers of ancestry estimates"""
+
+# Imports: standard library
+import os
+import glob
+import importlib.util
+from abc import ABC, abstractmethod
+from typing import IO, Set, Dict, List, Optional
+
+# Imports: third party
+import pandas as pd
+
+RESULT_FORMATS = ["csv", "parquet"]
+# Proportions are saved with this many decimals
+DECIMALS = 3
+
+
+def check_format(output_format: str):
+    """
+    Raise a ValueError if the results can not be written in the given format.
+    """
+    if output_format not in RESULT_FORMATS:
+        raise ValueError(f"Unknown result format {output_format}.")
+    if output_format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        raise ValueError("Writing parquet results requires pyarrow.")
+
+
+def _to_frame(ancestries: Dict[str, Dict[str, float]]) -> pd.DataFrame:
+    data = pd.DataFrame.from_dict(ancestries, orient="index").round(DECIMALS)
+    data.index.name = "id"
+    return data
+
+
+class ResultWriter(ABC):
+    """
+    Appends the ancestry of the samples to a result file as they are estimated, so
+    that the finished samples are kept if a run stops and the estimates do not have
+    to be held in memory until the end. A resumed writer keeps the samples already
+    written, whose ids are in sample_ids, and appends the new ones after them.
+    """
+
+    extension = ""
+
+    def __init__(self, output_dir: str):
+        """
+        :param output_dir: <str> Folder where to save the results.
+        """
+        self.path = os.path.join(output_dir, f"ancestries.{self.extension}")
+        self.columns: Optional[List[str]] = None
+        self.sample_ids: Set[str] = set()
+        self.n_written = 0
+
+    def _resume(self):
+        """
+        Keep the columns and the sample ids of the samples already written.
+        """
+        existing = self.read()
+        if len(existing.columns):
+            self.columns = list(existing.columns)
+        self.sample_ids.update(existing.index)
+
+    def write(self, ancestries: Dict[str, Dict[str, float]]):
+        """
+        Append the ancestry of some samples.
+
+        :param ancestries: <Dict[str, Dict[str, float]]> Proportion of each
+                                                         population in each sample.
+        """
+        if not ancestries:
+            return
+        data = _to_frame(ancestries)
+        if self.columns is None:
+            self.columns = list(data.columns)
+        elif set(data.columns) != set(self.columns):
+            raise ValueError(
+                f"The columns of the new samples ({', '.join(data.columns)}) differ "
+                f"from the columns of {self.path} ({', '.join(self.columns)}).",
+            )
+        self._append(data[self.columns])
+        self.sample_ids.update(data.index)
+        self.n_written += len(data)
+
+    @abstractmethod
+    def _append(self, data: pd.DataFrame):
+        """
+        Write new samples, with the columns of the previous ones.
+        """
+
+    @abstractmethod
+    def read(self) -> pd.DataFrame:
+        """
+        Read every sample written so far, including those of a resumed run.
+        """
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CsvWriter(ResultWriter):
+    """
+    Writes ancestries.csv, flushing every batch of samples as soon as it is written.
+    """
+
+    extension = "csv"
+
+    def __init__(self, output_dir: str, resume: bool = False):
+        """
+        :param output_dir: <str> Folder where to save the results.
+        :param resume: <bool> Keep the samples of a previous run instead of
+                              overwriting them. Default: False.
+        """
+        super().__init__(output_dir)
+        if resume and os.path.exists(self.path):
+            self._drop_partial_line()
+            self._resume()
+        self._file: IO[str] = open(
+            self.path,
+            "a" if resume else "w",
+            encoding="utf-8",
+            newline="",
+        )
+
+    def _drop_partial_line(self):
+        # A run stopped while writing may leave an incomplete last row
+        with open(self.path, "rb+") as file:
+            size = file.seek(0, os.SEEK_END)
+            start = max(0, size - 2**16)
+            file.seek(start)
+            tail = file.read()
+            if tail and not tail.endswith(b"\n"):
+                file.truncate(start + tail.rfind(b"\n") + 1)
+
+    def _append(self, data: pd.DataFrame):
+        data.to_csv(self._file, header=self._file.tell() == 0)
+        self._file.flush()
+
+    def read(self) -> pd.DataFrame:
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return pd.DataFrame(columns=self.columns or []).rename_axis("id")
+        return pd.read_csv(self.path, index_col="id", dtype={"id": str})
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter(ResultWriter):
+    """
+    Writes the ancestries.parquet dataset folder, one part file per batch of at
+    least row_group_size samples. Each part is written to a temporary file and then
+    renamed, so a stopped run never leaves a truncated part behind, but it loses up
+    to row_group_size samples not yet written. Requires pyarrow.
+    """
+
+    extension = "parquet"
+
+    def __init__(
+        self,
+        output_dir: str,
+        resume: bool = False,
+        row_group_size: int = 1000,
+    ):
+        """
+        :param output_dir: <str> Folder where to save the results.
+        :param resume: <bool> Keep the samples of a previous run. Default: False.
+        :param row_group_size: <int> Number of samples buffered before they are
+                                     written as a new part. Default: 1000.
+        """
+        check_format("parquet")
+        super().__init__(output_dir)
+        self.row_group_size = row_group_size
+        self._buffer: List[pd.DataFrame] = []
+        os.makedirs(self.path, exist_ok=True)
+        if resume:
+            self._resume()
+        else:
+            for part in self._parts():
+                os.remove(part)
+
+    def _parts(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.path, "part-*.parquet")))
+
+    def _append(self, data: pd.DataFrame):
+        self._buffer.append(data)
+        if sum(len(chunk) for chunk in self._buffer) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered samples as a new part.
+        """
+        if not self._buffer:
+            return
+        parts = self._parts()
+        number = int(os.path.basename(parts[-1])[5:-8]) + 1 if parts else 0
+        part_path = os.path.join(self.path, f"part-{number:05d}.parquet")
+        pd.concat(self._buffer).to_parquet(part_path + ".tmp", engine="pyarrow")
+        os.replace(part_path + ".tmp", part_path)
+        self._buffer = []
+
+    def read(self) -> pd.DataFrame:
+        parts = self._parts()
+        data = [pd.read_parquet(part, engine="pyarrow") for part in parts]
+        data += self._buffer
+        if not data:
+            return pd.DataFrame(columns=self.columns or []).rename_axis("id")
+        return pd.concat(data)
+
+    def close(self):
+        self.flush()
+
+
+def open_writer(
+    output_dir: str,
+    output_format: str = "csv",
+    resume: bool = False,
+) -> ResultWriter:
+    """
+    Open the writer of the ancestry estimates of a run.
+
+    :param output_dir: <str> Folder where to save the results.
+    :param output_format: <str> Format of the results: csv, saved as ancestries.csv,
+                                or parquet, saved as the ancestries.parquet folder.
+                                Default: csv.
+    :param resume: <bool> Keep the samples of a previous run in the same folder,
+                          see ResultWriter. Default: False.
+
+    :return: <ResultWriter> The writer.
+    """
+    if output_format == "csv":
+        return CsvWriter(output_dir, resume)
+    if output_format == "parquet":
+        return ParquetWriter(output_dir, resume)
+    raise ValueError(f"Unknown result format {output_format}.")
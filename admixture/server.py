@@ -0,0 +1,605 @@
+"""Long-running admixture service with warm models and batched estimation"""
+
+# Imports: standard library
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+from typing import Any, Dict, List, Tuple
+from collections import deque
+from urllib.parse import parse_qs, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+# Imports: third party
+import numpy as np
+
+# Imports: first party
+from bundle import ModelBundle
+from logger import load_config
+from encoding import GenotypeMatrix, concat_genotypes
+from pipeline import load_samples, estimate_samples
+from registry import ModelSpec, ModelCache, ModelRegistry
+from optimizer import PRECISIONS
+
+INPUT_FORMATS = ["23andme", "ancestry", "vcf"]
+SOLVERS = ["em", "slsqp", "trust-constr"]
+STAGES = ["upload", "load", "queue", "solve", "total"]
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    422: "Unprocessable Entity",
+    500: "Internal Server Error",
+}
+
+
+class RequestError(Exception):
+    """
+    Error reported to the client with the given HTTP status.
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Metrics:
+    """
+    Latency of the recent requests at each stage of their handling, kept in a
+    window of the last window_size values per stage.
+    """
+
+    def __init__(self, window_size: int = 1000):
+        self.started = time.monotonic()
+        self.latencies: Dict[str, deque] = {
+            stage: deque(maxlen=window_size) for stage in STAGES
+        }
+        self.batch_sizes: deque = deque(maxlen=window_size)
+        self.requests = 0
+        self.failures = 0
+
+    def record(self, stage: str, seconds: float):
+        self.latencies[stage].append(seconds)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Count, mean and percentiles, in milliseconds, of the latency of each stage.
+        """
+        stages: Dict[str, Dict[str, float]] = {}
+        for stage, values in self.latencies.items():
+            if not values:
+                stages[stage] = {"count": 0}
+                continue
+            latencies = np.array(values) * 1000
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            stages[stage] = {
+                "count": len(latencies),
+                "mean_ms": float(latencies.mean()),
+                "p50_ms": float(p50),
+                "p95_ms": float(p95),
+                "p99_ms": float(p99),
+                "max_ms": float(latencies.max()),
+            }
+        return {
+            "uptime_s": time.monotonic() - self.started,
+            "requests": self.requests,
+            "failures": self.failures,
+            "mean_batch_size": float(np.mean(self.batch_sizes or [0])),
+            "latency": stages,
+        }
+
+
+class Batcher:
+    """
+    Queue of the samples to estimate with a model and a solver. Samples submitted
+    concurrently are gathered for up to batch_window seconds, or until max_batch
+    samples are waiting, and estimated together in a single solver pass.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        models: ModelCache,
+        solver: str,
+        executor: ThreadPoolExecutor,
+        metrics: Metrics,
+        batch_window: float,
+        max_batch: int,
+        precision: str = "float64",
+    ):
+        self.model_name = model_name
+        self.models = models
+        self.solver = solver
+        self.precision = precision
+        self.executor = executor
+        self.metrics = metrics
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.in_flight = 0
+        self._ids = itertools.count()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def submit(
+        self,
+        genotypes: GenotypeMatrix,
+    ) -> Tuple[Dict[str, Dict[str, float]], Dict[str, str]]:
+        """
+        Estimate the ancestry of the given samples as part of the next batch.
+
+        :param genotypes: <GenotypeMatrix> Genotypes of the samples.
+
+        :return: <Tuple[Dict[str, Dict[str, float]], Dict[str, str]]> Ancestry of
+                                                                      each sample and
+                                                                      error message
+                                                                      of each failed
+                                                                      sample.
+        """
+        # Samples are renamed so that the ids of different requests never collide
+        ids = [f"{next(self._ids)}" for _ in genotypes.sample_ids]
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(
+            (genotypes._replace(sample_ids=ids), future, time.perf_counter()),
+        )
+        ancestries, failures = await future
+        names = dict(zip(ids, genotypes.sample_ids))
+        return (
+            {names[id]: ancestry for id, ancestry in ancestries.items()},
+            {names[id]: failure for id, failure in failures.items()},
+        )
+
+    async def _next_batch(self) -> List[Tuple[GenotypeMatrix, asyncio.Future, float]]:
+        batch = [await self.queue.get()]
+        n_samples = len(batch[0][0].sample_ids)
+        deadline = time.perf_counter() + self.batch_window
+        while n_samples < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            n_samples += len(item[0].sample_ids)
+        return batch
+
+    def _estimate(
+        self,
+        genotypes: GenotypeMatrix,
+    ) -> Tuple[Dict[str, Dict[str, float]], Dict[str, str]]:
+        # The model is taken from the cache for every batch, so that the batcher
+        # does not keep it loaded once the cache drops it
+        return estimate_samples(
+            genotypes,
+            self.models.get(self.model_name),
+            self.solver,
+            None,
+            self.precision,
+        )
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            self.in_flight = len(batch)
+            start = time.perf_counter()
+            for _, _, submitted in batch:
+                self.metrics.record("queue", start - submitted)
+            genotypes = concat_genotypes([item[0] for item in batch])
+            self.metrics.batch_sizes.append(len(genotypes.sample_ids))
+            try:
+                ancestries, failures = await loop.run_in_executor(
+                    self.executor,
+                    self._estimate,
+                    genotypes,
+                )
+            except Exception as error:  # pylint: disable=broad-except
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            finally:
+                self.metrics.record("solve", time.perf_counter() - start)
+                self.in_flight = 0
+            for item, future, _ in batch:
+                ids = item.sample_ids
+                if not future.done():
+                    future.set_result(
+                        (
+                            {id: ancestries[id] for id in ids if id in ancestries},
+                            {id: failures[id] for id in ids if id in failures},
+                        ),
+                    )
+
+
+class AdmixtureServer:
+    """
+    HTTP/1.1 server estimating the ancestry of the uploaded genotype files with
+    models kept in memory. Any model of the registry can be requested, it is loaded
+    on first use and kept in the model cache. Endpoints:
+
+    POST /estimate?model=K7b&format=23andme&solver=em&id=NAME
+        The body is the genotype file, optionally gzip compressed. The id names the
+        sample of 23andMe and AncestryDNA files. Returns the ancestry of each sample
+        and the error of each sample that could not be estimated.
+    GET /metrics
+        Queue depth, batch sizes and latency of each stage of the recent requests.
+    GET /health
+        Models loaded and available.
+    """
+
+    def __init__(
+        self,
+        models: ModelCache,
+        default_model: str,
+        threads: int = 4,
+        batch_window: float = 0.01,
+        max_batch: int = 256,
+        max_upload: int = 512 * 2**20,
+        precision: str = "float64",
+    ):
+        """
+        :param models: <ModelCache> Cache of the models served, which can be loaded
+                                    from its registry.
+        :param default_model: <str> Model used when a request does not name one.
+        :param threads: <int> Threads parsing the uploads and running the solver.
+        :param batch_window: <float> Seconds to wait for more samples to batch.
+        :param max_batch: <int> Maximum number of samples estimated together.
+        :param max_upload: <int> Maximum size of an uploaded file in bytes.
+        :param precision: <str> Floating point type of the likelihood computations.
+        """
+        self.models = models
+        self.default_model = default_model
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.metrics = Metrics()
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_upload = max_upload
+        self.precision = precision
+        self.batchers: Dict[Tuple[str, str], Batcher] = {}
+        self.pending = 0
+
+    def _batcher(self, model_name: str, solver: str) -> Batcher:
+        key = (model_name, solver)
+        if key not in self.batchers:
+            self.batchers[key] = Batcher(
+                model_name,
+                self.models,
+                solver,
+                self.executor,
+                self.metrics,
+                self.batch_window,
+                self.max_batch,
+                self.precision,
+            )
+        return self.batchers[key]
+
+    def queue_depth(self) -> Dict[str, Any]:
+        return {
+            "requests": self.pending,
+            "queued": {
+                f"{model}/{solver}": batcher.queue.qsize()
+                for (model, solver), batcher in self.batchers.items()
+            },
+            "solving": {
+                f"{model}/{solver}": batcher.in_flight
+                for (model, solver), batcher in self.batchers.items()
+            },
+        }
+
+    def _load(
+        self,
+        body: bytes,
+        input_format: str,
+        model: ModelBundle,
+        sample_id: str,
+    ) -> GenotypeMatrix:
+        # Uploads have no file name, so gzip compressed ones are told apart by their
+        # magic bytes and given the suffix from which their compression is inferred
+        suffix = ".gz" if body[:2] == b"\x1f\x8b" else ""
+        fd, path = tempfile.mkstemp(prefix="admixture-upload-", suffix=suffix)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(body)
+            genotypes = load_samples(path, input_format, model)
+        finally:
+            os.remove(path)
+        if input_format != "vcf":
+            genotypes = genotypes._replace(sample_ids=[sample_id])
+        return genotypes
+
+    async def estimate(self, query: Dict[str, str], body: bytes) -> Dict[str, Any]:
+        """
+        Estimate the ancestry of the samples of an uploaded genotype file.
+        """
+        model_name = query.get("model") or self.default_model
+        input_format = query.get("format", "23andme")
+        solver = query.get("solver", "em")
+        # Only models of the registry can be requested, not arbitrary paths
+        if model_name not in self.models.registry:
+            raise RequestError(400, f"Unknown model {model_name}.")
+        if input_format not in INPUT_FORMATS:
+            raise RequestError(400, f"Unknown input format {input_format}.")
+        if solver not in SOLVERS:
+            raise RequestError(400, f"Unknown solver {solver}.")
+
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            model = await loop.run_in_executor(
+                self.executor,
+                self.models.get,
+                model_name,
+            )
+        except (OSError, ValueError) as error:
+            logging.error(f"Failed to load model {model_name}: {error}")
+            raise RequestError(
+                500,
+                f"Could not load model {model_name}: {error}",
+            ) from error
+        try:
+            genotypes = await loop.run_in_executor(
+                self.executor,
+                self._load,
+                body,
+                input_format,
+                model,
+                query.get("id", "sample"),
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            raise RequestError(
+                422,
+                f"Could not parse the genotype file: {error}",
+            ) from error
+        self.metrics.record("load", time.perf_counter() - start)
+        if not genotypes.sample_ids:
+            raise RequestError(422, "The genotype file has no samples.")
+
+        ancestries, failures = await self._batcher(model_name, solver).submit(
+            genotypes,
+        )
+        # Proportions that are not finite can not be written as JSON, and mean the
+        # solver failed on the sample
+        for sample_id, admixture in list(ancestries.items()):
+            if not np.isfinite(list(admixture.values())).all():
+                logging.error(f"Non-finite admixture proportions for {sample_id}")
+                del ancestries[sample_id]
+                failures[sample_id] = "Non-finite admixture proportions."
+        if not ancestries:
+            raise RequestError(
+                422,
+                f"Could not estimate the ancestry of any sample: {failures}",
+            )
+        return {"model": model_name, "ancestries": ancestries, "failures": failures}
+
+    async def _read_request(
+        self,
+        reader: asyncio.StreamReader,
+    ) -> Tuple[str, str, Dict[str, str], bytes]:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise RequestError(400, "Malformed request line.")
+        method, target, _ = request_line
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > self.max_upload:
+            raise RequestError(413, f"Uploads are limited to {self.max_upload} bytes.")
+        body = await reader.readexactly(length)
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        return method, url.path, query, body
+
+    async def _route(
+        self,
+        method: str,
+        path: str,
+        query: Dict[str, str],
+        body: bytes,
+    ) -> Dict[str, Any]:
+        if path == "/estimate":
+            if method != "POST":
+                raise RequestError(405, "Use POST to upload a genotype file.")
+            return await self.estimate(query, body)
+        if method != "GET":
+            raise RequestError(405, f"Use GET for {path}.")
+        if path == "/metrics":
+            return {"queue_depth": self.queue_depth(), **self.metrics.summary()}
+        if path == "/health":
+            return {
+                "status": "ok",
+                "models": self.models.names(),
+                "available": self.models.registry.names(),
+                "model_memory": self.models.nbytes,
+            }
+        raise RequestError(404, f"Unknown path {path}.")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        start = time.perf_counter()
+        self.pending += 1
+        status = 200
+        try:
+            method, path, query, body = await self._read_request(reader)
+            self.metrics.record("upload", time.perf_counter() - start)
+            response = await self._route(method, path, query, body)
+        except RequestError as error:
+            status, response = error.status, {"error": str(error)}
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as error:
+            status, response = 400, {"error": f"Malformed request: {error}"}
+        except Exception as error:  # pylint: disable=broad-except
+            logging.exception("Failed to handle request")
+            status, response = 500, {"error": repr(error)}
+        finally:
+            self.pending -= 1
+
+        try:
+            payload = json.dumps(response, allow_nan=False).encode("utf-8")
+        except ValueError as error:
+            logging.error(f"Failed to serialize the response: {error}")
+            status = 500
+            payload = json.dumps({"error": str(error)}).encode("utf-8")
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+            + payload,
+        )
+        try:
+            await writer.drain()
+            writer.close()
+        except ConnectionError:
+            pass
+        self.metrics.requests += 1
+        self.metrics.failures += status != 200
+        self.metrics.record("total", time.perf_counter() - start)
+
+
+async def serve(server: AdmixtureServer, args: argparse.Namespace):
+    if args.socket:
+        listener = await asyncio.start_unix_server(server.handle, path=args.socket)
+        logging.info(f"Serving on unix socket {args.socket}")
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        logging.info(f"Serving on http://{args.host}:{args.port}")
+    async with listener:
+        await listener.serve_forever()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Serve ancestry estimates over HTTP with warm models.",
+    )
+    parser.add_argument(
+        "-m",
+        "--models",
+        nargs="+",
+        type=str,
+        required=True,
+        help="Models loaded at start-up, by name or path. The first one is used by "
+        "default. The other models of the registry are loaded when they are first "
+        "requested.",
+    )
+    parser.add_argument(
+        "--model-dir",
+        action="append",
+        dest="model_dirs",
+        metavar="MODEL_DIR",
+        help="Folder of user-defined models, searched before the bundled ones. Can "
+        "be repeated.",
+    )
+    parser.add_argument(
+        "--model-memory",
+        type=int,
+        help="Size in MB of the loaded models above which the least recently used "
+        "are dropped. Default: 2048",
+        default=2048,
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        help="Address to listen on. Default: 127.0.0.1",
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        help="Port to listen on. Default: 8000",
+        default=8000,
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        help="Listen on this unix socket instead of a TCP port.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Threads parsing the uploads and running the solver. Default: 4",
+        default=4,
+    )
+    parser.add_argument(
+        "--batch-window",
+        type=float,
+        help="Milliseconds to wait for concurrent requests to estimate together. "
+        "Default: 10",
+        default=10,
+    )
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        help="Maximum number of samples estimated together. Default: 256",
+        default=256,
+    )
+    parser.add_argument(
+        "--max-upload",
+        type=int,
+        help="Maximum size of an uploaded file in MB. Default: 512",
+        default=512,
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        help="Floating point type of the likelihood computations. Default: float64",
+        choices=list(PRECISIONS),
+        default="float64",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        required=False,
+        help="Path where the log file will be saved.",
+    )
+    args = parser.parse_args()
+    registry = ModelRegistry(args.model_dirs)
+    try:
+        for model_name in args.models:
+            registry.spec(model_name)
+    except ValueError as error:
+        parser.error(str(error))
+    return args
+
+
+def main():
+    args = parse_args()
+    load_config(log_dir=args.output, log_file_basename="server")
+    registry = ModelRegistry(args.model_dirs)
+    models = ModelCache(registry, args.model_memory * 2**20)
+    for model_name in args.models:
+        # Models given by path can be requested by that path
+        if model_name not in registry:
+            registry.add(ModelSpec(model_name, registry.spec(model_name).path))
+        logging.info(f"Loading admixture {model_name} model...")
+        models.get(model_name)
+    server = AdmixtureServer(
+        models,
+        args.models[0],
+        args.threads,
+        args.batch_window / 1000,
+        args.max_batch,
+        args.max_upload * 2**20,
+        args.precision,
+    )
+    try:
+        asyncio.run(serve(server, args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""Persistent genotypes and proportions of the estimated samples"""
+
+# Imports: standard library
+import os
+import hashlib
+import logging
+import tempfile
+from typing import Dict, List, Tuple, Optional, NamedTuple
+
+# Imports: third party
+import numpy as np
+
+# Imports: first party
+from bundle import ModelBundle
+from encoding import GenotypeMatrix, concat_genotypes
+
+
+class StoredSample(NamedTuple):
+    """
+    Genotypes and proportions of a sample kept in a SampleStore.
+
+    rows: <np.ndarray> Sorted model row of each SNP observed in the sample.
+    dosages: <np.ndarray> int8 count of the alternate allele at each row.
+    ancestry: <Dict[str, float]> Proportion of each population.
+    """
+
+    rows: np.ndarray
+    dosages: np.ndarray
+    ancestry: Dict[str, float]
+
+
+def merge_genotypes(
+    stored: StoredSample,
+    genotypes: GenotypeMatrix,
+    sample: int,
+) -> GenotypeMatrix:
+    """
+    Merge the genotypes of a sample with its stored genotypes. SNPs genotyped in
+    both take the new call, e.g. that of an updated genotyping file.
+
+    :param stored: <StoredSample> Stored genotypes of the sample.
+    :param genotypes: <GenotypeMatrix> New genotypes.
+    :param sample: <int> Position of the sample in genotypes.
+
+    :return: <GenotypeMatrix> Genotypes of the sample alone over both sets of SNPs.
+    """
+    dosages = genotypes.dosages[sample]
+    observed = dosages >= 0
+    # Both sets of rows are sorted and unique, so a merge sort is enough and
+    # much faster than the hashing of np.union1d
+    rows = np.concatenate([stored.rows, genotypes.rows[observed]])
+    rows.sort(kind="mergesort")
+    rows = rows[np.concatenate([[True], rows[1:] != rows[:-1]])]
+    merged: np.ndarray = np.full(len(rows), -1, dtype=np.int8)
+    merged[np.searchsorted(rows, stored.rows)] = stored.dosages
+    merged[np.searchsorted(rows, genotypes.rows[observed])] = dosages[observed]
+    return GenotypeMatrix([genotypes.sample_ids[sample]], rows, merged[None, :])
+
+
+class SampleStore:
+    """
+    Folder keeping, for each sample estimated with a model, its genotypes aligned to
+    the model rows and its proportions, one .npz file per sample and model. They are
+    all that is needed to estimate a sample again, so that when another genotyping
+    file of a sample arrives, e.g. from a second chip, only the new file is loaded
+    and aligned, its SNPs are merged with the stored ones and the solver starts from
+    the stored proportions. With merge False the samples are only saved.
+    """
+
+    def __init__(self, directory: str, merge: bool = False):
+        """
+        :param directory: <str> Folder of the store, created if needed.
+        :param merge: <bool> Merge the samples with their stored genotypes before
+                             estimating them, see merge_samples. Default: False.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.merge = merge
+
+    def _path(self, sample_id: str, fingerprint: str) -> str:
+        # Sample ids may contain any character, the file is named after their hash
+        name = hashlib.sha256(sample_id.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.directory, fingerprint, f"{name}.npz")
+
+    def get(self, sample_id: str, model: ModelBundle) -> Optional[StoredSample]:
+        """
+        Read a stored sample.
+
+        :param sample_id: <str> Id of the sample.
+        :param model: <ModelBundle> Model the sample was estimated with.
+
+        :return: <StoredSample> The sample, None if it is not in the store.
+        """
+        path = self._path(sample_id, model.fingerprint)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if str(data["sample_id"]) != sample_id:
+                    return None
+                ancestry = dict(zip(data["populations"].tolist(), data["ancestry"]))
+                return StoredSample(data["rows"], data["dosages"], ancestry)
+        except (OSError, ValueError, KeyError) as error:
+            logging.warning(f"Could not read stored sample {sample_id}: {error}")
+            return None
+
+    def put_many(
+        self,
+        genotypes: GenotypeMatrix,
+        model: ModelBundle,
+        ancestries: Dict[str, Dict[str, float]],
+    ):
+        """
+        Store the genotypes and the proportions of the estimated samples, replacing
+        any stored version of them. Each file is written to a temporary file and
+        then renamed, so readers never see a partial sample.
+
+        :param genotypes: <GenotypeMatrix> Genotypes of the samples.
+        :param model: <ModelBundle> Model the samples were estimated with.
+        :param ancestries: <Dict[str, Dict[str, float]]> Proportions of each sample,
+                                                         samples without are not
+                                                         stored.
+        """
+        folder = os.path.join(self.directory, model.fingerprint)
+        os.makedirs(folder, exist_ok=True)
+        for sample_id, dosages in zip(genotypes.sample_ids, genotypes.dosages):
+            if sample_id not in ancestries:
+                continue
+            observed = dosages >= 0
+            fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".npz")
+            try:
+                with os.fdopen(fd, "wb") as file:
+                    np.savez(
+                        file,
+                        sample_id=np.array(sample_id),
+                        rows=genotypes.rows[observed].astype(np.int64),
+                        dosages=dosages[observed],
+                        populations=np.array(model.populations),
+                        ancestry=np.array(
+                            [ancestries[sample_id][pop] for pop in model.populations],
+                        ),
+                    )
+                os.replace(tmp_path, self._path(sample_id, model.fingerprint))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def merge_samples(
+        self,
+        genotypes: GenotypeMatrix,
+        model: ModelBundle,
+    ) -> Tuple[GenotypeMatrix, Dict[str, Dict[str, float]]]:
+        """
+        Merge the genotypes of the samples already in the store with their stored
+        genotypes, see merge_genotypes.
+
+        :param genotypes: <GenotypeMatrix> New genotypes of the samples.
+        :param model: <ModelBundle> Model of the genotypes.
+
+        :return: <Tuple[GenotypeMatrix, Dict[str, Dict[str, float]]]> Merged
+                 genotypes and stored proportions of the samples that were in the
+                 store, to start the solver from.
+        """
+        matrices: List[GenotypeMatrix] = []
+        initial: Dict[str, Dict[str, float]] = {}
+        for i, sample_id in enumerate(genotypes.sample_ids):
+            stored = self.get(sample_id, model)
+            if stored is None:
+                matrices.append(genotypes.take([i]))
+                continue
+            matrices.append(merge_genotypes(stored, genotypes, i))
+            initial[sample_id] = stored.ancestry
+        if not initial:
+            return genotypes, initial
+        return concat_genotypes(matrices), initial
@@ -0,0 +1,401 @@
+"""Unsupervised estimation of allele frequencies and admixture proportions"""
+
+# Imports: standard library
+import os
+import time
+import argparse
+from typing import Any, Dict, List, Tuple, Optional
+
+# Imports: third party
+import numpy as np
+import pandas as pd
+
+# Imports: first party
+from loader import iter_vcf
+from optimizer import MIN_PROBABILITY
+
+# Frequencies and proportions are kept within [MIN_VALUE, 1 - MIN_VALUE], as in
+# ADMIXTURE, so that no genotype has a zero likelihood
+MIN_VALUE = 1e-5
+INITIAL_FST = 0.1
+# Genotypes processed at once by default. Blocks that fit in the CPU cache are more
+# than twice as fast as larger ones.
+BLOCK_GENOTYPES = 2**17
+
+
+def load_cohort(
+    vcf_path: str,
+    chunk_size: int = 10000,
+) -> Tuple[List[str], pd.DataFrame, np.ndarray]:
+    """
+    Read the genotypes of every sample at every biallelic SNP of a vcf file.
+
+    :param vcf_path: <str> Path to the vcf file, optionally gzip compressed.
+    :param chunk_size: <int> Number of records decoded at once. Default: 10000.
+
+    :return: <Tuple[List[str], pd.DataFrame, np.ndarray]> Sample ids, rsid, ref and
+                                                          alt of each SNP and the
+                                                          (n_samples, n_snps) int8
+                                                          count of alternate
+                                                          alleles, -1 where it is
+                                                          missing or not diploid.
+    """
+    sample_ids: List[str] = []
+    variants, dosages = [], []
+    for sample_ids, chunk, first, second in iter_vcf(vcf_path, chunk_size=chunk_size):
+        called = (first >= 0) & (second >= 0)
+        counts = (first == 1).astype(np.int8) + (second == 1)
+        variants.append(chunk)
+        dosages.append(np.where(called, counts, -1).astype(np.int8).T)
+    return (
+        sample_ids,
+        pd.concat(variants, ignore_index=True),
+        np.concatenate(dosages + [np.zeros((len(sample_ids), 0), np.int8)], axis=1),
+    )
+
+
+def read_matrix(path: str) -> np.ndarray:
+    """
+    Read an ADMIXTURE .P or .Q file: a whitespace-delimited matrix without header.
+    """
+    return pd.read_csv(path, sep=r"\s+", header=None, dtype=np.float64).to_numpy()
+
+
+def write_matrix(path: str, matrix: np.ndarray):
+    """
+    Write a matrix in the format of the ADMIXTURE .P and .Q files, with six
+    decimals.
+    """
+    np.savetxt(path, matrix, fmt="%.6f", delimiter=" ")
+
+
+def match_populations(reference: np.ndarray, estimate: np.ndarray) -> np.ndarray:
+    """
+    Find the order of the populations of an estimate that best matches a reference,
+    since unsupervised populations come out in an arbitrary order.
+
+    :param reference: <np.ndarray> (n, n_pops) Reference proportions, e.g. a .Q file.
+    :param estimate: <np.ndarray> (n, n_pops) Proportions of the same samples.
+
+    :return: <np.ndarray> (n_pops,) Column of the estimate matching each column of
+                          the reference, minimizing the mean absolute difference.
+    """
+    # Deferred like in optimizer, since scipy.optimize is slow to import
+    from scipy.optimize import linear_sum_assignment  # isort: skip
+
+    costs = np.abs(reference[:, :, None] - estimate[:, None, :]).mean(axis=0)
+    _, order = linear_sum_assignment(costs)
+    return order
+
+
+def _project(
+    admixture: np.ndarray,
+    frequencies: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    admixture = np.maximum(admixture, MIN_VALUE)
+    admixture /= admixture.sum(axis=1, keepdims=True)
+    return admixture, np.clip(frequencies, MIN_VALUE, 1 - MIN_VALUE)
+
+
+def _em_pass(
+    admixture: np.ndarray,
+    frequencies: np.ndarray,
+    dosages: np.ndarray,
+    totals: np.ndarray,
+    block_size: int,
+) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    One EM update of the proportions and the frequencies together, streaming over
+    blocks of SNPs. With h = Q F^T, the expected ancestry counts of each sample and
+    population are Q * (G / h) F + Q * ((2 - G) / (1 - h)) (1 - F), and those of each
+    SNP and population are F * (G / h)^T Q and (1 - F) * ((2 - G) / (1 - h))^T Q, so
+    the update is four matrix products per block, run by the multi-threaded BLAS.
+
+    :return: <Tuple[np.ndarray, np.ndarray, float]> Updated proportions and
+                                                    frequencies and log-likelihood
+                                                    of the given ones.
+    """
+    counts = np.zeros_like(admixture)
+    updated = np.empty_like(frequencies)
+    log_likelihood = 0.0
+    for start in range(0, dosages.shape[1], block_size):
+        block = slice(start, start + block_size)
+        chunk = dosages[:, block]
+        mutations = np.maximum(chunk, 0, dtype=np.float64)
+        not_mutations = np.where(chunk >= 0, 2.0, 0.0)
+        not_mutations -= mutations
+        block_frequencies = frequencies[block]
+        alt = np.maximum(admixture @ block_frequencies.T, MIN_PROBABILITY)
+        ref = np.maximum(1 - alt, MIN_PROBABILITY)
+        log_likelihood += np.vdot(mutations, np.log(alt))
+        log_likelihood += np.vdot(not_mutations, np.log(ref))
+
+        mutations /= alt
+        not_mutations /= ref
+        counts += mutations @ block_frequencies
+        counts += not_mutations @ (1 - block_frequencies)
+        alt_counts = block_frequencies * (mutations.T @ admixture)
+        ref_counts = (1 - block_frequencies) * (not_mutations.T @ admixture)
+        total_counts = alt_counts + ref_counts
+        # SNPs without any call keep their frequencies
+        updated[block] = np.divide(
+            alt_counts,
+            total_counts,
+            out=block_frequencies.copy(),
+            where=total_counts > 0,
+        )
+    return admixture * counts / totals[:, None], updated, log_likelihood
+
+
+def fit_admixture(
+    dosages: np.ndarray,
+    n_pops: int,
+    max_iter: int = 1000,
+    tol: float = 1e-4,
+    seed: int = 0,
+    block_size: Optional[int] = None,
+    n_secants: int = 3,
+    initial: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    verbose: bool = False,
+) -> Tuple[np.ndarray, np.ndarray, Dict[str, Any]]:
+    """
+    Jointly estimate the admixture proportions of the samples (Q) and the alternate
+    allele frequencies of the populations (P) from the genotypes alone, as in
+    ADMIXTURE's unsupervised mode. The EM updates of Q and P are accelerated with
+    the quasi-Newton scheme of Zhou, Alexander and Lange (2011), which approximates
+    the fixed point of the EM map from its last n_secants secants, falling back to
+    the plain EM iterate whenever the extrapolated point has a lower log-likelihood,
+    until the log-likelihood increases by less than tol.
+
+    :param dosages: <np.ndarray> (n_samples, n_snps) Count of alternate alleles of
+                                 each sample, negative where it is missing.
+    :param n_pops: <int> Number of populations (K).
+    :param max_iter: <int> Maximum number of iterations. Default: 1000.
+    :param tol: <float> Increase of the log-likelihood at which the estimation is
+                        considered converged, ADMIXTURE's default. Default: 1e-4.
+    :param seed: <int> Random seed of the initial proportions. Default: 0.
+    :param block_size: <int> Number of SNPs processed at once, which bounds the
+                             memory used to a few (n_samples, block_size) arrays.
+                             Default: BLOCK_GENOTYPES genotypes per block.
+    :param n_secants: <int> Number of secants of the quasi-Newton approximation.
+                            Default: 3.
+    :param initial: <Tuple[np.ndarray, np.ndarray]> Proportions and frequencies to
+                                                    start from, e.g. read from .Q
+                                                    and .P files. Default: random
+                                                    proportions and the cohort
+                                                    allele frequencies.
+    :param verbose: <bool> Print the log-likelihood of every iteration.
+                           Default: False.
+
+    :return: <Tuple[np.ndarray, np.ndarray, Dict[str, Any]]> (n_samples, n_pops)
+                                                             proportions,
+                                                             (n_snps, n_pops)
+                                                             frequencies and the
+                                                             iterations, EM passes,
+                                                             log-likelihood and
+                                                             convergence.
+    """
+    n_samples = dosages.shape[0]
+    block_size = block_size or max(1, BLOCK_GENOTYPES // max(n_samples, 1))
+    observed = dosages >= 0
+    totals = np.maximum(2 * observed.sum(axis=1), 1).astype(np.float64)
+    if initial is None:
+        rng = np.random.default_rng(seed)
+        admixture = rng.dirichlet(np.ones(n_pops), size=n_samples)
+        # The populations start from random frequencies around the cohort ones, as
+        # drawn by the Balding-Nichols model with a fixation index of INITIAL_FST,
+        # since identical frequencies are a saddle point that EM is slow to leave
+        alt_counts = np.where(observed, dosages, 0).sum(axis=0, dtype=np.float64)
+        cohort = alt_counts / np.maximum(2 * observed.sum(axis=0), 1)
+        cohort = np.clip(cohort, MIN_VALUE, 1 - MIN_VALUE)[:, None]
+        scale = (1 - INITIAL_FST) / INITIAL_FST
+        frequencies = rng.beta(
+            cohort * scale,
+            (1 - cohort) * scale,
+            size=(len(cohort), n_pops),
+        )
+    else:
+        admixture, frequencies = (np.array(values, np.float64) for values in initial)
+
+    # Both matrices are handled as a single vector of parameters
+    def join(admixture: np.ndarray, frequencies: np.ndarray) -> np.ndarray:
+        return np.concatenate([admixture.ravel(), frequencies.ravel()])
+
+    def split(parameters: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        admixture = parameters[: n_samples * n_pops].reshape(n_samples, n_pops)
+        return admixture, parameters[n_samples * n_pops :].reshape(-1, n_pops)
+
+    def update(parameters: np.ndarray) -> Tuple[np.ndarray, float]:
+        admixture, frequencies, log_likelihood = _em_pass(
+            *split(parameters),
+            dosages,
+            totals,
+            block_size,
+        )
+        return join(*_project(admixture, frequencies)), log_likelihood
+
+    parameters = join(*_project(admixture, frequencies))
+    secants: List[Tuple[np.ndarray, np.ndarray]] = []
+    previous = -np.inf
+    converged = False
+    iteration = 0
+    for iteration in range(1, max_iter + 1):
+        first, log_likelihood = update(parameters)
+        if verbose:
+            print(f"Iteration {iteration}: log-likelihood {log_likelihood:.4f}")
+        if log_likelihood - previous < tol:
+            converged = True
+            break
+        previous = log_likelihood
+        second, first_likelihood = update(first)
+
+        # With the secants U = F(x) - x and V = F(F(x)) - F(x) of the EM map F, the
+        # fixed point is approximated by F(x) - V (U'U - U'V)^-1 U' (x - F(x))
+        secants = (secants + [(first - parameters, second - first)])[-n_secants:]
+        first_secants = np.stack([secant for secant, _ in secants], axis=1)
+        second_secants = np.stack([secant for _, secant in secants], axis=1)
+        try:
+            coefficients = np.linalg.solve(
+                first_secants.T @ first_secants - first_secants.T @ second_secants,
+                first_secants.T @ (parameters - first),
+            )
+            proposal = join(*_project(*split(first - second_secants @ coefficients)))
+        except np.linalg.LinAlgError:
+            proposal = second
+        # One more EM step from the proposal, whose log-likelihood it evaluates
+        following, proposal_likelihood = update(proposal)
+        parameters = following if proposal_likelihood >= first_likelihood else second
+
+    admixture, frequencies = split(parameters)
+    return (
+        admixture,
+        frequencies,
+        {
+            "iterations": iteration,
+            # One pass to check convergence and three per accelerated iteration
+            "passes": 3 * iteration - 2 * converged,
+            "log_likelihood": log_likelihood,
+            "converged": converged,
+        },
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Estimate the allele frequencies (P) and admixture proportions "
+        "(Q) of a cohort without reference populations, like ADMIXTURE.",
+    )
+    parser.add_argument(
+        "input",
+        type=str,
+        help="Path to the vcf file of the cohort, optionally gzip compressed.",
+    )
+    parser.add_argument("K", type=int, help="Number of populations.")
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default=".",
+        help="Folder where to save <input>.<K>.P, <input>.<K>.Q and the sample ids "
+        "of the Q rows as <input>.<K>.samples. Default: the current folder.",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed. Default: 0")
+    parser.add_argument(
+        "--tol",
+        type=float,
+        default=1e-4,
+        help="Increase of the log-likelihood at which to stop. Default: 1e-4",
+    )
+    parser.add_argument(
+        "--max-iter",
+        type=int,
+        default=1000,
+        help="Maximum number of iterations. Default: 1000",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        help=f"Number of SNPs processed at once. Default: {BLOCK_GENOTYPES} "
+        "genotypes per block",
+    )
+    parser.add_argument(
+        "--secants",
+        type=int,
+        default=3,
+        help="Number of secants of the quasi-Newton acceleration. More secants may "
+        "take fewer iterations, at the cost of keeping two copies of P and Q per "
+        "secant in memory. Default: 3",
+    )
+    parser.add_argument(
+        "--initial",
+        type=str,
+        nargs=2,
+        metavar=("Q", "P"),
+        help="Start from the proportions and frequencies of a .Q and a .P file.",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        metavar="Q",
+        help="A .Q file of the same samples, e.g. from ADMIXTURE, to report the mean "
+        "absolute difference of the proportions with, after matching the "
+        "populations.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    start = time.perf_counter()
+    sample_ids, variants, dosages = load_cohort(args.input)
+    print(f"Loaded {len(sample_ids)} samples and {len(variants)} SNPs.")
+    initial = None
+    if args.initial is not None:
+        initial = (read_matrix(args.initial[0]), read_matrix(args.initial[1]))
+    admixture, frequencies, info = fit_admixture(
+        dosages,
+        args.K,
+        max_iter=args.max_iter,
+        tol=args.tol,
+        seed=args.seed,
+        block_size=args.block_size,
+        n_secants=args.secants,
+        initial=initial,
+        verbose=True,
+    )
+    status = "Converged" if info["converged"] else "Stopped without converging"
+    print(
+        f"{status} after {info['iterations']} iterations, log-likelihood "
+        f"{info['log_likelihood']:.4f}, in {time.perf_counter() - start:.1f}s.",
+    )
+
+    name = os.path.basename(args.input)
+    for extension in [".gz", ".vcf"]:
+        if name.endswith(extension):
+            name = name[: -len(extension)]
+    prefix = os.path.join(args.output, f"{name}.{args.K}")
+    os.makedirs(args.output, exist_ok=True)
+    write_matrix(f"{prefix}.Q", admixture)
+    write_matrix(f"{prefix}.P", frequencies)
+    with open(f"{prefix}.samples", "w", encoding="utf-8") as file:
+        file.write("\n".join(sample_ids) + "\n")
+    print(f"Saved {prefix}.Q, {prefix}.P and {prefix}.samples")
+
+    if args.compare is not None:
+        reference = read_matrix(args.compare)
+        if reference.shape != admixture.shape:
+            raise ValueError(
+                f"{args.compare} has shape {reference.shape}, expected "
+                f"{admixture.shape}.",
+            )
+        order = match_populations(reference, admixture)
+        difference = np.abs(reference - admixture[:, order])
+        print(
+            f"Compared to {args.compare}: mean absolute difference "
+            f"{difference.mean():.4f}, max {difference.max():.4f}, populations "
+            f"matched as columns {order.tolist()}.",
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Benchmark the vectorized cross_reference against the original row-wise version"""
+
+# Imports: standard library
+import os
+import sys
+import time
+import argparse
+from typing import Tuple
+
+# Imports: third party
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "admixture"))
+
+# Imports: first party
+from optimizer import cross_reference  # noqa: E402
+
+BASES = np.array(list("ACGT"))
+
+
+def cross_reference_apply(
+    sample: pd.DataFrame,
+    model: pd.DataFrame,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Original implementation of cross_reference based on row-wise DataFrame.apply,
+    kept as a reference for timing and correctness.
+    """
+    df = sample.merge(model, left_on="rsid", right_on="rsid")
+    df = df[
+        np.logical_or(
+            df.apply(lambda x: x.alt in x.genotype, axis=1),
+            df.apply(lambda x: x.ref in x.genotype, axis=1),
+        )
+    ]
+    df = df.reset_index(drop=True)
+    columns = model.columns[3:]
+    df["mutation"] = df.apply(lambda x: x.genotype.count(x.alt), axis=1)
+    df["not_mutation"] = 2 - df["mutation"]
+    return df[columns], df[["mutation", "not_mutation"]]
+
+
+def make_data(
+    n_snps: int,
+    n_pops: int,
+    seed: int = 0,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    rng = np.random.default_rng(seed)
+    rsids = np.array([f"rs{i}" for i in range(n_snps)])
+    ref = BASES[rng.integers(0, 4, n_snps)]
+    alt = BASES[(np.searchsorted(BASES, ref) + rng.integers(1, 4, n_snps)) % 4]
+    model = pd.DataFrame({"rsid": rsids, "ref": ref, "alt": alt})
+    frequencies = rng.random((n_snps, n_pops))
+    for k in range(n_pops):
+        model[f"POP{k}"] = frequencies[:, k]
+
+    # The sample covers most of the model SNPs plus some unknown ones and includes
+    # no-calls, haploid calls and alleles that match neither ref nor alt
+    keep = rng.random(n_snps) < 0.9
+    first = BASES[rng.integers(0, 4, n_snps)]
+    second = BASES[rng.integers(0, 4, n_snps)]
+    genotypes = np.char.add(first, second).astype(object)
+    genotypes[rng.random(n_snps) < 0.02] = "--"
+    haploid = rng.random(n_snps) < 0.02
+    genotypes[haploid] = first[haploid]
+    sample = pd.DataFrame({"rsid": rsids[keep], "genotype": genotypes[keep]})
+    extra = pd.DataFrame(
+        {
+            "rsid": [f"i{i}" for i in range(n_snps // 10)],
+            "genotype": "AA",
+        },
+    )
+    sample = pd.concat([sample, extra], ignore_index=True)
+    return sample, model
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--snps", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--pops", type=int, default=26)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'snps':>10} {'apply (s)':>12} {'vectorized (s)':>15} {'speedup':>8}")
+    for n_snps in args.snps:
+        sample, model = make_data(n_snps, args.pops)
+
+        start = time.perf_counter()
+        df, mutations = cross_reference_apply(sample, model)
+        apply_time = time.perf_counter() - start
+
+        vectorized_time = np.inf
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            frequencies, dosages = cross_reference(sample, model)
+            vectorized_time = min(vectorized_time, time.perf_counter() - start)
+
+        assert np.array_equal(mutations["mutation"].to_numpy(), dosages)
+        assert np.array_equal(df.to_numpy(), frequencies)
+        print(
+            f"{n_snps:>10} {apply_time:>12.3f} {vectorized_time:>15.3f} "
+            f"{apply_time / vectorized_time:>7.1f}x",
+        )
+
+
+if __name__ == "__main__":
+    main()
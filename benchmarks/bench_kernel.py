@@ -0,0 +1,127 @@
+"""Benchmark the likelihood and gradient evaluations, compiled against NumPy"""
+
+# Imports: standard library
+import os
+import sys
+import time
+import argparse
+
+# Imports: third party
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "admixture"))
+
+# Imports: first party
+import kernels  # noqa: E402
+from optimizer import PRECISIONS, score_admixture  # noqa: E402
+
+
+def make_data(n_snps: int, n_pops: int, seed: int = 0):
+    """
+    Random frequencies and the allele counts of a sample drawn from random
+    admixture proportions.
+    """
+    rng = np.random.default_rng(seed)
+    frequencies = rng.uniform(0.001, 0.999, (n_snps, n_pops))
+    mutations = rng.binomial(2, frequencies @ rng.dirichlet(np.ones(n_pops)))
+    return frequencies, np.asarray(mutations, dtype=np.int64)
+
+
+def evaluations_per_second(
+    frequencies: np.ndarray,
+    mutations: np.ndarray,
+    compiled: bool,
+    seconds: float,
+):
+    """
+    Evaluate the score and its gradient at random proportions for about the given
+    time, after a first evaluation that compiles the kernel.
+
+    :return: Evaluations per second, time of the first evaluation and the score and
+             gradient at the uniform proportions.
+    """
+    os.environ[kernels.KERNELS_VARIABLE] = "1" if compiled else "0"
+    score = score_admixture(frequencies, mutations, gradient=True)
+    n_pops = frequencies.shape[1]
+    uniform = np.full(n_pops, 1 / n_pops)
+    start = time.perf_counter()
+    result = score(uniform)
+    first = time.perf_counter() - start
+
+    proportions = np.random.default_rng(1).dirichlet(np.ones(n_pops), 64)
+    evaluations = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        score(proportions[evaluations % len(proportions)])
+        evaluations += 1
+    return evaluations / (time.perf_counter() - start), first, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--snps",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000],
+    )
+    parser.add_argument(
+        "--pops",
+        type=int,
+        nargs="+",
+        default=[7, 26],
+        help="Numbers of populations, e.g. 7 like K7b and 26 like the 1000 Genomes "
+        "populations.",
+    )
+    parser.add_argument("--precisions", nargs="+", default=["float64", "float32"])
+    parser.add_argument(
+        "--seconds",
+        type=float,
+        default=2,
+        help="Time spent evaluating each configuration.",
+    )
+    args = parser.parse_args()
+    if not kernels.kernels_enabled():
+        sys.exit("Numba is not installed or the kernels are disabled.")
+    # Time the kernel at every size, including those where NumPy is used by default
+    min_serial_snps = kernels.MIN_SERIAL_SNPS
+    kernels.MIN_SERIAL_SNPS = 0
+
+    print(
+        f"{'snps':>10} {'pops':>5} {'precision':>9} {'numpy evals/s':>14} "
+        f"{'numba evals/s':>14} {'speedup':>8} {'first numba (s)':>16} "
+        f"{'default':>8}",
+    )
+    for n_snps in args.snps:
+        kernels.MIN_SERIAL_SNPS = min_serial_snps
+        default = "numba" if kernels.score_kernel(n_snps) else "numpy"
+        kernels.MIN_SERIAL_SNPS = 0
+        for n_pops in args.pops:
+            frequencies, mutations = make_data(n_snps, n_pops)
+            for precision in args.precisions:
+                typed = frequencies.astype(PRECISIONS[precision])
+                numpy_rate, _, expected = evaluations_per_second(
+                    typed,
+                    mutations,
+                    False,
+                    args.seconds,
+                )
+                numba_rate, first, result = evaluations_per_second(
+                    typed,
+                    mutations,
+                    True,
+                    args.seconds,
+                )
+                # float32 products are rounded by NumPy but not by the kernel
+                rtol = 1e-9 if precision == "float64" else 1e-4
+                assert np.isclose(result[0], expected[0], rtol=rtol)
+                assert np.allclose(result[1], expected[1], rtol=rtol)
+                print(
+                    f"{n_snps:>10} {n_pops:>5} {precision:>9} {numpy_rate:>14.1f} "
+                    f"{numba_rate:>14.1f} {numba_rate / numpy_rate:>8.2f} "
+                    f"{first:>16.3f} {default:>8}",
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Benchmark the likelihood read from the model block by block against in memory"""
+
+# Imports: standard library
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+# Imports: third party
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "admixture"))
+
+# Imports: first party
+from bundle import ModelBundle, read_bundle, write_bundle  # noqa: E402
+from optimizer import score_admixture, model_frequencies  # noqa: E402
+
+
+def peak_rss() -> float:
+    """
+    Peak resident memory of this process in MB. On Linux it is read from VmHWM,
+    since ru_maxrss keeps the peak of the parent across the exec of a subprocess.
+    """
+    try:
+        with open("/proc/self/status", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 2**20 if sys.platform == "darwin" else usage / 2**10
+
+
+def make_data(n_snps: int, n_pops: int, folder: str, seed: int = 0):
+    """
+    Write a bundle with random frequencies, and the model rows of a sample covering
+    90% of them with its allele counts, drawn from random admixture proportions.
+    """
+    rng = np.random.default_rng(seed)
+    frequencies = rng.random((n_snps, n_pops), dtype=np.float32)
+    bundle = ModelBundle(
+        np.char.add(b"rs", np.arange(n_snps).astype("S10")),
+        np.tile(np.array([ord("A"), ord("G")], dtype=np.uint8), (n_snps, 1)),
+        frequencies,
+        [f"POP{k}" for k in range(n_pops)],
+    )
+    write_bundle(bundle, os.path.join(folder, "model.bundle"))
+    rows: np.ndarray = np.flatnonzero(rng.random(n_snps) < 0.9).astype(np.int32)
+    probabilities = frequencies[rows] @ rng.dirichlet(np.ones(n_pops))
+    mutations = np.asarray(rng.binomial(2, probabilities), dtype=np.int8)
+    np.save(os.path.join(folder, "rows.npy"), rows)
+    np.save(os.path.join(folder, "mutations.npy"), mutations)
+
+
+def measure(folder: str, block_size: int, evaluations: int, precision: str):
+    """
+    Time the evaluations of the log-likelihood and its gradient, in memory when
+    block_size is 0, and print the results as JSON. Run in a fresh process so that
+    its peak RSS only includes this measurement.
+    """
+    model = read_bundle(os.path.join(folder, "model.bundle"))
+    rows = np.load(os.path.join(folder, "rows.npy"))
+    mutations = np.load(os.path.join(folder, "mutations.npy"))
+    baseline = peak_rss()
+
+    start = time.perf_counter()
+    frequencies = model_frequencies(model, rows, precision, block_size or None)
+    score = score_admixture(frequencies, mutations, gradient=True)
+    admixture = np.full(len(model.populations), 1 / len(model.populations))
+    for _ in range(evaluations):
+        value, jacobian = score(admixture)
+        admixture = np.maximum(admixture - 1e-9 * jacobian, 1e-6)
+        admixture /= admixture.sum()
+    elapsed = time.perf_counter() - start
+    print(
+        json.dumps(
+            {
+                "seconds": elapsed,
+                "evaluations_per_second": evaluations / elapsed,
+                "peak_rss_mb": peak_rss(),
+                "baseline_rss_mb": baseline,
+                "score": float(value),
+            },
+        ),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--snps",
+        type=int,
+        nargs="+",
+        default=[1_000_000, 2_000_000, 5_000_000],
+    )
+    parser.add_argument("--pops", type=int, default=7)
+    parser.add_argument(
+        "--block-sizes",
+        type=int,
+        nargs="+",
+        default=[2**14, 2**16, 2**18],
+        help="Block sizes to time, 0 for the in-memory likelihood, which is always "
+        "timed too.",
+    )
+    parser.add_argument("--evaluations", type=int, default=10)
+    parser.add_argument("--precision", default="float64")
+    parser.add_argument("--measure", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(args.measure, args.block_sizes[0], args.evaluations, args.precision)
+        return
+
+    print(
+        f"{'snps':>10} {'block size':>11} {'evals/s':>8} {'peak RSS (MB)':>14} "
+        f"{'above start (MB)':>17}",
+    )
+    for n_snps in args.snps:
+        with tempfile.TemporaryDirectory() as folder:
+            make_data(n_snps, args.pops, folder)
+            scores = []
+            for block_size in [0] + [size for size in args.block_sizes if size]:
+                output = subprocess.run(
+                    [
+                        sys.executable,
+                        __file__,
+                        "--measure",
+                        folder,
+                        "--block-sizes",
+                        str(block_size),
+                        "--evaluations",
+                        str(args.evaluations),
+                        "--precision",
+                        args.precision,
+                    ],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                result = json.loads(output)
+                scores.append(result["score"])
+                print(
+                    f"{n_snps:>10} {block_size or 'in memory':>11} "
+                    f"{result['evaluations_per_second']:>8.2f} "
+                    f"{result['peak_rss_mb']:>14.0f} "
+                    f"{result['peak_rss_mb'] - result['baseline_rss_mb']:>17.0f}",
+                )
+            assert np.allclose(scores, scores[0], rtol=1e-9)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark the import time of the admixture CLI against importing everything"""
+
+# Imports: standard library
+import os
+import sys
+import argparse
+import subprocess
+from typing import Dict, List
+
+ADMIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "admixture"
+)
+
+# Modules the CLI imported at start-up before they were deferred to the code paths
+# using them, imported together with the CLI to reproduce the original cost
+EAGER_MODULES = ["plot", "seaborn", "matplotlib.pyplot", "scipy.optimize"]
+HEAVY_MODULES = ["pandas", "scipy", "matplotlib", "seaborn"]
+
+
+def import_times(modules: List[str]) -> Dict[str, float]:
+    """
+    Import the modules in a fresh interpreter with -X importtime.
+
+    :param modules: <List[str]> Modules to import, in order.
+
+    :return: <Dict[str, float]> Cumulative import time of every module imported, in
+                                milliseconds.
+    """
+    code = f"import sys; sys.path.insert(0, {ADMIXTURE_DIR!r}); " + "; ".join(
+        f"import {module}" for module in modules
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "MPLBACKEND": "Agg"},
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if not line.startswith("import time:") or len(fields) != 3:
+            continue
+        if fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1]) / 1000
+    return times
+
+
+def total_time(times: Dict[str, float], modules: List[str]) -> float:
+    """
+    Time spent importing the given modules and everything they imported.
+    """
+    return sum(times.get(module, 0) for module in modules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        help="Fail if the CLI takes longer than this many milliseconds to import.",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for label, modules in [
+        ("lazy", ["admixture"]),
+        ("eager", ["admixture"] + EAGER_MODULES),
+    ]:
+        runs = [import_times(modules) for _ in range(args.repeats)]
+        totals = [total_time(times, modules) for times in runs]
+        best = runs[totals.index(min(totals))]
+        results[label] = min(totals)
+        loaded = [module for module in HEAVY_MODULES if module in best]
+        print(
+            f"{label:>6}: {min(totals):8.1f} ms (best of {args.repeats}), "
+            f"heavy modules: {', '.join(loaded) or 'none'}",
+        )
+    print(f"speedup: {results['eager'] / results['lazy']:.1f}x")
+
+    if args.budget is not None and results["lazy"] > args.budget:
+        sys.exit(
+            f"Import time {results['lazy']:.1f} ms is over the {args.budget} ms budget",
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""Time the admixture pipeline on synthetic data across scales and check its accuracy"""
+
+# Imports: standard library
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import Any, Dict, List, Tuple, Callable
+
+# Imports: third party
+import numpy as np
+import pandas as pd
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ADMIXTURE_DIR = os.path.join(BENCHMARKS_DIR, "..", "admixture")
+sys.path.insert(0, ADMIXTURE_DIR)
+
+# Imports: first party
+from bundle import compile_model  # noqa: E402
+from loader import vcf, ancestry, load_model, twenty_three, vcf_genotypes  # noqa: E402
+from optimizer import (  # noqa: E402
+    align_samples,
+    cross_reference,
+    estimate_ancestry,
+    estimate_ancestry_batch,
+)
+from synthetic import make_dataset  # noqa: E402
+
+LOADERS = {"23andme": twenty_three, "ancestry": ancestry}
+# Number of SNPs at which the accuracy tolerance applies as given
+REFERENCE_SNPS = 1000
+
+
+def timed(function: Callable, *args, **kwargs) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def accuracy(
+    estimates: Dict[str, Dict[str, float]],
+    sample_ids: List[str],
+    proportions: np.ndarray,
+    populations: List[str],
+) -> Dict[str, float]:
+    """
+    Mean and maximum absolute error of the estimated proportions of the samples
+    that were estimated.
+    """
+    rows = [i for i, sample_id in enumerate(sample_ids) if sample_id in estimates]
+    estimated = np.array(
+        [[estimates[sample_ids[i]][pop] for pop in populations] for i in rows],
+    ).reshape(len(rows), len(populations))
+    errors = np.abs(estimated - proportions[rows])
+    return {
+        "samples": len(rows),
+        "mean_abs_error": float(errors.mean()) if len(rows) else float("nan"),
+        "max_abs_error": float(errors.max()) if len(rows) else float("nan"),
+    }
+
+
+def run_cli(
+    model_path: str,
+    input_paths: List[str],
+    input_format: str,
+    output: str,
+    precision: str,
+) -> Tuple[Dict[str, Dict[str, float]], float]:
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable,
+            os.path.join(ADMIXTURE_DIR, "admixture.py"),
+            "-m",
+            model_path,
+            "-i",
+            *input_paths,
+            "-if",
+            input_format,
+            "--no-cache",
+            "--no-plot",
+            "--precision",
+            precision,
+            "-o",
+            output,
+        ],
+        check=True,
+        capture_output=True,
+        env={**os.environ, "MPLBACKEND": "Agg"},
+    )
+    elapsed = time.perf_counter() - start
+    data = pd.read_csv(os.path.join(output, "ancestries.csv"), index_col="id")
+    return data.to_dict(orient="index"), elapsed
+
+
+def run_case(
+    folder: str,
+    n_snps: int,
+    n_pops: int,
+    n_samples: int,
+    input_format: str,
+    max_single: int,
+    cli: bool,
+    seed: int,
+    precision: str = "float64",
+) -> Dict[str, Any]:
+    """
+    Generate a dataset and time every stage of the pipeline on it.
+    """
+    model_path, input_paths, sample_ids, proportions = make_dataset(
+        folder,
+        n_snps,
+        n_pops,
+        n_samples,
+        input_format,
+        seed,
+    )
+    timings: Dict[str, float] = {}
+    errors: Dict[str, Dict[str, float]] = {}
+
+    _, timings["compile_model"] = timed(compile_model, model_path)
+    model, timings["load_model"] = timed(load_model, model_path)
+    populations = model.populations
+
+    # Loaders, and the per sample DataFrames used by the single sample functions
+    single_ids = sample_ids[:max_single]
+    if input_format == "vcf":
+        genotypes, timings["load_samples"] = timed(
+            vcf_genotypes,
+            input_paths[0],
+            model,
+        )
+        samples = vcf(input_paths[0], single_ids)
+    else:
+        start = time.perf_counter()
+        samples = {}
+        for path in input_paths:
+            samples.update(LOADERS[input_format](path, model.index))
+        timings["load_samples"] = time.perf_counter() - start
+        genotypes, timings["align_samples"] = timed(align_samples, samples, model)
+        samples = {sample_id: samples[sample_id] for sample_id in single_ids}
+
+    start = time.perf_counter()
+    for sample in samples.values():
+        cross_reference(sample, model)
+    timings["cross_reference_per_sample"] = (time.perf_counter() - start) / len(
+        samples,
+    )
+
+    single = {}
+    start = time.perf_counter()
+    for sample_id, sample in samples.items():
+        single[sample_id] = estimate_ancestry(sample, model, precision=precision)
+    timings["estimate_ancestry_per_sample"] = (time.perf_counter() - start) / len(
+        samples,
+    )
+    errors["estimate_ancestry"] = accuracy(
+        single,
+        sample_ids,
+        proportions,
+        populations,
+    )
+
+    batch, timings["estimate_ancestry_batch"] = timed(
+        estimate_ancestry_batch,
+        genotypes,
+        model,
+        precision=precision,
+    )
+    errors["estimate_ancestry_batch"] = accuracy(
+        batch,
+        sample_ids,
+        proportions,
+        populations,
+    )
+
+    if cli:
+        estimates, timings["cli"] = run_cli(
+            model_path,
+            input_paths,
+            input_format,
+            os.path.join(folder, "output"),
+            precision,
+        )
+        errors["cli"] = accuracy(estimates, sample_ids, proportions, populations)
+
+    return {
+        "snps": n_snps,
+        "pops": n_pops,
+        "samples": n_samples,
+        "format": input_format,
+        "precision": precision,
+        "timings_s": timings,
+        "accuracy": errors,
+    }
+
+
+def metadata(args: argparse.Namespace) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BENCHMARKS_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "arguments": vars(args),
+    }
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str):
+    """
+    Print the time of each stage relative to a previous run of the suite.
+    """
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = json.load(file)
+    previous = {
+        (case["snps"], case["pops"], case["samples"], case["format"]): case
+        for case in baseline["results"]
+    }
+    print(f"\nCompared to {baseline_path} ({baseline['metadata']['commit']}):")
+    for case in results:
+        key = (case["snps"], case["pops"], case["samples"], case["format"])
+        if key not in previous:
+            continue
+        ratios = [
+            f"{stage} {previous[key]['timings_s'][stage] / seconds:.2f}x"
+            for stage, seconds in case["timings_s"].items()
+            if stage in previous[key]["timings_s"] and seconds > 0
+        ]
+        print(f"{key}: " + ", ".join(ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--snps", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--samples", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--pops", type=int, default=7)
+    parser.add_argument(
+        "--formats",
+        nargs="+",
+        default=["23andme", "ancestry", "vcf"],
+        choices=["23andme", "ancestry", "vcf"],
+    )
+    parser.add_argument(
+        "--max-single",
+        type=int,
+        default=10,
+        help="Samples timed with the single sample functions.",
+    )
+    parser.add_argument("--skip-cli", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Fail if the mean absolute error of the proportions is higher. It is "
+        "the limit for 1000 SNPs and shrinks with the square root of the SNPs.",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="float64",
+        choices=["float64", "float32"],
+        help="Floating point type of the likelihood computations.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="bench_suite.json")
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help="Results of a previous run to compare the timings with.",
+    )
+    args = parser.parse_args()
+
+    results = []
+    failed = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for input_format in args.formats:
+            for n_snps in args.snps:
+                for n_samples in args.samples:
+                    case = run_case(
+                        os.path.join(workdir, f"{input_format}-{n_snps}-{n_samples}"),
+                        n_snps,
+                        args.pops,
+                        n_samples,
+                        input_format,
+                        args.max_single,
+                        not args.skip_cli,
+                        args.seed,
+                        args.precision,
+                    )
+                    results.append(case)
+                    timings = ", ".join(
+                        f"{stage} {seconds:.3f}s"
+                        for stage, seconds in case["timings_s"].items()
+                    )
+                    print(
+                        f"{input_format} {n_snps} snps {n_samples} samples: {timings}"
+                    )
+                    # The error of the estimates shrinks with the number of SNPs
+                    limit = args.tolerance * np.sqrt(REFERENCE_SNPS / n_snps)
+                    for name, errors in case["accuracy"].items():
+                        print(
+                            f"\t{name}: mean abs error "
+                            f"{errors['mean_abs_error']:.4f}, max "
+                            f"{errors['max_abs_error']:.4f}",
+                        )
+                        if not errors["mean_abs_error"] <= limit:
+                            failed.append(f"{input_format} {n_snps} {n_samples} {name}")
+
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump({"metadata": metadata(args), "results": results}, file, indent=2)
+    print(f"Saved results to {args.output}")
+    if args.baseline is not None:
+        compare(results, args.baseline)
+    if failed:
+        sys.exit(f"Mean absolute error above the tolerance: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""Synthetic admixture models and admixed genotype files with known proportions"""
+
+# Imports: standard library
+import os
+from typing import List, Tuple
+
+# Imports: third party
+import numpy as np
+import pandas as pd
+
+BASES = np.array(list("ACGT"))
+# Genotype fields of a vcf record by dosage, the last one being a missing call
+VCF_GENOTYPES = np.array(["0|0", "0|1", "1|1", "./."])
+
+
+def make_model(
+    n_snps: int,
+    n_pops: int,
+    fst: float = 0.1,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Generate a model under the Balding-Nichols model: the alternate allele frequency
+    of each population is drawn from a Beta distribution around an ancestral
+    frequency, with a divergence of fst between populations.
+
+    :param n_snps: <int> Number of SNPs.
+    :param n_pops: <int> Number of populations.
+    :param fst: <float> Fixation index of the populations. Default: 0.1.
+    :param seed: <int> Random seed. Default: 0.
+
+    :return: <pd.DataFrame> Model with the rsid, ref, alt and frequency columns.
+    """
+    rng = np.random.default_rng(seed)
+    ref = rng.integers(0, 4, n_snps)
+    alt = (ref + rng.integers(1, 4, n_snps)) % 4
+    ancestral = rng.uniform(0.05, 0.95, n_snps)[:, None]
+    scale = (1 - fst) / fst
+    frequencies = rng.beta(
+        ancestral * scale,
+        (1 - ancestral) * scale,
+        size=(n_snps, n_pops),
+    )
+    model = pd.DataFrame(
+        {
+            "rsid": [f"rs{i + 1}" for i in range(n_snps)],
+            "ref": BASES[ref],
+            "alt": BASES[alt],
+        },
+    )
+    columns = pd.DataFrame(
+        np.clip(frequencies, 0.001, 0.999).round(6),
+        columns=[f"POP{k}" for k in range(n_pops)],
+    )
+    return pd.concat([model, columns], axis=1)
+
+
+def write_model(model: pd.DataFrame, path: str):
+    """
+    Write a model as a whitespace-delimited text file.
+    """
+    model.to_csv(path, sep=" ", index=False)
+
+
+def make_proportions(
+    n_samples: int,
+    n_pops: int,
+    alpha: float = 0.5,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Draw the admixture proportions of each sample from a Dirichlet distribution.
+
+    :return: <np.ndarray> (n_samples, n_pops) Proportions.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.dirichlet(np.full(n_pops, alpha), size=n_samples)
+
+
+def make_dosages(
+    model: pd.DataFrame,
+    proportions: np.ndarray,
+    missing: float = 0.02,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Draw the count of alternate alleles of each sample at each SNP from the
+    admixture likelihood model.
+
+    :param model: <pd.DataFrame> Model as generated by make_model.
+    :param proportions: <np.ndarray> (n_samples, n_pops) Proportions of each sample.
+    :param missing: <float> Fraction of missing calls. Default: 0.02.
+    :param seed: <int> Random seed. Default: 0.
+
+    :return: <np.ndarray> (n_samples, n_snps) int8 dosages, -1 where missing.
+    """
+    rng = np.random.default_rng(seed)
+    frequencies = model[model.columns[3:]].to_numpy()
+    dosages = np.asarray(rng.binomial(2, proportions @ frequencies.T), dtype=np.int8)
+    dosages[rng.random(dosages.shape) < missing] = -1
+    return dosages
+
+
+def _genotype_strings(
+    model: pd.DataFrame,
+    dosages: np.ndarray,
+    no_call: str,
+) -> np.ndarray:
+    ref = model["ref"].to_numpy().astype(object)
+    alt = model["alt"].to_numpy().astype(object)
+    genotypes = np.where(dosages == 0, ref + ref, alt + alt)
+    genotypes = np.where(dosages == 1, ref + alt, genotypes)
+    return np.where(dosages < 0, no_call, genotypes)
+
+
+def write_23andme(
+    model: pd.DataFrame,
+    dosages: np.ndarray,
+    folder: str,
+    extra_snps: float = 0.1,
+) -> List[str]:
+    """
+    Write one 23andMe file per sample. Every file also has SNPs that are not in the
+    model.
+
+    :param model: <pd.DataFrame> Model as generated by make_model.
+    :param dosages: <np.ndarray> (n_samples, n_snps) Dosages of each sample.
+    :param folder: <str> Folder where to save the files.
+    :param extra_snps: <float> Number of SNPs not in the model, relative to the
+                               model size. Default: 0.1.
+
+    :return: <List[str]> Path of each file.
+    """
+    return _write_arrays(model, dosages, folder, "23andme", extra_snps)
+
+
+def write_ancestry(
+    model: pd.DataFrame,
+    dosages: np.ndarray,
+    folder: str,
+    extra_snps: float = 0.1,
+) -> List[str]:
+    """
+    Write one AncestryDNA file per sample, see write_23andme.
+    """
+    return _write_arrays(model, dosages, folder, "ancestry", extra_snps)
+
+
+def _write_arrays(
+    model: pd.DataFrame,
+    dosages: np.ndarray,
+    folder: str,
+    input_format: str,
+    extra_snps: float,
+) -> List[str]:
+    os.makedirs(folder, exist_ok=True)
+    n_extra = int(len(model) * extra_snps)
+    rsids = np.concatenate([model["rsid"], [f"i{i}" for i in range(n_extra)]])
+    positions = np.arange(1, len(rsids) + 1)
+    no_call = "--" if input_format == "23andme" else "00"
+    paths = []
+    for i, sample_dosages in enumerate(dosages):
+        genotypes = _genotype_strings(model, sample_dosages, no_call)
+        genotypes = np.concatenate([genotypes, np.full(n_extra, "AA", dtype=object)])
+        data = pd.DataFrame({"rsid": rsids, "chromosome": 1, "position": positions})
+        if input_format == "23andme":
+            header = "# rsid\tchromosome\tposition\tgenotype\n"
+            data["genotype"] = genotypes
+        else:
+            header = "rsid\tchromosome\tposition\tallele1\tallele2\n"
+            data["allele1"] = pd.Series(genotypes).str[0]
+            data["allele2"] = pd.Series(genotypes).str[1]
+        path = os.path.join(folder, f"sample{i}.txt")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(header)
+            data.to_csv(file, sep="\t", header=False, index=False)
+        paths.append(path)
+    return paths
+
+
+def write_vcf(
+    model: pd.DataFrame,
+    dosages: np.ndarray,
+    path: str,
+    flipped: float = 0.1,
+    seed: int = 0,
+    chunk_size: int = 10000,
+) -> List[str]:
+    """
+    Write the samples in a single vcf file. Some SNPs have their ref and alt
+    alleles swapped with respect to the model, as happens across references.
+
+    :param model: <pd.DataFrame> Model as generated by make_model.
+    :param dosages: <np.ndarray> (n_samples, n_snps) Dosages of each sample.
+    :param path: <str> Path of the vcf file.
+    :param flipped: <float> Fraction of SNPs with swapped alleles. Default: 0.1.
+    :param seed: <int> Random seed. Default: 0.
+    :param chunk_size: <int> Number of records formatted at once. Default: 10000.
+
+    :return: <List[str]> The sample ids.
+    """
+    rng = np.random.default_rng(seed)
+    flip = rng.random(len(model)) < flipped
+    ref = np.where(flip, model["alt"], model["ref"])
+    alt = np.where(flip, model["ref"], model["alt"])
+    sample_ids = [f"sample{i}" for i in range(dosages.shape[0])]
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("##fileformat=VCFv4.2\n")
+        file.write(
+            "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"
+            + "\t".join(sample_ids)
+            + "\n",
+        )
+        for start in range(0, len(model), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            codes: np.ndarray = dosages[:, chunk].T.astype(np.int64)
+            codes = np.where(flip[chunk, None] & (codes >= 0), 2 - codes, codes)
+            fields = VCF_GENOTYPES[np.where(codes < 0, 3, codes)]
+            lines = [
+                f"1\t{start + j + 1}\t{rsid}\t{r}\t{a}\t.\tPASS\t.\tGT\t"
+                + "\t".join(row)
+                for j, (rsid, r, a, row) in enumerate(
+                    zip(model["rsid"][chunk], ref[chunk], alt[chunk], fields),
+                )
+            ]
+            file.write("\n".join(lines) + "\n")
+    return sample_ids
+
+
+def make_dataset(
+    folder: str,
+    n_snps: int,
+    n_pops: int,
+    n_samples: int,
+    input_format: str,
+    seed: int = 0,
+) -> Tuple[str, List[str], List[str], np.ndarray]:
+    """
+    Generate a model and admixed samples in the given format.
+
+    :param folder: <str> Folder where to save the files.
+    :param n_snps: <int> Number of SNPs of the model.
+    :param n_pops: <int> Number of populations of the model.
+    :param n_samples: <int> Number of samples.
+    :param input_format: <str> Format of the samples: 23andme, ancestry or vcf.
+    :param seed: <int> Random seed. Default: 0.
+
+    :return: <Tuple[str, List[str], List[str], np.ndarray]> Path of the model text
+                                                            file, paths of the input
+                                                            files, sample ids and
+                                                            true proportions.
+    """
+    os.makedirs(folder, exist_ok=True)
+    model = make_model(n_snps, n_pops, seed=seed)
+    model_path = os.path.join(folder, "model.txt")
+    write_model(model, model_path)
+    proportions = make_proportions(n_samples, n_pops, seed=seed + 1)
+    dosages = make_dosages(model, proportions, seed=seed + 2)
+    if input_format == "vcf":
+        vcf_path = os.path.join(folder, "samples.vcf")
+        sample_ids = write_vcf(model, dosages, vcf_path, seed=seed + 3)
+        return model_path, [vcf_path], sample_ids, proportions
+    if input_format == "23andme":
+        paths = write_23andme(model, dosages, os.path.join(folder, "samples"))
+    elif input_format == "ancestry":
+        paths = write_ancestry(model, dosages, os.path.join(folder, "samples"))
+    else:
+        raise ValueError(f"Unknown input format {input_format}")
+    return model_path, paths, [os.path.basename(path) for path in paths], proportions
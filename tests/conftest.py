@@ -0,0 +1,9 @@
+# Imports: standard library
+import os
+import sys
+
+# The modules of the package and the synthetic data generators of the benchmarks
+# are imported by name, as the scripts of both folders do
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, os.path.join(ROOT, "admixture"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
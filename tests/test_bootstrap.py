@@ -0,0 +1,25 @@
+# Imports: third party
+import numpy as np
+
+# Imports: first party
+from bundle import ModelBundle
+from encoding import GenotypeMatrix
+from bootstrap import bootstrap_intervals
+from synthetic import make_model, make_dosages
+
+
+def test_intervals_leave_zero_estimates():
+    frame = make_model(20_000, 4, seed=1)
+    model = ModelBundle.from_frame(frame)
+    dosages = make_dosages(frame, np.array([[0.0, 0.6, 0.4, 0.0]]), seed=2)
+    genotypes = GenotypeMatrix(["sample"], np.arange(len(frame)), dosages)
+    # Proportions put exactly on zero by a solver, from which EM alone barely moves
+    # the replicates
+    ancestries = {"sample": {"POP0": 0.0, "POP1": 0.6, "POP2": 0.4, "POP3": 0.0}}
+
+    intervals = bootstrap_intervals(genotypes, model, ancestries, 50)["sample"]
+
+    for pop in ["POP0", "POP3"]:
+        lower, upper = intervals[pop]
+        assert lower < 0.001
+        assert upper > 0.003
@@ -0,0 +1,53 @@
+# Imports: third party
+import numpy as np
+import pytest
+
+# Imports: first party
+from optimizer import PRECISIONS, FrequencyBlocks, solve_admixture
+from synthetic import make_model, make_dosages, make_proportions
+
+
+def make_fixed_snps(n_snps: int, n_pops: int, n_fixed: int, seed: int = 0):
+    """
+    Random frequencies and the dosages of a sample drawn from random admixture
+    proportions, then fix the alternate allele of n_fixed SNPs in every population
+    and of n_fixed others in none, and give the sample the absent allele at those.
+
+    :return: Frequencies, dosages and the positions of the fixed SNPs.
+    """
+    model = make_model(n_snps, n_pops, seed=seed)
+    proportions = make_proportions(1, n_pops, seed=seed)
+    dosages = make_dosages(model, proportions, missing=0, seed=seed)[0]
+    frequencies = model[model.columns[3:]].to_numpy(copy=True)
+    rng = np.random.default_rng(seed)
+    fixed = rng.choice(n_snps, 2 * n_fixed, replace=False)
+    frequencies[fixed[:n_fixed]] = 1
+    frequencies[fixed[n_fixed:]] = 0
+    dosages[fixed[:n_fixed]] = rng.integers(0, 2, n_fixed)
+    dosages[fixed[n_fixed:]] = rng.integers(1, 3, n_fixed)
+    return frequencies, dosages.astype(np.int64), fixed
+
+
+@pytest.mark.parametrize("blocks", [False, True])
+@pytest.mark.parametrize("precision", list(PRECISIONS))
+@pytest.mark.parametrize("solver", ["slsqp", "trust-constr", "em"])
+def test_fixed_snps_are_ignored(solver, precision, blocks):
+    n_snps = 20_000
+    frequencies, dosages, fixed = make_fixed_snps(n_snps, 5, 3)
+    # The fixed SNPs carry no information, so the estimates must not change when
+    # they are left out
+    kept = np.setdiff1d(np.arange(n_snps), fixed)
+    expected, _ = solve_admixture(frequencies[kept], dosages[kept])
+
+    typed = frequencies.astype(PRECISIONS[precision])
+    if blocks:
+        typed = FrequencyBlocks(
+            typed,
+            np.arange(n_snps),
+            block_size=4096,
+            precision=precision,
+        )
+    admixture, info = solve_admixture(typed, dosages, solver)
+
+    assert np.isfinite(info["log_likelihood"])
+    np.testing.assert_allclose(admixture, expected, rtol=0, atol=1e-4)
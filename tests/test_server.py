@@ -0,0 +1,33 @@
+# Imports: standard library
+import gzip
+
+# Imports: third party
+import numpy as np
+import pytest
+
+# Imports: first party
+from bundle import ModelBundle
+from server import AdmixtureServer
+from registry import ModelCache
+from synthetic import make_model, make_dosages, write_23andme, write_ancestry
+
+
+@pytest.mark.parametrize(
+    "input_format, write",
+    [("23andme", write_23andme), ("ancestry", write_ancestry)],
+)
+def test_load_gzip_upload(tmp_path, input_format, write):
+    frame = make_model(500, 3)
+    model = ModelBundle.from_frame(frame)
+    dosages = make_dosages(frame, np.array([[0.2, 0.3, 0.5]]))
+    with open(write(frame, dosages, str(tmp_path))[0], "rb") as file:
+        body = file.read()
+    server = AdmixtureServer(ModelCache(), "model", threads=1)
+
+    plain = server._load(body, input_format, model, "plain")
+    compressed = server._load(gzip.compress(body), input_format, model, "gzip")
+
+    assert compressed.sample_ids == ["gzip"]
+    np.testing.assert_array_equal(compressed.rows, plain.rows)
+    np.testing.assert_array_equal(compressed.dosages, plain.dosages)
+    assert len(plain.rows) == (dosages >= 0).sum()
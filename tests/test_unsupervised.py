@@ -0,0 +1,27 @@
+# Imports: third party
+import numpy as np
+
+# Imports: first party
+from synthetic import make_model, make_dosages, make_proportions
+from unsupervised import fit_admixture, match_populations
+
+
+def test_fit_admixture_recovers_proportions():
+    model = make_model(3000, 3, fst=0.2, seed=0)
+    proportions = make_proportions(200, 3, seed=0)
+    dosages = make_dosages(model, proportions, seed=0)
+
+    admixture, frequencies, info = fit_admixture(dosages, 3)
+
+    assert info["converged"]
+    assert frequencies.shape == (3000, 3)
+    order = match_populations(proportions, admixture)
+    assert np.abs(admixture[:, order] - proportions).mean() < 0.03
+    # The estimates fit the genotypes at least as well as the true parameters
+    _, _, truth = fit_admixture(
+        dosages,
+        3,
+        max_iter=1,
+        initial=(proportions, model[model.columns[3:]].to_numpy()),
+    )
+    assert info["log_likelihood"] >= truth["log_likelihood"]